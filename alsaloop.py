@@ -23,185 +23,1668 @@ SOFTWARE.
 
 # !/usr/bin/env python
 
+import os
 import sys
 import logging
-from math import sqrt, log
-from struct import unpack_from
-import os
+import argparse
+import select
+import signal
+import time
+import threading
+import queue
+from collections import Counter
+from math import sqrt
+from operator import add
 
 import alsaaudio
 
-output_stopped = True
+import alsaloopdsp
+import alsaloopbuffer
+import alsaloopconfig
+import alsaloopdetect
+import alsaloopmixer
+import alsaloophooks
+import alsaloopmetrics
+import alsaloopsched
+import alsaloopsupervisor
+import alsalooptap
+
+# The engine run by the command line entry point
+engine = None
 
-# The maximum value which can be read from the input device (in other words, the value for maximum volume)
-SAMPLE_MAXVAL = 32768
+# The maximum value which can be read from the input device (in other words, the value for maximum volume) in the
+# default S32_LE format. The full scale of the negotiated format is used for the actual device.
+SAMPLE_MAXVAL = alsaloopdsp.DEFAULT_FORMAT.full_scale
 
+INPUT_DEVICE = "hw:CARD=UAC2Gadget,DEV=0"
+OUTPUT_DEVICE = "default"
+
+# Default number of channels, both devices are opened with the same number of channels
 CHANNELS = 2
 # Sample rate in samples per second
 SAMPLE_RATE = 48000
 PERIOD_SIZE = 2048
-# The duration of a measurement interval (after which the thresholds will be checked) in seconds.
+# Bytes per sample in the default S32_LE format
+SAMPLE_WIDTH = alsaloopdsp.DEFAULT_FORMAT.width
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+# Sample formats in order of preference. The first one supported by both devices is used, audio is only converted if
+# there is none.
+FORMAT_PREFERENCE = ["S32_LE", "S24_LE", "S24_3LE", "S16_LE", "FLOAT_LE"]
+# Sample rates in order of preference, if a device doesn't support SAMPLE_RATE
+RATE_PREFERENCE = [SAMPLE_RATE, 44100, 96000, 88200, 192000, 176400, 32000]
+# The time to wait for a device to become ready in milliseconds
+POLL_TIMEOUT = 1000
+# Size of the buffer between the capture and the playback thread in milliseconds
+BUFFER_TIME = 1000
+# Playback starts once this many milliseconds of audio have been buffered
+TARGET_LATENCY = 100
+# If the buffer drops below the low watermark, playback waits until the target latency has been buffered again.
+# If it exceeds the high watermark, the oldest audio is dropped. Both are in milliseconds, the low watermark is at
+# least one period.
+LOW_WATERMARK = 0
+HIGH_WATERMARK = 400
+# Audio kept from before a signal has been detected in milliseconds. It is played when output starts, so the
+# beginning of the music isn't lost, but it adds to the latency. 0 disables the pre-roll.
+PREROLL_TIME = 0
+# The number of captured periods that can wait for the analysis
+ANALYSIS_QUEUE_LENGTH = 64
+# Period size of the capture device while no input signal has been detected for IDLE_DELAY seconds, 0 disables the
+# idle mode. Larger periods wake up the threads less often, only IDLE_MEASURE of every period is measured.
+IDLE_PERIOD_SIZE = 0
+IDLE_DELAY = 10
+IDLE_MEASURE = 0.25
+# The interval in which the input level is reported on stdout in seconds
 SAMPLE_SECONDS_BEFORE_CHECK = 1
-# The number of samples before each check
-SAMPLE_COUNT_BEFORE_CHECK = int((SAMPLE_RATE / CHANNELS) * SAMPLE_SECONDS_BEFORE_CHECK)
 # The time during which the input threshold hasn't been reached, before output is stopped.
 # This is useful for preventing the output device from turning off and on when there is a short silence in the input.
-SAMPLE_SECONDS_BEFORE_TURN_OFF = 15
-# The number of checks which have to fail before audio is turned off.
-CHECK_NUMBER_BEFORE_TURN_OFF = int(SAMPLE_SECONDS_BEFORE_TURN_OFF / SAMPLE_COUNT_BEFORE_CHECK)
+SAMPLE_SECONDS_BEFORE_TURN_OFF = alsaloopdetect.RELEASE_TIME / 1000
+# Seconds between two "heartbeat" events of the engine
+HEARTBEAT_INTERVAL = 1
+# Seconds between two saves of the noise floor with automatic thresholds, it is saved when the engine stops as well
+NOISE_SAVE_INTERVAL = 300
 
-def open_mixer(output=False):
-    input_mixer = alsaaudio.Mixer(control='PCM', device="hw:CARD=UAC2Gadget")
+# Input format, output format and rate negotiated by negotiate() for a pair of devices, reopening the devices
+# doesn't probe them again
+negotiated_parameters = {}
+
+
+def probe(device):
+    """ Returns the supported formats of a device in order of preference and its supported rates """
+    try:
+        supported = device.getformats()
+    except AttributeError:
+        # pyalsaaudio before 0.10 can only try one format after the other
+        supported = []
+        for name in FORMAT_PREFERENCE:
+            try:
+                if device.setformat(getattr(alsaaudio, "PCM_FORMAT_" + name)) == getattr(alsaaudio, "PCM_FORMAT_" + name):
+                    supported.append(name)
+            except alsaaudio.ALSAAudioError:
+                pass
+
+    try:
+        rates = device.getrates()
+    except AttributeError:
+        rates = None
+
+    return [name for name in FORMAT_PREFERENCE if name in supported], rates
 
-    if output:
-        output_mixer = alsaaudio.Mixer(control='DSPVolume', device="hw:CARD=sndrpihifiberry") 
-        return input_mixer, output_mixer
 
+def supports_rate(rates, rate):
+    if rates is None:
+        # Unknown, let alsa pick the nearest rate
+        return True
+    elif isinstance(rates, int):
+        return rates == rate
+    elif isinstance(rates, tuple):
+        return rates[0] <= rate <= rates[1]
+    return rate in rates
+
+
+def negotiate(input_name=INPUT_DEVICE, output_name=OUTPUT_DEVICE):
+    """ Find the sample formats and the rate for both devices, the result is cached """
+    if (input_name, output_name) in negotiated_parameters:
+        return negotiated_parameters[(input_name, output_name)]
+
+    input_device = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=input_name)
+    (input_formats, input_rates) = probe(input_device)
+    input_device.close()
+    if not input_formats:
+        raise ValueError("{} doesn't support any of {}".format(input_name, ", ".join(FORMAT_PREFERENCE)))
+
+    try:
+        output_device = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NONBLOCK, device=output_name)
+        (output_formats, output_rates) = probe(output_device)
+        output_device.close()
+    except alsaaudio.ALSAAudioError as e:
+        logging.warning("couldn't probe %s (%s), assuming it supports the input format", output_name, e)
+        (output_formats, output_rates) = (input_formats, input_rates)
+    if not output_formats:
+        raise ValueError("{} doesn't support any of {}".format(output_name, ", ".join(FORMAT_PREFERENCE)))
+
+    common_formats = [name for name in input_formats if name in output_formats]
+    if common_formats:
+        input_format = output_format = alsaloopdsp.FORMATS[common_formats[0]]
     else:
-        return input_mixer
+        input_format = alsaloopdsp.FORMATS[input_formats[0]]
+        output_format = alsaloopdsp.FORMATS[output_formats[0]]
+
+    rate = SAMPLE_RATE
+    for candidate in RATE_PREFERENCE:
+        if supports_rate(input_rates, candidate) and supports_rate(output_rates, candidate):
+            rate = candidate
+            break
+
+    logging.info("using %s at %d Hz for capture from %s, %s for playback on %s", input_format, rate, input_name,
+                 output_format, output_name)
+    negotiated_parameters[(input_name, output_name)] = (input_format, output_format, rate)
+    return negotiated_parameters[(input_name, output_name)]
+
+
+def configure(device, name, sample_format, rate, channels=CHANNELS, period_size=PERIOD_SIZE):
+    actual = device.setchannels(channels)
+    if actual is not None and actual != channels:
+        raise ValueError("{} doesn't support {} channels".format(name, channels))
+    device.setrate(rate)
+    actual = device.setformat(getattr(alsaaudio, "PCM_FORMAT_" + sample_format.name))
+    if actual is not None and actual != getattr(alsaaudio, "PCM_FORMAT_" + sample_format.name):
+        logging.warning("%s doesn't accept %s", name, sample_format)
+    device.setperiodsize(period_size)
+    return device
+
+
+def open_input(input_name=INPUT_DEVICE, output_name=OUTPUT_DEVICE, channels=CHANNELS, period_size=PERIOD_SIZE):
+    (input_format, _output_format, rate) = negotiate(input_name, output_name)
+    input_device = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device=input_name)
+    return configure(input_device, input_name, input_format, rate, channels, period_size)
 
-def open_sound(output=False):
-    input_device = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NONBLOCK, device="hw:CARD=UAC2Gadget,DEV=0")
-    input_device.setchannels(CHANNELS)
-    input_device.setrate(SAMPLE_RATE)
-    input_device.setformat(alsaaudio.PCM_FORMAT_S32_LE)
-    input_device.setperiodsize(PERIOD_SIZE)
+
+def open_output(input_name=INPUT_DEVICE, output_name=OUTPUT_DEVICE, channels=CHANNELS):
+    (_input_format, output_format, rate) = negotiate(input_name, output_name)
+    output_device = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NONBLOCK, device=output_name)
+    return configure(output_device, output_name, output_format, rate, channels)
+
+
+def open_sound(output=False, channels=CHANNELS):
+    input_device = open_input(channels=channels)
 
     if output:
-        output_device = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NONBLOCK, device=device)
-        output_device.setchannels(CHANNELS)
-        output_device.setrate(SAMPLE_RATE)
-        output_device.setformat(alsaaudio.PCM_FORMAT_S32_LE)
-        return input_device, output_device
+        return input_device, open_output(channels=channels)
 
     else:
         return input_device
 
 
-def decibel(value):
-    return 20 * log(value / SAMPLE_MAXVAL, 10)
+class DevicePoller():
+    """ Waits on the poll descriptors of a PCM device
 
+    ALSA wakes up pollers once at least a period can be read from a capture
+    device or written to a playback device.
+    """
 
-def stop_playback(_signalNumber, _frame):
-    global output_stopped
-    logging.info("received USR1, stopping music playback")
-    output_stopped = True
+    def __init__(self, device):
+        self.device = device
+        self.descriptors = device.polldescriptors()
+        self.poll = select.poll()
+        for (fd, eventmask) in self.descriptors:
+            self.poll.register(fd, eventmask)
 
+    def wait(self, timeout):
+        """ Wait up to timeout milliseconds, returns True if the device is ready """
+        if not self.poll.poll(timeout):
+            return False
+        try:
+            # Let alsa-lib translate the events, plugins might report events that aren't relevant
+            return self.device.polldescriptors_revents(self.descriptors) != 0
+        except AttributeError:
+            # Older pyalsaaudio versions don't support this
+            return True
 
-if __name__ == '__main__':
 
-    start_db_threshold = 0
-    stop_db_threshold = 0
-    try:
-        start_db_threshold = float(sys.argv[1])
-        if start_db_threshold > 0:
-            start_db_threshold = -start_db_threshold
+def create_poller(device, busy_wait=False):
+    if busy_wait or device is None:
+        return None
+    return DevicePoller(device)
 
-        # Define the stop threshold. This prevents hysteresis when the volume fluctuates just around the threshold.
-        stop_db_threshold = start_db_threshold - 3
 
-        print("using alsaloop with input level detection {:.1f} to start, {:.1f} to stop"
-              .format(start_db_threshold, stop_db_threshold))
-    except:
-        print("using alsaloop without input level detection")
+def write_data(output_device, output_poller, data, timeout=POLL_TIMEOUT, counters=None, frame_size=FRAME_SIZE):
+    """ Write data to the output device, waiting until it can take more data if a poller is given """
+    if counters is None:
+        counters = Counter()
+
+    data = memoryview(data)
+    short_write = False
+    while len(data) > 0:
+        written = output_device.write(data)
+        if written < 0:
+            # Underrun, the device has been prepared again
+            logging.debug("playback underrun")
+            counters["playback_underruns"] += 1
+            continue
 
-    device = 'default'
-    input_device = open_sound(output=False)
-    output_device = None
-    finished = False
+        data = data[written * frame_size:]
+        if len(data) == 0:
+            break
 
-    samples = 0
-    sample_sum = 0
-    max_sample = 0
-    status = "-"
-    rms_volume = 0
-    input_detected = False
+        if not short_write:
+            short_write = True
+            counters["short_writes"] += 1
 
-    # Counter for subsequent intervals in which the threshold has not been met while playback is active
-    count_playback_threshold_not_met = 0
+        if output_poller is not None and not output_poller.wait(timeout):
+            logging.warning("output device not ready after %d ms, dropping %d bytes", timeout, len(data))
+            counters["dropped_writes"] += 1
+            break
 
-    while not finished:
-        # Read data from device
-        data_length, data = input_device.read()
 
-        if data_length < 0:
-            # Something's wrong when this happens. Just try to read again.
-            logging.error("?")
-            continue
+class OutputGate():
+    """ Starts and stops playback on an output device that stays open
 
-        if (len(data) % 4) != 0:
-            # Additional sanity test: If the length isn't a multiple of 4, something's wrong
-            print("oops %s".format(len(data)))
-            continue
+    The device is paused while no input is detected. Devices that can't be
+    paused (e.g. dmix) are kept running with silence instead. What is still
+    queued when playback is paused is dropped when it is resumed.
+    """
+
+    def __init__(self, output_device, output_poller, timeout=POLL_TIMEOUT, counters=None, frame_size=FRAME_SIZE):
+        self.output_device = output_device
+        self.output_poller = output_poller
+        self.timeout = timeout
+        self.counters = counters
+        self.frame_size = frame_size
+        self.can_pause = True
+        self.paused = False
+        self.started = False
+        self.silence = bytes(PERIOD_SIZE * frame_size)
+
+    @property
+    def needs_silence(self):
+        return self.started and not self.can_pause
+
+    def open(self):
+        if self.paused:
+            # Don't play the rest of the old audio, the device is prepared again by the next write
+            self.output_device.drop()
+            self.paused = False
+
+    def close(self):
+        # A device that hasn't been written to yet isn't running and doesn't need to be paused
+        if not self.started or not self.can_pause:
+            return
+        try:
+            self.output_device.pause(True)
+            self.paused = True
+        except alsaaudio.ALSAAudioError as e:
+            logging.info("output device can't be paused (%s), playing silence instead", e)
+            self.can_pause = False
+
+    def drain(self):
+        """ Wait until the device has played what has been written, e.g. a fade out, before it is paused or closed
+
+        A period of silence is written after it and stays queued, so that the device doesn't underrun.
+        """
+        if not self.started:
+            return
+        self.write(self.silence)
+        info = self.output_device.info()
+        buffer_size = info["buffer_size"]
+        silence_frames = len(self.silence) // self.frame_size
+        deadline = time.monotonic() + buffer_size / info["rate"] + self.timeout / 1000
+        while True:
+            avail = self.output_device.avail()
+            # A negative value is an error like an underrun, nothing is played anymore
+            if avail < 0 or buffer_size - avail <= silence_frames:
+                return
+            if time.monotonic() > deadline:
+                logging.debug("output device still has %d frames queued", buffer_size - avail)
+                return
+            time.sleep(silence_frames / info["rate"] / 4)
+
+    def write(self, data):
+        self.started = True
+        write_data(self.output_device, self.output_poller, data, self.timeout, self.counters, self.frame_size)
+
+    def idle(self, frames):
+        """ Called for every period while the gate is closed """
+        if not self.needs_silence:
+            return
+        # Like a period of audio, silence is only written once the device can take it
+        if self.output_poller is not None and not self.output_poller.wait(self.timeout):
+            return
+        self.write(memoryview(self.silence)[:frames * self.frame_size])
+
+
+class Pipeline():
+    """ Moves audio from the capture to the playback device
+
+    A capture thread reads periods from the input device into a ring buffer
+    and queues them for the analysis. While output is active, a playback
+    thread writes the buffered audio to the output device. Overruns and
+    underruns on the devices and the buffer are counted in counters. If
+    metrics are given, reads and writes are timed. With realtime, both
+    threads run with the SCHED_FIFO policy at rt_priority on the given cpus.
+    If a device fails, the thread using it ends and sets failure to the
+    error, the pipeline has to be set up again. A busy output device is
+    opened again after a growing delay instead.
+    While idle is set, the capture device is opened again with idle_period
+    frames per period. Output fades in when it starts and the buffered audio
+    fades out before it stops, over fade_time milliseconds.
+    """
 
-        offset = 0
-        # Read through the currently captured audio data
-        while offset < data_length:
+    def __init__(self, persistent=False, busy_wait=False, poll_timeout=POLL_TIMEOUT,
+                 latency=TARGET_LATENCY, low_watermark=LOW_WATERMARK, high_watermark=HIGH_WATERMARK,
+                 buffer_time=BUFFER_TIME, drift_compensation=False, preroll_time=PREROLL_TIME,
+                 counters=None, metrics=None, input_name=INPUT_DEVICE, output_name=OUTPUT_DEVICE,
+                 realtime=False, rt_priority=alsaloopsched.RT_PRIORITY, cpus=None, channels=CHANNELS,
+                 idle_period=IDLE_PERIOD_SIZE, fade_time=alsaloopdsp.FADE_TIME,
+                 volume_ramp=alsaloopdsp.VOLUME_RAMP_TIME):
+        self.channels = channels
+        self.fade_time = fade_time
+        self.volume_ramp = volume_ramp
+        self.idle_period = idle_period
+        # Set by the engine while no input signal is expected, the capture thread changes the period size
+        self.idle = False
+        self.period_size = PERIOD_SIZE
+        self.realtime = realtime
+        self.rt_priority = rt_priority
+        self.cpus = cpus
+        self.input_name = input_name
+        self.output_name = output_name
+        self.persistent = persistent
+        self.busy_wait = busy_wait
+        self.poll_timeout = poll_timeout
+        self.latency = latency
+        self.low_watermark_time = low_watermark
+        self.high_watermark_time = high_watermark
+        self.buffer_time = buffer_time
+        self.drift_compensation = drift_compensation
+        self.preroll_time = preroll_time
+
+        # Set up by start() once the devices' formats are known
+        self.input_format = None
+        self.output_format = None
+        self.rate = SAMPLE_RATE
+        self.input_frame_size = FRAME_SIZE
+        self.output_frame_size = FRAME_SIZE
+        self.ring = None
+        self.preroll = None
+        # Bytes of pre-roll audio that have been moved into the ring buffer when output started
+        self.preroll_fill = 0
+        self.drift_controller = None
+        self.resampler = None
+        # Fades and software volume, None without numpy
+        self.gain = None
+        self.periods = queue.Queue(ANALYSIS_QUEUE_LENGTH)
+        if counters is None:
+            counters = Counter()
+        self.counters = counters
+        # Counters can be shared with a previous pipeline, only report what happens from now on
+        self.reported_counters = Counter(counters)
+        self.metrics = metrics
+
+        self.input_device = None
+        self.input_poller = None
+        self.output_device = None
+        self.output_poller = None
+        self.output_gate = None
+        self.output_active = threading.Event()
+        # Set while output stops with a fade, the capture thread keeps filling the buffer until it has been read
+        self.fading = False
+        # Delay before opening an output device that was busy again, at most one poll timeout
+        self.open_backoff = alsaloopsupervisor.Backoff(maximum=poll_timeout / 1000)
+        # The error that ended the capture or the playback thread
+        self.failure = None
+        self.running = False
+        self.threads = []
+
+    def milliseconds_to_bytes(self, milliseconds):
+        return int(milliseconds * self.rate / 1000) * self.input_frame_size
+
+    def setup_buffers(self):
+        """ Allocate the buffers for the negotiated formats and rate """
+        (self.input_format, self.output_format, self.rate) = negotiate(self.input_name, self.output_name)
+        self.input_frame_size = self.channels * self.input_format.width
+        self.output_frame_size = self.channels * self.output_format.width
+
+        (self.target_fill, self.low_watermark, self.high_watermark) = self.watermarks(
+            self.latency, self.low_watermark_time, self.high_watermark_time)
+        buffer_size = self.milliseconds_to_bytes(self.buffer_time)
+
+        # The pre-roll is moved into the ring buffer when output starts, make room for it
+        preroll_size = self.milliseconds_to_bytes(self.preroll_time)
+        if preroll_size > 0:
+            self.preroll = alsaloopbuffer.RingBuffer(preroll_size // self.input_frame_size, self.input_frame_size)
+        else:
+            self.preroll = None
+        self.ring = alsaloopbuffer.RingBuffer((buffer_size + preroll_size) // self.input_frame_size,
+                                              self.input_frame_size)
+
+        if self.drift_compensation:
+            self.drift_controller = alsaloopbuffer.DriftController(self.target_fill // self.input_frame_size)
+            self.resampler = alsaloopdsp.create_resampler(self.channels, self.input_format, self.output_format)
+        else:
+            self.drift_controller = None
+            self.resampler = None
+            if self.input_format is not self.output_format and alsaloopdsp.numpy is None:
+                raise ValueError("converting from {} to {} requires numpy".format(self.input_format,
+                                                                                  self.output_format))
+        self.gain = alsaloopdsp.create_gain_stage(self.output_format, self.channels, self.rate, self.fade_time,
+                                                  self.volume_ramp)
+
+    def watermarks(self, latency, low_watermark, high_watermark):
+        """ The target fill and the watermarks in bytes, raises ValueError if they don't fit the buffer """
+        period_bytes = PERIOD_SIZE * self.input_frame_size
+        target_fill = self.milliseconds_to_bytes(latency)
+        low_watermark = max(self.milliseconds_to_bytes(low_watermark), period_bytes)
+        high_watermark = self.milliseconds_to_bytes(high_watermark)
+        if not low_watermark <= target_fill < high_watermark:
+            raise ValueError("watermarks have to be below and above the target latency")
+        if self.milliseconds_to_bytes(self.buffer_time) < high_watermark + period_bytes:
+            raise ValueError("buffer time has to exceed the high watermark by at least one period")
+        return (target_fill, low_watermark, high_watermark)
+
+    def set_buffering(self, latency, low_watermark, high_watermark):
+        """ Change the target latency and the watermarks while audio keeps playing """
+        (self.target_fill, self.low_watermark, self.high_watermark) = self.watermarks(latency, low_watermark,
+                                                                                     high_watermark)
+        self.latency = latency
+        self.low_watermark_time = low_watermark
+        self.high_watermark_time = high_watermark
+        if self.drift_controller is not None:
+            self.drift_controller.target = (self.target_fill + self.preroll_fill) // self.input_frame_size
+
+    def set_fades(self, fade_time, volume_ramp):
+        self.fade_time = fade_time
+        self.volume_ramp = volume_ramp
+        if self.gain is not None:
+            self.gain.set_times(fade_time, volume_ramp)
+
+    def start(self):
+        if self.realtime and self.busy_wait:
+            raise ValueError("busy waiting with real-time priority would keep other threads from running")
+        self.setup_buffers()
+        self.input_device = open_input(self.input_name, self.output_name, self.channels)
+        if self.metrics is not None:
+            self.metrics.counters["input_opens"] += 1
+        self.input_poller = create_poller(self.input_device, self.busy_wait)
+        if self.persistent:
+            self.open_output()
+
+        self.running = True
+        self.threads = [threading.Thread(target=self.capture_loop, name="capture", daemon=True),
+                        threading.Thread(target=self.playback_loop, name="playback", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        # The threads notice within the poll timeout
+        self.running = False
+        for thread in self.threads:
+            thread.join(self.poll_timeout / 1000 + 1)
+        self.threads = []
+        self.close_output()
+        self.input_device = None
+        self.input_poller = None
+
+    def start_output(self):
+        self.ring.clear()
+        self.output_active.set()
+
+    def stop_output(self):
+        self.fading = self.gain is not None
+        self.output_active.clear()
+
+    def read_period(self, timeout=None):
+        """ Returns the next captured (frames, data) period for the analysis, or None after timeout seconds """
+        try:
+            return self.periods.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def report_counters(self):
+        """ Log the counters that have changed since the last report """
+        changed = {key: value for (key, value) in self.counters.items() if self.reported_counters[key] != value}
+        if changed:
+            logging.warning("audio pipeline problems: %s",
+                            ", ".join("{} {}".format(key, value) for (key, value) in sorted(changed.items())))
+            # Counter.update() would add the values
+            for (key, value) in changed.items():
+                self.reported_counters[key] = value
+
+        if self.drift_controller is not None:
+            logging.debug("clock drift %.1f ppm, resampling ratio %.6f",
+                          self.drift_controller.drift * 1e6, self.drift_controller.ratio)
+
+    def buffered_frames(self):
+        """ Frames in the ring buffer, including the part of the next period the capture device already has """
+        since_write = (time.monotonic() - self.ring.written_at) * self.rate
+        return self.ring.fill_frames + min(self.period_size, since_write)
+
+    def open_output(self):
+        self.output_device = open_output(self.input_name, self.output_name, self.channels)
+        if self.metrics is not None:
+            self.metrics.counters["output_opens"] += 1
+        self.output_poller = create_poller(self.output_device, self.busy_wait)
+        self.output_gate = OutputGate(self.output_device, self.output_poller, self.poll_timeout, self.counters,
+                                      self.output_frame_size)
+
+    def close_output(self):
+        if self.output_device is not None:
+            self.output_device.close()
+        self.output_device = None
+        self.output_poller = None
+        self.output_gate = None
+
+    def open_gate(self):
+        """ Called by the playback thread when output starts, returns False if the device can't be opened yet
+
+        The device can still be busy, e.g. while the start hooks pause other
+        players, it is tried again after a delay.
+        """
+        try:
+            if self.output_gate is None:
+                self.open_output()
+            self.output_gate.open()
+        except alsaaudio.ALSAAudioError as e:
+            self.close_output()
+            self.counters["output_open_failures"] += 1
+            delay = self.open_backoff.failed()
+            logging.warning("can't open %s (%s), trying again in %.2f s", self.output_name, e, delay)
+            time.sleep(delay)
+            return False
+        self.open_backoff.reset()
+        return True
+
+    def fail(self, error):
+        """ Called by the capture or the playback thread when its device has failed """
+        logging.error("%s thread failed: %s", threading.current_thread().name, error)
+        self.counters["device_errors"] += 1
+        self.failure = error
+
+    def start_forwarding(self):
+        """ Called by the capture thread when output starts """
+        self.preroll_fill = 0
+        if self.preroll is not None:
+            self.preroll_fill = self.preroll.fill
+        if self.drift_controller is not None:
+            # Keep the latency that the pre-roll adds, don't try to catch up
+            self.drift_controller.target = (self.target_fill + self.preroll_fill) // self.input_frame_size
+        if self.preroll is not None:
+            self.preroll.move_to(self.ring)
+            logging.debug("playing %.0f ms of pre-roll", self.preroll_fill / self.input_frame_size * 1000 / self.rate)
+
+    def reopen_input(self, period_size):
+        """ Called by the capture thread to change the period size, returns False if the device can't be opened
+
+        Audio that hasn't been read from the device yet is lost, the capture
+        thread reads the period that is ready before.
+        """
+        transition_start = time.monotonic()
+        if self.input_device is not None:
+            self.input_device.close()
+            self.input_device = None
+            self.input_poller = None
+        try:
+            input_device = open_input(self.input_name, self.output_name, self.channels, period_size)
+        except alsaaudio.ALSAAudioError as e:
+            logging.warning("can't open %s again: %s", self.input_name, e)
+            self.counters["input_reopen_failures"] += 1
+            return False
+        self.input_device = input_device
+        self.input_poller = create_poller(input_device, self.busy_wait)
+        self.period_size = period_size
+        if self.metrics is not None:
+            self.metrics.counters["input_opens"] += 1
+        logging.info("capturing periods of %d frames, opened %s again in %.1f ms", period_size, self.input_name,
+                     (time.monotonic() - transition_start) * 1000)
+        return True
+
+    def output_data(self, data):
+        """ Convert a period of captured audio for the output device and apply the gain """
+        if self.drift_controller is not None:
+            data = self.resampler.process(data, self.drift_controller.ratio)
+        else:
+            # Audio is passed through unchanged if both devices use the same format
+            data = alsaloopdsp.convert(data, self.input_format, self.output_format)
+        if self.gain is not None:
+            data = self.gain.process(data)
+        return data
+
+    def fade_out(self, period):
+        """ Play the start of the buffered audio with a falling gain, so that output doesn't stop with a click
+
+        Returns once the device has played the fade, before it is paused or closed.
+        """
+        if self.gain is None or self.output_gate is None:
+            return
+        self.gain.fade_out()
+        size = min(PERIOD_SIZE, int(self.fade_time * self.rate / 1000)) * self.input_frame_size
+        # Playback keeps up with the capture, so the audio to fade may not have been captured yet
+        self.ring.wait(size, self.poll_timeout / 1000)
+        length = self.ring.read(memoryview(period)[:size])
+        self.fading = False
+        if length:
+            self.output_gate.write(self.output_data(memoryview(period)[:length]))
+            self.output_gate.drain()
+
+    def capture_loop(self):
+        if self.realtime:
+            alsaloopsched.realtime_thread(self.rt_priority, self.cpus)
+        forwarding = False
+        # Set when the device has a period that hasn't been read yet
+        ready = False
+        metrics = self.metrics
+        while self.running:
+            if self.idle and self.idle_period:
+                period_size = self.idle_period
+            else:
+                period_size = PERIOD_SIZE
+            # A period that is ready is read first, e.g. the start of the signal that ends the idle mode would be lost
+            if (period_size != self.period_size and not ready or self.input_device is None) \
+                    and not self.reopen_input(period_size):
+                time.sleep(self.poll_timeout / 1000)
+                continue
+
+            # Read data from device
+            if metrics is not None:
+                read_start = time.perf_counter()
             try:
-                # Read the left and right channel from the data packet
-                (sample_l, sample_r) = unpack_from('<ii', data, offset=offset)
-            except:
-                # logging.error("%s %s %s",l,len(data), offset)
-                # Set a default value of zero so the program can keep running
-                (sample_l, sample_r) = (0, 0)
-
-            offset += 8
-            samples += 2
-            # Calculate the sum of all samples squared, used to determine rms later.
-            sample_sum += sample_l * sample_l + sample_r * sample_r
-            # Determine the max value of all samples
-            max_sample = max(max_sample, abs(sample_l), abs(sample_r))
-
-        if samples >= SAMPLE_COUNT_BEFORE_CHECK:
-            # Calculate RMS
-            rms_volume = sqrt(sample_sum / samples)
-
-            # Determine which threshold value to use
-            if output_stopped:
-                threshold = start_db_threshold
+                data_length, data = self.input_device.read()
+            except alsaaudio.ALSAAudioError as e:
+                self.fail(e)
+                return
+            ready = False
+
+            if data_length == 0:
+                # Nothing captured yet. The first read has started the device, sleep until a period is available.
+                if self.input_poller is not None:
+                    ready = self.input_poller.wait(self.poll_timeout)
+                    if not ready:
+                        logging.debug("no input data within %d ms", self.poll_timeout)
+                continue
+
+            if data_length < 0:
+                # The device overran and has been prepared again, the next read will work
+                logging.debug("capture overrun")
+                self.counters["capture_overruns"] += 1
+                if metrics is not None:
+                    metrics.restart("capture")
+                continue
+
+            if (len(data) % self.input_frame_size) != 0:
+                # Additional sanity test: If the length isn't a multiple of the frame size, something's wrong
+                logging.error("captured %s bytes, not a multiple of the frame size", len(data))
+                continue
+
+            if metrics is not None:
+                now = time.perf_counter()
+                metrics.observe("read", now - read_start)
+                metrics.iteration("capture", now, data_length / self.rate)
+
+            active = self.output_active.is_set() or self.fading
+            if active and not forwarding:
+                self.start_forwarding()
+            forwarding = active
+
+            if active:
+                if self.ring.write(data):
+                    self.counters["buffer_overruns"] += 1
+                elif self.ring.fill > self.high_watermark + self.preroll_fill:
+                    # Playback doesn't keep up, skip ahead to keep the latency bounded
+                    self.ring.discard(self.ring.fill - self.target_fill - self.preroll_fill)
+                    self.counters["buffer_overruns"] += 1
+            elif self.preroll is not None:
+                self.preroll.write(data)
+
+            try:
+                self.periods.put_nowait((data_length, data))
+            except queue.Full:
+                # The analysis is too slow, this doesn't affect the audio
+                self.counters["analysis_overruns"] += 1
+
+    def playback_loop(self):
+        if self.realtime:
+            alsaloopsched.realtime_thread(self.rt_priority, self.cpus)
+        try:
+            self.play_periods()
+        except alsaaudio.ALSAAudioError as e:
+            self.close_output()
+            self.fail(e)
+
+    def play_periods(self):
+        period = bytearray(PERIOD_SIZE * self.input_frame_size)
+        playing = False
+        prefill = True
+        metrics = self.metrics
+        period_time = PERIOD_SIZE / self.rate
+
+        while self.running:
+            active = self.output_active.is_set()
+            if active != playing:
+                transition_start = time.monotonic()
+                if active:
+                    if not self.open_gate():
+                        continue
+                    if self.gain is not None:
+                        self.gain.fade_in()
+                elif self.persistent:
+                    self.fade_out(period)
+                    self.output_gate.close()
+                else:
+                    self.fade_out(period)
+                    self.close_output()
+                logging.info("output %s in %.1f ms", "started" if active else "stopped",
+                             (time.monotonic() - transition_start) * 1000)
+                playing = active
+                prefill = True
+                if self.drift_controller is not None:
+                    self.drift_controller.reset()
+
+            if not playing:
+                # Output has stopped before it could play, there is nothing to fade
+                self.fading = False
+                if self.output_gate is not None and self.output_gate.needs_silence:
+                    self.output_gate.idle(PERIOD_SIZE)
+                else:
+                    self.output_active.wait(self.poll_timeout / 1000)
+                continue
+
+            if prefill:
+                # Buffer up to the target latency before playback starts
+                if not self.ring.wait(self.target_fill, self.poll_timeout / 1000):
+                    continue
+                prefill = False
+                if metrics is not None:
+                    metrics.restart("playback")
+
+            # Wait until the device can take another period
+            if self.output_poller is not None and not self.output_poller.wait(self.poll_timeout):
+                continue
+
+            if not self.ring.wait(self.low_watermark, PERIOD_SIZE / self.rate):
+                if self.output_active.is_set():
+                    # Capture doesn't keep up, build up the buffer again
+                    self.counters["buffer_underruns"] += 1
+                    prefill = True
+                    if self.drift_controller is not None:
+                        self.drift_controller.reset()
+                continue
+
+            if self.drift_controller is not None:
+                # The fill before reading the period
+                self.drift_controller.update(self.buffered_frames())
+            length = self.ring.read(period)
+            data = self.output_data(memoryview(period)[:length])
+
+            if metrics is not None:
+                write_start = time.perf_counter()
+                self.output_gate.write(data)
+                now = time.perf_counter()
+                metrics.observe("write", now - write_start)
+                metrics.iteration("playback", now, period_time)
             else:
-                threshold = stop_db_threshold
+                self.output_gate.write(data)
+
+
+def decibel(value, full_scale=SAMPLE_MAXVAL):
+    return alsaloopdetect.decibel(value, full_scale)
+
+
+def parse_threshold(value):
+    return alsaloopdetect.parse_threshold(value)
+
+
+# Options of the engine and their defaults, the command line options have the same names
+DEFAULT_OPTIONS = {
+    "input_device": INPUT_DEVICE,
+    "output_device": OUTPUT_DEVICE,
+    "channels": CHANNELS,
+    "meter": "auto",
+    "poll_timeout": POLL_TIMEOUT,
+    "busy_wait": False,
+    "persistent": False,
+    "latency": TARGET_LATENCY,
+    "low_watermark": LOW_WATERMARK,
+    "high_watermark": HIGH_WATERMARK,
+    "buffer_time": BUFFER_TIME,
+    "preroll": PREROLL_TIME,
+    "drift_compensation": False,
+    "window": alsaloopdetect.DETECTION_WINDOW,
+    "attack": alsaloopdetect.ATTACK_TIME,
+    "release": SAMPLE_SECONDS_BEFORE_TURN_OFF * 1000,
+    "hysteresis": alsaloopdetect.HYSTERESIS,
+    "volume_curve": "linear",
+    "start_hooks": [alsaloophooks.PAUSE_ALL_COMMAND],
+    "stop_hooks": [],
+    "hook_timeout": alsaloophooks.HOOK_TIMEOUT,
+    "metrics": False,
+    "metrics_file": None,
+    "weighting": "none",
+    "band_low": alsaloopdsp.BAND_LOW,
+    "band_high": alsaloopdsp.BAND_HIGH,
+    "detect_on": "peak",
+    "crest_min": alsaloopdetect.CREST_MIN,
+    "crest_max": alsaloopdetect.CREST_MAX,
+    "crest_rms": alsaloopdetect.CREST_RMS,
+    "channel_policy": "any",
+    "channel_mask": None,
+    "realtime": False,
+    "rt_priority": alsaloopsched.RT_PRIORITY,
+    "cpus": None,
+    "tap_file": None,
+    "tap_seconds": alsalooptap.TAP_SECONDS,
+    "auto_threshold": False,
+    "start_margin": alsaloopdetect.START_MARGIN,
+    "stop_margin": alsaloopdetect.STOP_MARGIN,
+    "noise_file": alsaloopdetect.NOISE_FILE,
+    "idle_period": IDLE_PERIOD_SIZE,
+    "idle_delay": IDLE_DELAY,
+    "idle_measure": IDLE_MEASURE,
+    "fade_time": alsaloopdsp.FADE_TIME,
+    "volume_ramp": alsaloopdsp.VOLUME_RAMP_TIME,
+    "software_volume": False,
+}
+# Options used to set up the audio pipeline. Changing one of them while the engine runs opens the devices again, all
+# the others are applied between two periods without interrupting the audio.
+PIPELINE_OPTIONS = {"input_device", "output_device", "channels", "poll_timeout", "busy_wait", "persistent",
+                    "buffer_time", "preroll", "drift_compensation", "realtime", "rt_priority", "cpus"}
+BUFFERING_OPTIONS = {"latency", "low_watermark", "high_watermark"}
+GAIN_OPTIONS = {"fade_time", "volume_ramp"}
+METER_OPTIONS = {"meter", "weighting", "band_low", "band_high", "idle_measure"}
+DETECTOR_OPTIONS = {"window", "attack", "release", "hysteresis", "detect_on", "crest_min", "crest_max", "crest_rms",
+                    "channel_policy", "channel_mask", "auto_threshold", "start_margin", "stop_margin"}
+TAP_OPTIONS = {"tap_file", "tap_seconds"}
+# Smallest and largest allowed values of numeric options, None if there is no limit
+OPTION_RANGES = {
+    "channels": (1, None),
+    "poll_timeout": (1, None),
+    "latency": (0, None),
+    "low_watermark": (0, None),
+    "high_watermark": (0, None),
+    "buffer_time": (0, None),
+    "preroll": (0, None),
+    "window": (0, None),
+    "attack": (0, None),
+    "release": (0, None),
+    "hysteresis": (0, None),
+    "hook_timeout": (0, None),
+    "band_low": (0, None),
+    "band_high": (0, None),
+    "crest_min": (0, None),
+    "crest_max": (0, None),
+    "crest_rms": (alsaloopdetect.NOISE_LOWEST, 0),
+    "rt_priority": (1, 99),
+    "tap_seconds": (0, None),
+    "start_margin": (0, None),
+    "stop_margin": (0, None),
+    "idle_period": (0, None),
+    "idle_delay": (0, None),
+    "idle_measure": (0, 1),
+    "fade_time": (0, None),
+    "volume_ramp": (0, None),
+}
+
+
+def convert_option(action, value):
+    """ Convert a value from the configuration file or DBus like argparse converts the command line option """
+    default = DEFAULT_OPTIONS[action.dest]
+    if value is None:
+        if default is not None:
+            raise ValueError("can't be empty")
+        return None
+    if action.nargs == 0:
+        # A flag, DBus booleans are integers
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        if not isinstance(value, int) or value not in (0, 1):
+            raise ValueError("has to be true or false, not {!r}".format(value))
+        return bool(value)
+    if isinstance(default, list) or action.type is alsaloopconfig.parse_numbers:
+        # A list like the start hooks or the channel mask
+        if isinstance(value, str):
+            value = action.type(value) if action.type is not None else [value]
+        elif not isinstance(value, (list, tuple)):
+            raise ValueError("has to be a list, not {!r}".format(value))
+        item_type = int if action.type is alsaloopconfig.parse_numbers else str
+        if not all(isinstance(item, item_type) and not isinstance(item, bool) for item in value):
+            raise ValueError("invalid list {!r}".format(value))
+        return [item_type(item) for item in value]
+
+    if isinstance(value, str):
+        if action.type is not None:
+            value = action.type(value)
+    elif action.type in (int, float):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or (action.type is int and value != int(value)):
+            raise ValueError("has to be a number, not {!r}".format(value))
+        value = action.type(value)
+    else:
+        raise ValueError("has to be a string, not {!r}".format(value))
+    if action.choices is not None and value not in action.choices:
+        raise ValueError("has to be one of {}, not {!r}".format(", ".join(action.choices), value))
+    return value
+
+
+def convert_options(options):
+    """ The options converted to the types of the command line options, raises ValueError if one is invalid """
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise ValueError("unknown options {}".format(", ".join(sorted(unknown))))
+    actions = {action.dest: action for action in create_parser()._actions}
+    converted = {}
+    for (name, value) in options.items():
+        try:
+            converted[name] = convert_option(actions[name], value)
+        except (TypeError, ValueError) as e:
+            raise ValueError("{}: {}".format(name, e))
+    return converted
+
 
-            # Check if the threshold has been exceeded
-            if start_db_threshold == 0 or decibel(max_sample) > threshold:
-                input_detected = True
-                status = "P"
+def check_options(options, rate=SAMPLE_RATE):
+    """ Raises ValueError if a value is out of range or the options don't fit together """
+    for (name, (low, high)) in OPTION_RANGES.items():
+        value = options[name]
+        if high is None and value < low:
+            raise ValueError("{} has to be at least {}, not {}".format(name, low, value))
+        if high is not None and not low <= value <= high:
+            raise ValueError("{} has to be between {} and {}, not {}".format(name, low, high, value))
+    if not options["idle_measure"]:
+        raise ValueError("idle_measure has to be larger than 0")
+    if options["channel_mask"] is not None and \
+            (not options["channel_mask"] or not all(0 <= channel < options["channels"]
+                                                    for channel in options["channel_mask"])):
+        raise ValueError("channel mask {} doesn't fit {} channels".format(options["channel_mask"],
+                                                                          options["channels"]))
+    if options["crest_min"] > options["crest_max"]:
+        raise ValueError("crest_min has to be below crest_max")
+    if options["band_low"] >= options["band_high"]:
+        raise ValueError("band_low has to be below band_high")
+    if options["auto_threshold"] and options["start_margin"] <= options["stop_margin"]:
+        raise ValueError("the start margin has to be larger than the stop margin")
+    if options["realtime"] and options["busy_wait"]:
+        raise ValueError("busy waiting with real-time priority would keep other threads from running")
+    # The same checks as Pipeline.watermarks(), in milliseconds
+    period_time = PERIOD_SIZE * 1000 / rate
+    if not max(options["low_watermark"], period_time) <= options["latency"] < options["high_watermark"]:
+        raise ValueError("watermarks have to be below and above the target latency")
+    if options["buffer_time"] < options["high_watermark"] + period_time:
+        raise ValueError("buffer time has to exceed the high watermark by at least one period")
+
+
+def metrics_enabled(options):
+    return bool(options["metrics"] or options["metrics_file"])
+
+
+class Engine():
+    """ Loops the input to the output while an input signal is detected
+
+    The engine runs on its own thread after start(), or on the calling
+    thread with run(). Listeners are called on the engine thread with an
+    event name and a dict of values:
+
+    - "playback" when output starts or stops, with "playing" and "hold"
+    - "level" once per report interval, with "playing", "rms" and "peak" in dBFS
+      and "channels", a list of the (rms, peak) of every channel
+    - "meter" with the same values for the detection window, at most every
+      meter_interval seconds. Not sent while meter_interval is None.
+    - "heartbeat" every HEARTBEAT_INTERVAL while the engine thread is alive,
+      with "capturing", whether a period has been captured since the last one
+    - "hook" when a start or stop hook has finished, with "command", "duration"
+      in seconds and "returncode", which is None if it was killed. This one is
+      called on the hook thread.
+    """
+
+    def __init__(self, threshold=None, **options):
+        self.threshold = None
+        self.options = dict(DEFAULT_OPTIONS)
+        self.pipeline = None
+        self.configure(threshold, **options)
+        self.listeners = []
+        self.playing = False
+        self.running = False
+        # Set by reconfigure() to make the engine thread set up the pipeline again
+        self.restart = False
+        # Set by reconfigure() if only options that don't need a new pipeline have changed
+        self.changed = False
+        self.lock = threading.Lock()
+        # Set by stop_output() to make the engine thread stop the output
+        self.output_reset = False
+        # Output held off by control(): None follows the detector, "pause" until the input signal has been lost,
+        # "stop" until control("play")
+        self.hold = None
+        # Set by control("play"), the detector starts out active
+        self.play_requested = False
+        # Taken while the output is started or stopped, control() is called from other threads
+        self.playing_lock = threading.RLock()
+        # Seconds between two "meter" events, None if nobody is interested
+        self.meter_interval = None
+        # Set if run() failed while playing, output continues when it is called again
+        self.resume = False
+        self.thread = None
+        self.hooks = None
+        # Problems of the pipeline and the hooks, kept when the pipeline is set up again
+        self.counters = Counter()
+        self.metrics = None
+        # Noise floor for automatic thresholds, kept when the pipeline is set up again
+        self.noise_floor = None
+
+    def configure(self, threshold=None, **options):
+        """ Raises ValueError and keeps the current configuration if an option is unknown or invalid
+
+        Values can be strings like on the command line, see convert_options().
+        """
+        if isinstance(threshold, str):
+            threshold = parse_threshold(threshold)
+        new_options = dict(self.options)
+        new_options.update(convert_options(options))
+        pipeline = self.pipeline
+        check_options(new_options, SAMPLE_RATE if pipeline is None else pipeline.rate)
+        self.threshold = threshold
+        self.options = new_options
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, **values):
+        for listener in self.listeners:
+            try:
+                listener(event, values)
+            except Exception as e:
+                logging.error("alsaloop listener failed on %s: %s", event, e)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="engine", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.options["poll_timeout"] / 1000 * 2 + 1)
+            self.thread = None
+
+    def reconfigure(self, threshold=None, **options):
+        """ Apply a new configuration while the engine is running
+
+        The audio devices are only set up again if one of the PIPELINE_OPTIONS
+        has changed, everything else is applied by the engine thread before
+        the next period is analysed. Raises ValueError if an option is
+        invalid, the engine continues with the previous configuration.
+        """
+        with self.lock:
+            previous = dict(self.options)
+            self.configure(threshold, **options)
+            changed = {name for (name, value) in self.options.items() if previous[name] != value}
+            if changed & PIPELINE_OPTIONS or metrics_enabled(previous) != metrics_enabled(self.options):
+                logging.info("reconfiguring the audio pipeline, changed %s", ", ".join(sorted(changed)))
+                self.restart = True
             else:
-                input_detected = False
-                status = "-"
+                self.changed = True
 
-            print("{} {:.1f} {:.1f}".format(status, decibel(rms_volume), decibel(max_sample)), flush=True)
+    def stop_output(self):
+        """ Stop the output until the input signal is detected again """
+        self.output_reset = True
 
-            sample_sum = 0
-            samples = 0
-            max_sample = 0
+    def control(self, command):
+        """ Start or stop the output right away, called from any thread
 
-            if output_stopped and input_detected:
-                del input_device
-                logging.info("Input signal detected, pausing other players")
-                os.system("/opt/hifiberry/bin/pause-all alsaloop")
-                (input_device, output_device) = open_sound(output=True)
-                output_stopped = False
-                continue
+        "play" starts the output, it stops again once the input signal has
+        been lost for the release time. "pause" stops the output until the
+        input signal has been lost and is detected again, "stop" until the
+        next "play".
+        """
+        if command not in ("play", "pause", "stop"):
+            raise ValueError("unknown command {}".format(command))
+        with self.playing_lock:
+            if command == "play":
+                self.hold = None
+                self.play_requested = True
+            else:
+                self.hold = command
+            logging.info("%s requested", command)
+            if self.pipeline is not None:
+                self.change_playing(command == "play")
+
+    def run(self):
+        self.running = True
+        if self.options["realtime"]:
+            alsaloopsched.lock_memory()
+            alsaloopsched.log_in_background()
+        # Hooks run on their own thread, so audio is captured while other players are paused
+        self.hooks = alsaloophooks.HookRunner(self.options["hook_timeout"], self.hook_finished, self.counters)
+        self.hooks.start()
+        try:
+            while self.running:
+                self.restart = False
+                self.loop()
+        finally:
+            self.hooks.stop()
+
+    def hook_finished(self, command, duration, returncode):
+        if self.metrics is not None:
+            self.metrics.observe("hook", duration)
+        self.notify("hook", command=command, duration=duration, returncode=returncode)
+
+    def metrics_snapshot(self):
+        """ Flat name -> value mapping of the metrics, empty if they aren't enabled """
+        if self.metrics is None:
+            return {}
+        return self.metrics.snapshot(self.counters)
+
+    def create_meter(self, pipeline, options):
+        if options["weighting"] != "none":
+            # Levels are measured after the weighting, hum and noise outside the band don't count
+            return alsaloopdsp.WeightedMeter(pipeline.input_format, pipeline.channels, pipeline.rate,
+                                             options["weighting"], options["band_low"], options["band_high"])
+        return alsaloopdsp.create_meter(options["meter"], pipeline.input_format, pipeline.channels)
+
+    def create_detector(self, pipeline, threshold, options):
+        return alsaloopdetect.Detector(threshold, pipeline.input_format.full_scale, pipeline.rate,
+                                       pipeline.period_size, hysteresis=options["hysteresis"], window=options["window"],
+                                       attack=options["attack"], release=options["release"],
+                                       mode=options["detect_on"], crest_min=options["crest_min"],
+                                       crest_max=options["crest_max"], crest_rms=options["crest_rms"],
+                                       channels=pipeline.channels,
+                                       policy=options["channel_policy"], mask=options["channel_mask"],
+                                       noise_floor=self.load_noise_floor(options),
+                                       start_margin=options["start_margin"], stop_margin=options["stop_margin"])
 
-            elif not output_stopped and not input_detected:
-                count_playback_threshold_not_met += 1
-                logging.info(f"No input signal for {count_playback_threshold_not_met} intervals")
-                if count_playback_threshold_not_met > CHECK_NUMBER_BEFORE_TURN_OFF:
-                    del input_device
-                    output_device = None
-                    logging.info("Input signal lost, stopping playback")
-                    input_device = open_sound(output=False)
-                    output_stopped = True
+    def load_noise_floor(self, options):
+        """ The noise floor for automatic thresholds, read from the noise file the first time """
+        if not options["auto_threshold"]:
+            return None
+        if self.noise_floor is None:
+            self.noise_floor = alsaloopdetect.NoiseFloor()
+            if options["noise_file"]:
+                try:
+                    self.noise_floor.load(options["noise_file"])
+                    logging.info("noise floor %.1f dBFS from %s", self.noise_floor.level or float("-inf"),
+                                 options["noise_file"])
+                except FileNotFoundError:
+                    logging.info("no noise floor in %s yet, calibrating", options["noise_file"])
+                except (OSError, ValueError) as e:
+                    logging.warning("can't read the noise floor from %s: %s", options["noise_file"], e)
+        return self.noise_floor
+
+    def save_noise_floor(self, options):
+        if self.noise_floor is None or not options["auto_threshold"] or not options["noise_file"]:
+            return
+        try:
+            self.noise_floor.save(options["noise_file"])
+        except OSError as e:
+            logging.warning("can't save the noise floor to %s: %s", options["noise_file"], e)
+
+    def create_volume_follower(self, pipeline, options, metrics):
+        if options["volume_curve"] == "off":
+            return None
+        gain_stage = None
+        if options["software_volume"]:
+            if pipeline.gain is None:
+                logging.warning("software volume requires numpy, using the output mixer")
+            gain_stage = pipeline.gain
+        volume_follower = alsaloopmixer.VolumeFollower(options["volume_curve"], options["poll_timeout"], metrics,
+                                                       gain_stage)
+        if not volume_follower.start():
+            return None
+        return volume_follower
+
+    def create_tap(self, pipeline, options):
+        if not options["tap_file"]:
+            return None
+        try:
+            return alsalooptap.Tap(options["tap_file"], pipeline.input_format, pipeline.channels, pipeline.rate,
+                                   PERIOD_SIZE, options["tap_seconds"])
+        except OSError as e:
+            logging.warning("can't open the capture tap %s: %s", options["tap_file"], e)
+            return None
+
+    def loop(self):
+        with self.lock:
+            self.changed = False
+            options = dict(self.options)
+            threshold = self.threshold
+        if metrics_enabled(options):
+            if self.metrics is None:
+                self.metrics = alsaloopmetrics.Metrics()
+        else:
+            self.metrics = None
+        metrics = self.metrics
+        pipeline = Pipeline(persistent=options["persistent"], busy_wait=options["busy_wait"],
+                            poll_timeout=options["poll_timeout"], latency=options["latency"],
+                            low_watermark=options["low_watermark"], high_watermark=options["high_watermark"],
+                            buffer_time=options["buffer_time"], drift_compensation=options["drift_compensation"],
+                            preroll_time=options["preroll"], counters=self.counters, metrics=metrics,
+                            input_name=options["input_device"], output_name=options["output_device"],
+                            realtime=options["realtime"], rt_priority=options["rt_priority"], cpus=options["cpus"],
+                            channels=options["channels"], idle_period=options["idle_period"],
+                            fade_time=options["fade_time"], volume_ramp=options["volume_ramp"])
+        pipeline.start()
+        self.pipeline = pipeline
+        self.hooks.timeout = options["hook_timeout"]
+        full_scale = pipeline.input_format.full_scale
+        frames_before_check = int(pipeline.rate * SAMPLE_SECONDS_BEFORE_CHECK)
+        meter = self.create_meter(pipeline, options)
+        idle_meter = alsaloopdsp.SubsamplingMeter(meter, options["idle_measure"])
+        detector = self.create_detector(pipeline, threshold, options)
+        volume_follower = self.create_volume_follower(pipeline, options, metrics)
+        tap = self.create_tap(pipeline, options)
+
+        frames = 0
+        # Frames captured since the last report, only part of them is measured while idle
+        report_frames = 0
+        sample_sums = [0] * pipeline.channels
+        max_samples = [0] * pipeline.channels
+        # Time since when neither output nor an input signal has been seen, the idle mode starts after idle_delay
+        quiet_since = time.monotonic()
+        warmed_up = False
+        meter_time = 0
+        noise_saved = time.monotonic()
+        reported_threshold = detector.start_threshold
+        heartbeat_time = 0
+        capturing = False
+        if self.resume:
+            # Restarted after a failure, the output continues without running the hooks again
+            self.resume = False
+            detector.reset(active=True)
+            self.set_playing(True, notify=False)
+
+        try:
+            while self.running and not self.restart:
+                # Wait for the next captured period, the capture thread keeps reading in the meantime
+                period = pipeline.read_period(options["poll_timeout"] / 1000)
+                capturing = capturing or period is not None
+                if time.monotonic() - heartbeat_time >= HEARTBEAT_INTERVAL:
+                    heartbeat_time = time.monotonic()
+                    self.notify("heartbeat", capturing=capturing)
+                    capturing = False
+                if pipeline.failure is not None:
+                    # A device has failed, the caller sets up the pipeline again
+                    raise pipeline.failure
+                if period is None:
                     continue
+                (data_length, data) = period
+
+                if self.changed:
+                    # Apply the new configuration without touching the audio devices
+                    with self.lock:
+                        self.changed = False
+                        previous = options
+                        options = dict(self.options)
+                        changed = {name for (name, value) in options.items() if previous[name] != value}
+                        if threshold != self.threshold:
+                            changed.add("threshold")
+                        threshold = self.threshold
+                    if changed & METER_OPTIONS:
+                        meter = self.create_meter(pipeline, options)
+                        idle_meter = alsaloopdsp.SubsamplingMeter(meter, options["idle_measure"])
+                    if changed & DETECTOR_OPTIONS or "threshold" in changed:
+                        # The detector keeps its state, output doesn't stop because the threshold has changed
+                        active = detector.active
+                        detector = self.create_detector(pipeline, threshold, options)
+                        detector.reset(active)
+                    if {"volume_curve", "software_volume"} & changed:
+                        if volume_follower is not None:
+                            volume_follower.stop()
+                        volume_follower = self.create_volume_follower(pipeline, options, metrics)
+                    if changed & TAP_OPTIONS:
+                        if tap is not None:
+                            tap.close()
+                        tap = self.create_tap(pipeline, options)
+                    if changed & BUFFERING_OPTIONS:
+                        try:
+                            pipeline.set_buffering(options["latency"], options["low_watermark"],
+                                                   options["high_watermark"])
+                        except ValueError as e:
+                            logging.warning("keeping the previous buffering: %s", e)
+                    if changed & GAIN_OPTIONS:
+                        pipeline.set_fades(options["fade_time"], options["volume_ramp"])
+                    # The capture thread changes the period size before the next read
+                    pipeline.idle_period = options["idle_period"]
+                    self.hooks.timeout = options["hook_timeout"]
+                    if changed:
+                        logging.info("applied %s", ", ".join(sorted(changed)))
+
+                if self.output_reset:
+                    self.output_reset = False
+                    detector.reset()
+                    self.set_playing(False)
+
+                if metrics is not None:
+                    analysis_start = time.perf_counter()
+
+                # Measure every channel of the currently captured audio data in one go
+                if pipeline.idle:
+                    (count, square_sums, peaks) = idle_meter.measure_channels(data)
+                else:
+                    (count, square_sums, peaks) = meter.measure_channels(data)
+                frames += count
+                report_frames += data_length
+                # The sums of all samples squared, used to determine rms later.
+                sample_sums = list(map(add, sample_sums, square_sums))
+                # The max values of all samples
+                max_samples = list(map(max, max_samples, peaks))
+
+                # The detector is updated with every period, output follows it immediately
+                detector.set_period_size(pipeline.period_size)
+                changed = detector.update(count, square_sums, peaks, data_length)
+                if tap is not None:
+                    # What the detector saw, for alsaloopreplay.py
+                    tap.write(data, data_length, detector.rms, detector.peak,
+                              detector.threshold if detector.start_threshold is not None else None, detector.active)
+                if metrics is not None:
+                    metrics.observe("analysis", time.perf_counter() - analysis_start)
+
+                with self.playing_lock:
+                    if self.play_requested:
+                        self.play_requested = False
+                        detector.reset(active=True)
+                    if changed and not detector.active and self.hold == "pause":
+                        # The input signal is gone, the next one starts the output again
+                        self.hold = None
+                    elif changed and self.hold is None:
+                        if detector.active:
+                            logging.info("Input signal detected, pausing other players")
+                        else:
+                            logging.info("Input signal lost, stopping playback")
+                        self.change_playing(detector.active)
+                    else:
+                        # Without level detection, output starts right away
+                        self.set_playing(detector.active and self.hold is None)
+
+                if options["idle_period"]:
+                    if self.playing or detector.candidate():
+                        quiet_since = time.monotonic()
+                        if pipeline.idle:
+                            logging.info("input level rising, leaving the idle mode")
+                            pipeline.idle = False
+                    elif not pipeline.idle and time.monotonic() - quiet_since >= options["idle_delay"]:
+                        logging.info("no input signal for %.1f s, entering the idle mode", time.monotonic() - quiet_since)
+                        pipeline.idle = True
+
+                if self.meter_interval is not None and time.monotonic() - meter_time >= self.meter_interval:
+                    meter_time = time.monotonic()
+                    levels = [(detector.channel_rms(channel), detector.channel_peak(channel))
+                              for channel in range(pipeline.channels)]
+                    self.notify("meter", playing=self.playing, rms=detector.rms, peak=detector.peak, channels=levels)
+
+                if volume_follower is not None:
+                    # The output volume follows the host while music is playing
+                    if self.playing:
+                        volume_follower.enable()
+                    else:
+                        volume_follower.disable()
+
+                if report_frames >= frames_before_check:
+                    # Calculate RMS
+                    rms_volume = sqrt(sum(sample_sums) / (frames * pipeline.channels))
+                    levels = [(decibel(sqrt(sample_sum / frames), full_scale), decibel(max_sample, full_scale))
+                              for (sample_sum, max_sample) in zip(sample_sums, max_samples)]
+                    self.notify("level", playing=self.playing, rms=decibel(rms_volume, full_scale),
+                                peak=decibel(max(max_samples), full_scale), channels=levels)
+                    pipeline.report_counters()
+                    if metrics is not None:
+                        self.update_metrics(pipeline, levels, detector)
+
+                    if detector.noise_floor is not None:
+                        if reported_threshold is None or abs(detector.start_threshold - reported_threshold) >= 1:
+                            logging.info("noise floor %.1f dBFS, start threshold %.1f dB, stop threshold %.1f dB",
+                                         detector.noise_floor.level, detector.start_threshold,
+                                         detector.stop_threshold)
+                            reported_threshold = detector.start_threshold
+                        if time.monotonic() - noise_saved >= NOISE_SAVE_INTERVAL:
+                            noise_saved = time.monotonic()
+                            self.save_noise_floor(options)
+
+                    # Short pauses in the music aren't worth a message, pending_frames counts the audio captured
+                    # since the level has dropped below the stop threshold
+                    silence = detector.pending_frames / pipeline.rate
+                    if self.playing and silence >= SAMPLE_SECONDS_BEFORE_CHECK:
+                        logging.info("No input signal for %.1f s", silence)
+
+                    if options["realtime"] and not warmed_up:
+                        # Everything the pipeline needs has been allocated by now
+                        alsaloopsched.freeze_gc()
+                        warmed_up = True
+
+                    frames = 0
+                    report_frames = 0
+                    sample_sums = [0] * pipeline.channels
+                    max_samples = [0] * pipeline.channels
+        except Exception:
+            # The caller starts the engine again, listeners don't see the output stop in the meantime
+            self.resume = self.playing
+            raise
+        finally:
+            if volume_follower is not None:
+                volume_follower.stop()
+            if tap is not None:
+                tap.close()
+            self.save_noise_floor(options)
+            self.set_playing(False, notify=not self.resume)
+            pipeline.stop()
+            self.pipeline = None
+
+    def update_metrics(self, pipeline, levels, detector):
+        """ Called once per report interval with the RMS and the peak of every channel """
+        self.metrics.gauges["buffer_fill_seconds"] = pipeline.ring.fill_frames / pipeline.rate
+        self.metrics.gauges["idle"] = int(pipeline.idle)
+        for (channel, (rms, peak)) in enumerate(levels):
+            self.metrics.gauges["channel{}_rms_dbfs".format(channel)] = rms
+            self.metrics.gauges["channel{}_peak_dbfs".format(channel)] = peak
+        if detector.start_threshold is not None:
+            self.metrics.gauges["start_threshold_db"] = detector.start_threshold
+        if detector.noise_floor is not None and detector.noise_floor.level is not None:
+            self.metrics.gauges["noise_floor_dbfs"] = detector.noise_floor.level
+        if pipeline.drift_controller is not None:
+            self.metrics.gauges["drift_ppm"] = pipeline.drift_controller.drift * 1e6
+        if self.options["metrics_file"]:
+            try:
+                self.metrics.write_textfile(self.options["metrics_file"], self.counters)
+            except OSError as e:
+                logging.warning("can't write metrics to %s: %s", self.options["metrics_file"], e)
+
+    def change_playing(self, playing):
+        """ Start or stop the output and run the hooks """
+        if playing == self.playing:
+            return
+        if playing:
+            self.hooks.run("start", self.options["start_hooks"])
+        else:
+            self.hooks.run("stop", self.options["stop_hooks"])
+        self.set_playing(playing)
 
-            if input_detected:
-                # Reset counter when input detected
-                count_playback_threshold_not_met = 0
-                (input_mixer, output_mixer) = open_mixer(output=True)
-                volume = input_mixer.getvolume(alsaaudio.PCM_CAPTURE)[0]
-                output_mixer.setvolume(volume)
+    def set_playing(self, playing, notify=True):
+        with self.playing_lock:
+            if playing == self.playing:
+                return
+            self.playing = playing
+            if playing:
+                self.pipeline.start_output()
+            else:
+                self.pipeline.stop_output()
+            if notify:
+                self.notify("playback", playing=playing, hold=self.hold)
+
+
+def stop_playback(_signalNumber, _frame):
+    """ SIGUSR1 pauses the output like control("pause"), alsaloopmpris sends it with --external """
+    logging.info("received USR1, pausing music playback")
+    if engine is not None:
+        # The engine thread might hold the playing lock, don't take it in the signal handler
+        threading.Thread(target=engine.control, args=("pause",), name="usr1", daemon=True).start()
+
+
+def send_heartbeat(fd):
+    """ Tells alsaloopmpris that the engine is alive and capturing, see --heartbeat-fd """
+    try:
+        os.write(fd, b".")
+    except OSError:
+        # Nobody is reading, or the pipe is full
+        pass
+
+
+def print_level(event, values):
+    """ Prints the status and the input level once per second, alsaloopmpris reads this in external mode
+
+    The level of all channels is followed by the rms/peak of every channel.
+    """
+    if event == "level":
+        if values["playing"]:
+            status = "P"
+        else:
+            status = "-"
+        channels = " ".join("{:.1f}/{:.1f}".format(rms, peak) for (rms, peak) in values["channels"])
+        print("{} {:.1f} {:.1f} {}".format(status, values["rms"], values["peak"], channels), flush=True)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Loop audio input to the output while an input signal is detected")
+    parser.add_argument("threshold", nargs="?",
+                        help="input level in dB that starts playback, no level detection if omitted, auto for "
+                             "--auto-threshold")
+    parser.add_argument("--input-device", default=INPUT_DEVICE,
+                        help="alsa device the audio is captured from")
+    parser.add_argument("--output-device", default=OUTPUT_DEVICE,
+                        help="alsa device the audio is played on")
+    parser.add_argument("--channels", type=int, default=CHANNELS,
+                        help="number of channels of both devices")
+    parser.add_argument("--meter", default="auto", choices=["auto"] + sorted(alsaloopdsp.METERS),
+                        help="implementation used to measure the input level")
+    parser.add_argument("--poll-timeout", type=int, default=POLL_TIMEOUT,
+                        help="milliseconds to wait for the audio devices before trying again")
+    parser.add_argument("--busy-wait", action="store_true",
+                        help="don't wait on the devices' poll descriptors, read continuously instead")
+    parser.add_argument("--persistent", action="store_true",
+                        help="keep the output device open and pause it instead of closing it")
+    parser.add_argument("--latency", type=float, default=TARGET_LATENCY,
+                        help="milliseconds of audio buffered before playback starts")
+    parser.add_argument("--low-watermark", type=float, default=LOW_WATERMARK,
+                        help="buffer fill in milliseconds below which playback waits for the target latency again")
+    parser.add_argument("--high-watermark", type=float, default=HIGH_WATERMARK,
+                        help="buffer fill in milliseconds above which old audio is dropped")
+    parser.add_argument("--buffer-time", type=float, default=BUFFER_TIME,
+                        help="size of the buffer between capture and playback in milliseconds")
+    parser.add_argument("--preroll", type=float, default=PREROLL_TIME,
+                        help="milliseconds of audio from before the detection that are played when output starts")
+    parser.add_argument("--idle-period", type=int, default=IDLE_PERIOD_SIZE,
+                        help="frames per period of the capture device while no input signal is expected, e.g. 8192, "
+                             "0 always uses the normal period size")
+    parser.add_argument("--idle-delay", type=float, default=IDLE_DELAY,
+                        help="seconds without output or input signal before the idle period size is used")
+    parser.add_argument("--idle-measure", type=float, default=IDLE_MEASURE,
+                        help="part of every period that is measured in the idle mode")
+    parser.add_argument("--drift-compensation", action="store_true",
+                        help="resample the input to follow the clock of the output device")
+    parser.add_argument("--window", type=float, default=alsaloopdetect.DETECTION_WINDOW,
+                        help="length of the sliding window over which the input level is measured in milliseconds")
+    parser.add_argument("--attack", type=float, default=alsaloopdetect.ATTACK_TIME,
+                        help="milliseconds the input has to exceed the threshold before output starts")
+    parser.add_argument("--release", type=float, default=SAMPLE_SECONDS_BEFORE_TURN_OFF * 1000,
+                        help="milliseconds the input has to stay below the threshold before output stops")
+    parser.add_argument("--volume-curve", default="linear", choices=alsaloopmixer.VOLUME_CURVES + ["off"],
+                        help="how the volume set by the USB host is applied to the output, off doesn't change it")
+    parser.add_argument("--software-volume", action="store_true",
+                        help="apply the volume set by the USB host to the samples instead of the output mixer, "
+                             "requires numpy")
+    parser.add_argument("--fade-time", type=float, default=alsaloopdsp.FADE_TIME,
+                        help="milliseconds over which output fades in and out when it starts and stops, 0 switches "
+                             "it hard")
+    parser.add_argument("--volume-ramp", type=float, default=alsaloopdsp.VOLUME_RAMP_TIME,
+                        help="milliseconds over which a software volume change is applied")
+    parser.add_argument("--start-hook", dest="start_hooks", action="append",
+                        help="shell command run when an input signal has been detected, can be given more than "
+                             "once, default: " + alsaloophooks.PAUSE_ALL_COMMAND)
+    parser.add_argument("--stop-hook", dest="stop_hooks", action="append",
+                        help="shell command run when the input signal has been lost, can be given more than once")
+    parser.add_argument("--hook-timeout", type=float, default=alsaloophooks.HOOK_TIMEOUT,
+                        help="seconds after which a hook is killed")
+    parser.add_argument("--metrics", action="store_true",
+                        help="time the stages of the audio path")
+    parser.add_argument("--metrics-file",
+                        help="write the metrics in the Prometheus text format to this file once per second, "
+                             "enables --metrics")
+    parser.add_argument("--weighting", default="none", choices=["none"] + alsaloopdsp.WEIGHTINGS,
+                        help="frequency weighting applied before the level is measured, requires numpy")
+    parser.add_argument("--band-low", type=float, default=alsaloopdsp.BAND_LOW,
+                        help="lower corner frequency of the band weighting in Hz")
+    parser.add_argument("--band-high", type=float, default=alsaloopdsp.BAND_HIGH,
+                        help="upper corner frequency of the band weighting in Hz")
+    parser.add_argument("--detect-on", default="peak", choices=alsaloopdetect.DETECTION_MODES,
+                        help="level compared against the threshold, crest uses the peak if the crest factor is in "
+                             "the range of music or the RMS is above --crest-rms, so quieter steady tones don't count")
+    parser.add_argument("--crest-min", type=float, default=alsaloopdetect.CREST_MIN,
+                        help="lowest crest factor in dB that counts as music")
+    parser.add_argument("--crest-max", type=float, default=alsaloopdetect.CREST_MAX,
+                        help="highest crest factor in dB that counts as music")
+    parser.add_argument("--crest-rms", type=float, default=alsaloopdetect.CREST_RMS,
+                        help="RMS in dBFS above which a signal counts in the crest mode whatever its crest factor")
+    parser.add_argument("--hysteresis", type=float, default=alsaloopdetect.HYSTERESIS,
+                        help="dB between the start and the stop threshold")
+    parser.add_argument("--auto-threshold", action="store_true",
+                        help="derive the thresholds from the noise floor of the input, the threshold is used until "
+                             "it has been measured")
+    parser.add_argument("--start-margin", type=float, default=alsaloopdetect.START_MARGIN,
+                        help="dB above the noise floor that start playback with --auto-threshold")
+    parser.add_argument("--stop-margin", type=float, default=alsaloopdetect.STOP_MARGIN,
+                        help="dB above the noise floor below which playback stops with --auto-threshold")
+    parser.add_argument("--noise-file", default=alsaloopdetect.NOISE_FILE,
+                        help="file the noise floor is kept in between restarts with --auto-threshold")
+    parser.add_argument("--channel-policy", default="any", choices=alsaloopdetect.CHANNEL_POLICIES,
+                        help="whether any or all of the channels in the mask need a signal to start playback")
+    parser.add_argument("--channel-mask", type=alsaloopconfig.parse_numbers,
+                        help="channels that are checked for a signal counting from 0, e.g. 0,1 or 2-5, default: all")
+    parser.add_argument("--tap-file",
+                        help="keep the last captured audio and the detected levels in this file, see alsaloopreplay.py")
+    parser.add_argument("--tap-seconds", type=float, default=alsalooptap.TAP_SECONDS,
+                        help="seconds of audio kept in the tap file")
+    parser.add_argument("--heartbeat-fd", type=int,
+                        help="write a byte to this file descriptor every second while the engine is alive")
+    parser.add_argument("--realtime", action="store_true",
+                        help="run capture and playback with real-time priority and lock the memory, requires the "
+                             "CAP_SYS_NICE and CAP_IPC_LOCK capabilities")
+    parser.add_argument("--rt-priority", type=int, default=alsaloopsched.RT_PRIORITY,
+                        help="SCHED_FIFO priority of the capture and playback threads with --realtime")
+    parser.add_argument("--cpus", type=alsaloopconfig.parse_numbers,
+                        help="CPUs the capture and playback threads run on with --realtime, e.g. 2,3 or 2-3")
+    return parser
 
 
-        if not output_stopped:
-            output_device.write(data)
+def parse_arguments():
+    return create_parser().parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+
+    if args.threshold == "auto":
+        args.auto_threshold = True
+        args.threshold = None
+    try:
+        start_db_threshold = parse_threshold(args.threshold)
+    except ValueError:
+        start_db_threshold = None
+    if args.auto_threshold:
+        print("using alsaloop with input level detection {:.1f} dB above the noise floor to start, {:.1f} to stop"
+              .format(args.start_margin, args.stop_margin))
+    elif start_db_threshold is not None:
+        print("using alsaloop with input level detection {:.1f} to start, {:.1f} to stop"
+              .format(start_db_threshold, start_db_threshold - args.hysteresis))
+    else:
+        print("using alsaloop without input level detection")
+
+    options = vars(args)
+    del options["threshold"]
+    heartbeat_fd = options.pop("heartbeat_fd")
+    # Hooks that haven't been given keep their defaults
+    options = {name: value for (name, value) in options.items() if value is not None}
+    try:
+        engine = Engine(start_db_threshold, **options)
+    except ValueError as e:
+        sys.exit("alsaloop: {}".format(e))
+    engine.add_listener(print_level)
+    signal.signal(signal.SIGUSR1, stop_playback)
+    if heartbeat_fd is not None:
+        os.set_blocking(heartbeat_fd, False)
+        # Only sent while audio is captured, alsaloopmpris kills alsaloop when the capture device hangs
+        engine.add_listener(lambda event, values: event == "heartbeat" and values["capturing"]
+                            and send_heartbeat(heartbeat_fd))
+    engine.run()
@@ -0,0 +1,667 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+# Micro-benchmarks for alsaloop. They don't need any audio hardware and can be
+# run on the target system to compare implementations:
+#
+#   python alsaloopbench.py meter
+#
+# The gain benchmark times the fades and the software volume per period.
+# The drift benchmark simulates a day of capture and playback on skewed clocks
+# in about a minute. The transition and startup benchmarks use the real audio devices configured in alsaloop.
+# The dbus benchmark starts a private dbus-daemon and needs dbus-python and GLib.
+#
+# The detection and engine benchmarks run on test signals from alsaloopfake.
+# The detection benchmark feeds them straight into the meter and the
+# detector, the engine benchmark runs the whole engine on the fake alsaaudio
+# backend faster than real time. The stress benchmark runs the engine in real
+# time while other processes keep all CPUs busy, once normally and once in
+# real-time mode, and counts the xruns of the fake devices. The idle
+# benchmark measures the CPU time and the context switches per second of the
+# engine in real time while it waits for an input signal, with and without
+# the idle mode, and how long it takes to start the output once a signal
+# appears. With --json, their results are printed as JSON to track them
+# over time.
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from struct import pack
+
+import alsaloopdsp
+import alsaloopbuffer
+import alsaloopdetect
+import alsaloopfake
+import alsaloopmetrics
+
+CHANNELS = 2
+SAMPLE_RATE = 48000
+PERIOD_SIZE = 2048
+
+
+def noise_period(frames, channels, level=0.1, seed=0):
+    """ Create one period of S32_LE white noise """
+    rnd = random.Random(seed)
+    maxval = int(level * (2 ** 31 - 1))
+    values = [rnd.randint(-maxval, maxval) for _i in range(frames * channels)]
+    return pack("<{}i".format(len(values)), *values)
+
+
+def bench_meter(seconds, channels=CHANNELS):
+    """ Per channel metering as done by the engine """
+    periods = int(SAMPLE_RATE * seconds / PERIOD_SIZE)
+    data = noise_period(PERIOD_SIZE, channels)
+    audio_seconds = periods * PERIOD_SIZE / SAMPLE_RATE
+
+    print("{:8s} {:>14s} {:>20s}".format("meter", "cpu s/audio s", "result"))
+    for name in sorted(alsaloopdsp.METERS):
+        try:
+            meter = alsaloopdsp.create_meter(name, channels=channels)
+        except ValueError as e:
+            print("{:8s} {}".format(name, e))
+            continue
+
+        start = time.process_time()
+        for _i in range(periods):
+            (frames, square_sums, peaks) = meter.measure_channels(data)
+        used = time.process_time() - start
+
+        print("{:8s} {:14.5f} {:>20s}".format(name, used / audio_seconds,
+                                              "{} {:.4g} {}".format(frames, sum(square_sums), max(peaks))))
+
+
+def bench_gain(seconds, channels=CHANNELS):
+    """ Time of the gain stage per period, at unity gain, at a constant volume and while fading """
+    if alsaloopdsp.numpy is None:
+        print("the gain stage requires numpy")
+        return
+    periods = int(SAMPLE_RATE * seconds / PERIOD_SIZE)
+    data = noise_period(PERIOD_SIZE, channels)
+    period_time = PERIOD_SIZE / SAMPLE_RATE
+
+    print("{:8s} {:>12s} {:>12s} {:>14s}".format("gain", "median us", "max us", "% of period"))
+    for case in ("unity", "volume", "fade"):
+        stage = alsaloopdsp.GainStage(alsaloopdsp.FORMATS["S32_LE"], channels, SAMPLE_RATE)
+        if case == "volume":
+            stage.set_volume(0.5)
+            while stage.volume.moving:
+                stage.process(data)
+        times = []
+        for _i in range(periods):
+            if case == "fade":
+                stage.fade_in()
+            start = time.perf_counter()
+            stage.process(data)
+            times.append(time.perf_counter() - start)
+        print("{:8s} {:12.1f} {:12.1f} {:14.3f}".format(case, statistics.median(times) * 1e6, max(times) * 1e6,
+                                                       statistics.median(times) / period_time * 100))
+
+    # Back at unity gain, 32 bit samples come out unchanged
+    stage.set_volume(0.5)
+    stage.set_volume(1.0)
+    while stage.fade.moving or stage.volume.moving:
+        stage.process(data)
+    print("bit exact at unity gain: {}".format(bytes(stage.process(data)) == data))
+
+
+def report_times(name, times):
+    print("{:12s} min {:7.1f} ms  median {:7.1f} ms  max {:7.1f} ms".format(
+        name, min(times) * 1000, statistics.median(times) * 1000, max(times) * 1000))
+
+
+def bench_transition(cycles):
+    """ Time it takes from a detected signal until the output plays, with and without persistent devices """
+    import alsaloop
+
+    (_input_format, output_format, _rate) = alsaloop.negotiate()
+    frame_size = alsaloop.CHANNELS * output_format.width
+    silence = bytes(alsaloop.PERIOD_SIZE * frame_size)
+
+    times = []
+    for _i in range(cycles):
+        input_device = alsaloop.open_sound(output=False)
+        input_device.read()
+        start = time.monotonic()
+        del input_device
+        (input_device, output_device) = alsaloop.open_sound(output=True)
+        alsaloop.write_data(output_device, alsaloop.create_poller(output_device), silence, frame_size=frame_size)
+        times.append(time.monotonic() - start)
+        del input_device, output_device
+    report_times("reopen", times)
+
+    (input_device, output_device) = alsaloop.open_sound(output=True)
+    output_gate = alsaloop.OutputGate(output_device, alsaloop.create_poller(output_device), frame_size=frame_size)
+    output_gate.write(silence)
+    times = []
+    for _i in range(cycles):
+        output_gate.close()
+        output_gate.idle(alsaloop.PERIOD_SIZE)
+        start = time.monotonic()
+        output_gate.open()
+        output_gate.write(silence)
+        times.append(time.monotonic() - start)
+    report_times("persistent", times)
+
+
+def process_rss(pid):
+    """ Resident set size of a process and all of its children in kB """
+    rss = 0
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    with open("/proc/{}/task/{}/children".format(pid, pid)) as children:
+        for child in children.read().split():
+            rss += process_rss(int(child))
+    return rss
+
+
+def bench_startup(threshold):
+    """ Time until the first level report and memory used, with alsaloop as a child process and in process """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alsaloop.py")
+    start = time.monotonic()
+    # Started the same way as alsaloopmpris --external does
+    child = subprocess.Popen("{} {} {}".format(sys.executable, script, threshold), stdout=subprocess.PIPE,
+                             shell=True, universal_newlines=True, start_new_session=True)
+    while child.stdout.readline()[:2] not in ("P ", "- "):
+        pass
+    elapsed = time.monotonic() - start
+    rss = process_rss(child.pid)
+    os.killpg(child.pid, signal.SIGKILL)
+    child.wait()
+    print("{:12s} first report {:7.1f} ms  RSS {:7d} kB".format("external", elapsed * 1000, rss))
+
+    rss_before = process_rss(os.getpid())
+    reported = threading.Event()
+    start = time.monotonic()
+    import alsaloop
+    engine = alsaloop.Engine(alsaloop.parse_threshold(threshold))
+    engine.add_listener(lambda event, _values: event == "level" and reported.set())
+    engine.start()
+    reported.wait()
+    elapsed = time.monotonic() - start
+    rss = process_rss(os.getpid()) - rss_before
+    engine.stop()
+    print("{:12s} first report {:7.1f} ms  RSS {:7d} kB".format("in process", elapsed * 1000, rss))
+
+
+def bench_dbus(seconds, rate):
+    """ Count the PropertiesChanged signals of alsaloopmpris for level reports at rate per second """
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        os.environ["DBUS_SESSION_BUS_ADDRESS"] = daemon.stdout.readline().strip()
+
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop
+        from gi.repository import GLib
+        import alsaloopmpris
+
+        DBusGMainLoop(set_as_default=True)
+        wrapper = alsaloopmpris.ALSALoopWrapper()
+        alsaloopmpris.alsaloop_wrapper = wrapper
+        wrapper.dbus_service = alsaloopmpris.MPRISInterface(bus=dbus.SessionBus())
+
+        received = []
+        listener = dbus.bus.BusConnection(os.environ["DBUS_SESSION_BUS_ADDRESS"])
+        listener.add_signal_receiver(lambda *args: received.append(args), signal_name="PropertiesChanged",
+                                     path=alsaloopmpris.MPRISInterface.PATH)
+
+        reports = int(seconds * rate)
+
+        def report():
+            # Playback starts and stops every 10 seconds of reports, like music with pauses
+            for number in range(reports):
+                playing = (number // (10 * rate)) % 2 == 0
+                wrapper.engine_event("level", {"playing": playing, "rms": -30.0, "peak": -20.0})
+                time.sleep(1 / rate)
+
+        loop = GLib.MainLoop()
+        thread = threading.Thread(target=report, daemon=True)
+        thread.start()
+        GLib.timeout_add(int(seconds * 1000) + 1500, loop.quit)
+        loop.run()
+
+        # Every report used to send PlaybackStatus and Metadata in separate signals
+        print("{} level reports, {} signals before, {} sent, {} received".format(
+            reports, reports * 2, wrapper.dbus_service.signal_count, len(received)))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def bench_metrics(seconds):
+    """ CPU time the instrumentation of the audio path takes per second of audio """
+    metrics = alsaloopmetrics.Metrics()
+    periods = int(SAMPLE_RATE * seconds / PERIOD_SIZE)
+    period_time = PERIOD_SIZE / SAMPLE_RATE
+
+    start = time.process_time()
+    for _i in range(periods):
+        # What the capture, playback and analysis threads do for every period
+        for stage in ("read", "write", "analysis"):
+            stage_start = time.perf_counter()
+            metrics.observe(stage, time.perf_counter() - stage_start)
+        metrics.iteration("capture", time.perf_counter(), period_time)
+        metrics.iteration("playback", time.perf_counter(), period_time)
+    used = time.process_time() - start
+    # Reports once per second
+    for _i in range(int(seconds)):
+        metrics.prometheus()
+    used_reports = time.process_time() - start - used
+
+    print("periods {:.5f} % of a core, reports {:.5f} % of a core".format(
+        used / seconds * 100, used_reports / seconds * 100))
+
+
+# Test signals as (generator, seconds, music is playing), levels are in dBFS
+SCENARIOS = {
+    "start-stop": [
+        (alsaloopfake.silence, 5, False),
+        (alsaloopfake.music, 30, True),
+        (alsaloopfake.silence, 25, False),
+    ],
+    "noise-floor": [
+        (lambda seconds: alsaloopfake.noise(seconds, level=-60), 120, False),
+    ],
+    # The pause is shorter than the release time, output should keep playing
+    "quiet-passage": [
+        (alsaloopfake.music, 20, True),
+        (alsaloopfake.silence, 5, True),
+        (lambda seconds: alsaloopfake.music(seconds, seed=1), 20, True),
+        (alsaloopfake.silence, 25, False),
+    ],
+    "tone": [
+        (alsaloopfake.silence, 2, False),
+        (alsaloopfake.tone, 20, True),
+        (alsaloopfake.silence, 20, False),
+    ],
+    # Mains hum and clicks on an otherwise silent input shouldn't start playback
+    "hum": [
+        (lambda seconds: alsaloopfake.tone(seconds, frequency=50, level=-35), 60, False),
+    ],
+    "clicks": [
+        (alsaloopfake.clicks, 60, False),
+    ],
+    "skewed": [
+        (alsaloopfake.silence, 5, False),
+        (lambda seconds: alsaloopfake.music(seconds, skew=500e-6), 30, True),
+        (alsaloopfake.silence, 25, False),
+    ],
+}
+
+
+def scenario_periods(name):
+    """ The periods of a scenario and whether music is playing in each of them """
+    result = []
+    for (generator, seconds, playing) in SCENARIOS[name]:
+        result.extend((data, playing) for data in generator(seconds))
+    return result
+
+
+def detection_events(transitions, truth_changes, seconds):
+    """ Evaluate the (time, active) transitions of a detector against the (time, playing) changes of the signal """
+    latencies = []
+    releases = []
+    false_starts = 0
+    false_stops = 0
+    for (index, (start, playing)) in enumerate(truth_changes):
+        end = truth_changes[index + 1][0] if index + 1 < len(truth_changes) else seconds
+        for (time_, active) in transitions:
+            if not start <= time_ < end:
+                continue
+            if active and not playing:
+                false_starts += 1
+            elif not active and playing:
+                false_stops += 1
+        # The first transition after the signal changed is the expected one
+        expected = [time_ for (time_, active) in transitions if active == playing and start <= time_ < end]
+        if expected and playing:
+            latencies.append(expected[0] - start)
+        elif expected and index > 0:
+            releases.append(expected[0] - start)
+    hours = seconds / 3600
+    return {
+        "latency_ms": [round(latency * 1000, 1) for latency in latencies],
+        "release_ms": [round(release * 1000, 1) for release in releases],
+        "false_starts": false_starts,
+        "false_stops": false_stops,
+        "false_starts_per_hour": false_starts / hours,
+        "false_stops_per_hour": false_stops / hours,
+    }
+
+
+def truth_changes(periods):
+    changes = []
+    frames = 0
+    for (data, playing) in periods:
+        if not changes or changes[-1][1] != playing:
+            changes.append((frames / SAMPLE_RATE, playing))
+        frames += len(data) // (CHANNELS * 4)
+    return changes
+
+
+def create_detection_meter(meter_name, weighting):
+    if weighting != "none":
+        return alsaloopdsp.WeightedMeter(alsaloopdsp.DEFAULT_FORMAT, CHANNELS, SAMPLE_RATE, weighting)
+    return alsaloopdsp.create_meter(meter_name, channels=CHANNELS)
+
+
+def bench_detection(threshold, meter_name="auto", weighting="none", mode="peak"):
+    """ Run the meter and the detector over every scenario """
+    results = {}
+    for name in SCENARIOS:
+        periods = scenario_periods(name)
+        meter = create_detection_meter(meter_name, weighting)
+        detector = alsaloopdetect.Detector(threshold, alsaloopdsp.DEFAULT_FORMAT.full_scale, SAMPLE_RATE,
+                                           PERIOD_SIZE, mode=mode)
+        frames = 0
+        transitions = []
+        start = time.process_time()
+        for (data, _playing) in periods:
+            count = len(data) // (CHANNELS * 4)
+            (samples, square_sums, peaks) = meter.measure_channels(data)
+            frames += count
+            # The detector decides at the end of a period
+            if detector.update(samples, square_sums, peaks, count):
+                transitions.append((frames / SAMPLE_RATE, detector.active))
+        used = time.process_time() - start
+        seconds = frames / SAMPLE_RATE
+
+        # A second pass to count the memory allocated while a period is processed
+        meter = create_detection_meter(meter_name, weighting)
+        detector.reset()
+        allocated = 0
+        tracemalloc.start()
+        for (data, _playing) in periods:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            (samples, square_sums, peaks) = meter.measure_channels(data)
+            detector.update(samples, square_sums, peaks, len(data) // (CHANNELS * 4))
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+
+        result = {
+            "audio_seconds": seconds,
+            "cpu_per_audio_second": used / seconds,
+            "bytes_per_period": allocated / len(periods),
+            "transitions": [(round(time_, 3), active) for (time_, active) in transitions],
+        }
+        result.update(detection_events(transitions, truth_changes(periods), seconds))
+        results[name] = result
+    return results
+
+
+def bench_engine(threshold, scenario, speed):
+    """ Run the engine on the fake backend, time is measured on the capture clock """
+    periods = scenario_periods(scenario)
+    backend = alsaloopfake.install([data for (data, _playing) in periods], speed=speed)
+    import alsaloop
+
+    transitions = []
+    engine = alsaloop.Engine(threshold, start_hooks=[], metrics=True)
+    engine.add_listener(lambda event, values: event == "playback" and
+                        transitions.append((backend.seconds(), values["playing"])))
+    start = time.process_time()
+    engine.start()
+    backend.finished.wait()
+    used = time.process_time() - start
+    seconds = backend.seconds()
+    engine.stop()
+
+    result = {
+        "scenario": scenario,
+        "speed": speed,
+        "audio_seconds": seconds,
+        "cpu_per_audio_second": used / seconds,
+        "played_seconds": backend.played_frames / SAMPLE_RATE,
+        "counters": dict(engine.counters),
+        "metrics": engine.metrics_snapshot(),
+        "transitions": [(round(time_, 3), playing) for (time_, playing) in transitions],
+    }
+    result.update(detection_events(transitions, truth_changes(periods), seconds))
+    return result
+
+
+def print_results(results, prefix=""):
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            print("{}{}:".format(prefix, key))
+            print_results(value, prefix + "  ")
+        elif isinstance(value, float):
+            print("{}{:24s} {:.6g}".format(prefix, key, value))
+        else:
+            print("{}{:24s} {}".format(prefix, key, value))
+
+
+def simulate_drift(skew, hours, latency=0.1, jitter=0.002, seed=0):
+    """ Simulate capture and playback on clocks that differ by skew, only the buffer fill is modeled
+
+    Returns the lowest and highest fill after the first hour, or after the
+    first half of shorter runs, the estimated drift and the range of
+    resampling ratios.
+    """
+    rnd = random.Random(seed)
+    target = int(latency * SAMPLE_RATE)
+    controller = alsaloopbuffer.DriftController(target)
+    capture_interval = PERIOD_SIZE / (SAMPLE_RATE * (1 + skew))
+    next_capture = 0.0
+    written_at = 0.0
+    fill = target
+    periods = max(1, int(hours * 3600 * SAMPLE_RATE / PERIOD_SIZE))
+    settled = min(int(3600 * SAMPLE_RATE / PERIOD_SIZE), periods // 2)
+    lowest = highest = None
+    ratios = []
+
+    for period in range(periods):
+        now = period * PERIOD_SIZE / SAMPLE_RATE + abs(rnd.gauss(0, jitter))
+        while next_capture <= now:
+            fill += PERIOD_SIZE
+            written_at = next_capture + abs(rnd.gauss(0, jitter))
+            next_capture += capture_interval
+
+        since_write = max(0.0, now - written_at) * SAMPLE_RATE
+        ratio = controller.update(fill + min(PERIOD_SIZE, since_write))
+        fill -= PERIOD_SIZE * ratio
+
+        if period >= settled:
+            lowest = fill if lowest is None else min(lowest, fill)
+            highest = fill if highest is None else max(highest, fill)
+            ratios.append(ratio)
+
+    return lowest, highest, controller.drift, max(ratios) - min(ratios)
+
+
+def burn_cpu(stop):
+    while not stop.is_set():
+        pass
+
+
+def bench_stress(threshold, seconds, workers):
+    """ Count xruns in real time while workers processes keep the CPUs busy """
+    if workers is None:
+        workers = 2 * os.cpu_count()
+    results = {}
+    # Real-time mode locks the memory and freezes the garbage collector of this process, it has to run last
+    for realtime in (False, True):
+        backend = alsaloopfake.install(alsaloopfake.tone(seconds), speed=1.0)
+        import alsaloop
+
+        stop = multiprocessing.Event()
+        burners = [multiprocessing.Process(target=burn_cpu, args=(stop,), daemon=True) for _i in range(workers)]
+        for burner in burners:
+            burner.start()
+        engine = alsaloop.Engine(threshold, start_hooks=[], metrics=True, realtime=realtime)
+        engine.start()
+        backend.finished.wait()
+        seconds_played = backend.seconds()
+        engine.stop()
+        stop.set()
+        for burner in burners:
+            burner.join()
+
+        xruns = backend.capture_overruns + backend.playback_underruns
+        results["realtime" if realtime else "normal"] = {
+            "workers": workers,
+            "audio_seconds": seconds_played,
+            "capture_overruns": backend.capture_overruns,
+            "playback_underruns": backend.playback_underruns,
+            "xruns_per_hour": xruns * 3600 / seconds_played,
+            "counters": dict(engine.counters),
+        }
+    return results
+
+
+def bench_idle(threshold, seconds, idle_period):
+    """ CPU time and context switches per second while waiting for a signal, and the time until output starts """
+    results = {}
+    for period in (0, idle_period):
+        # Noise below the threshold, followed by a tone that starts the output
+        source = list(alsaloopfake.noise(seconds + 2, level=-80)) + list(alsaloopfake.tone(2, level=-20))
+        backend = alsaloopfake.install(source, speed=1.0)
+        import alsaloop
+
+        started = []
+        engine = alsaloop.Engine(threshold, start_hooks=[], idle_period=period, idle_delay=1)
+        engine.add_listener(lambda event, values: event == "playback" and values["playing"] and
+                            started.append(backend.seconds()))
+        engine.start()
+        # Measure once the idle mode has started
+        time.sleep(2)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.monotonic()
+        time.sleep(seconds)
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        elapsed = time.monotonic() - start
+        backend.finished.wait()
+        engine.stop()
+
+        cpu = used.ru_utime + used.ru_stime - usage.ru_utime - usage.ru_stime
+        switches = used.ru_nvcsw + used.ru_nivcsw - usage.ru_nvcsw - usage.ru_nivcsw
+        results["idle" if period else "normal"] = {
+            "period_size": period or alsaloop.PERIOD_SIZE,
+            "cpu_percent": cpu / elapsed * 100,
+            "wakeups_per_second": switches / elapsed,
+            "periods_per_second": alsaloop.SAMPLE_RATE / (period or alsaloop.PERIOD_SIZE),
+            # Seconds between the start of the tone and the output
+            "start_delay": started[0] - (seconds + 2) if started else None,
+            "counters": dict(engine.counters),
+        }
+    return results
+
+
+def bench_drift(hours):
+    print("{:>10s} {:>22s} {:>14s} {:>14s}".format("skew ppm", "buffer range ms", "estimate ppm", "wobble ppm"))
+    for skew in (-500e-6, -100e-6, 0, 100e-6, 500e-6):
+        (lowest, highest, drift, wobble) = simulate_drift(skew, hours)
+        print("{:10.0f} {:10.1f} .. {:8.1f} {:14.1f} {:14.1f}".format(
+            skew * 1e6, lowest * 1000 / SAMPLE_RATE, highest * 1000 / SAMPLE_RATE, drift * 1e6, wobble * 1e6))
+
+    resampler = alsaloopdsp.create_resampler(CHANNELS)
+    data = noise_period(PERIOD_SIZE, CHANNELS)
+    periods = int(SAMPLE_RATE * 10 / PERIOD_SIZE)
+    start = time.process_time()
+    for _i in range(periods):
+        resampler.process(data, 1.0002)
+    used = time.process_time() - start
+    print("{} cpu s/audio s {:.5f}".format(type(resampler).__name__, used / (periods * PERIOD_SIZE / SAMPLE_RATE)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="alsaloop micro-benchmarks")
+    parser.add_argument("--seconds", type=float, default=10,
+                        help="seconds of audio to process")
+    parser.add_argument("--channels", type=int, default=CHANNELS,
+                        help="number of channels for the meter benchmark")
+    parser.add_argument("--cycles", type=int, default=20,
+                        help="number of start/stop cycles for the transition benchmark")
+    parser.add_argument("--hours", type=float, default=24,
+                        help="simulated run time for the drift benchmark")
+    parser.add_argument("--rate", type=float, default=20,
+                        help="level reports per second for the dbus benchmark")
+    parser.add_argument("--threshold", default="40",
+                        help="input level threshold for the startup, detection and engine benchmarks")
+    parser.add_argument("--scenario", default="start-stop", choices=sorted(SCENARIOS),
+                        help="test signal for the engine benchmark")
+    parser.add_argument("--speed", type=float, default=20,
+                        help="how much faster than real time the engine benchmark runs")
+    parser.add_argument("--meter", default="auto", choices=["auto"] + sorted(alsaloopdsp.METERS),
+                        help="meter for the detection benchmark")
+    parser.add_argument("--weighting", default="none", choices=["none"] + alsaloopdsp.WEIGHTINGS,
+                        help="frequency weighting for the detection benchmark")
+    parser.add_argument("--detect-on", default="peak", choices=alsaloopdetect.DETECTION_MODES,
+                        help="detection mode for the detection benchmark")
+    parser.add_argument("--workers", type=int,
+                        help="processes that keep the CPUs busy in the stress benchmark, default: twice the CPUs")
+    parser.add_argument("--idle-period", type=int, default=8192,
+                        help="period size in frames of the idle mode in the idle benchmark")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results of the detection, engine, stress and idle benchmarks as JSON")
+    parser.add_argument("benchmark", choices=["meter", "gain", "transition", "drift", "startup", "dbus", "metrics",
+                                              "detection", "engine", "stress", "idle"])
+    args = parser.parse_args()
+    if args.hours <= 0:
+        parser.error("--hours has to be larger than 0")
+
+    if args.benchmark == "meter":
+        bench_meter(args.seconds, args.channels)
+    elif args.benchmark == "gain":
+        bench_gain(args.seconds, args.channels)
+    elif args.benchmark == "transition":
+        bench_transition(args.cycles)
+    elif args.benchmark == "drift":
+        bench_drift(args.hours)
+    elif args.benchmark == "startup":
+        bench_startup(args.threshold)
+    elif args.benchmark == "dbus":
+        bench_dbus(args.seconds, args.rate)
+    elif args.benchmark == "metrics":
+        bench_metrics(args.seconds)
+    elif args.benchmark in ("detection", "engine", "stress", "idle"):
+        threshold = alsaloopdetect.parse_threshold(args.threshold)
+        if args.benchmark == "detection":
+            results = bench_detection(threshold, args.meter, args.weighting, args.detect_on)
+        elif args.benchmark == "engine":
+            results = bench_engine(threshold, args.scenario, args.speed)
+        elif args.benchmark == "stress":
+            results = bench_stress(threshold, args.seconds, args.workers)
+        else:
+            results = bench_idle(threshold, args.seconds, args.idle_period)
+        if args.json:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            print_results(results)
+
+
+if __name__ == '__main__':
+    main()
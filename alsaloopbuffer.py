@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import threading
+import time
+
+# The largest clock drift between capture and playback that will be compensated, as a ratio (1000 ppm)
+MAX_DRIFT = 0.001
+
+
+class RingBuffer():
+    """ FIFO of audio frames in a buffer that is allocated once
+
+    One thread writes and another one reads. If the buffer is full, the
+    oldest frames are overwritten.
+    """
+
+    def __init__(self, frames, frame_size):
+        self.frame_size = frame_size
+        self.size = frames * frame_size
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        # Position of the oldest byte and number of bytes in the buffer
+        self.start = 0
+        self.fill = 0
+        # Time of the last write, used to estimate the fill between writes
+        self.written_at = 0.0
+        self.condition = threading.Condition()
+
+    @property
+    def fill_frames(self):
+        return self.fill // self.frame_size
+
+    def write(self, data):
+        """ Append data, returns the number of bytes that had to be dropped because the buffer was full """
+        data = memoryview(data).cast("B")
+        length = len(data)
+        truncated = 0
+        if length > self.size:
+            truncated = length - self.size
+            data = data[truncated:]
+            length = self.size
+
+        with self.condition:
+            end = (self.start + self.fill) % self.size
+            first = min(length, self.size - end)
+            self.view[end:end + first] = data[:first]
+            self.view[:length - first] = data[first:]
+
+            dropped = max(0, self.fill + length - self.size)
+            self.fill += length - dropped
+            self.start = (self.start + dropped) % self.size
+            self.written_at = time.monotonic()
+            self.condition.notify_all()
+
+        return dropped + truncated
+
+    def read(self, out):
+        """ Move up to len(out) bytes into out, returns the number of bytes read """
+        out = memoryview(out).cast("B")
+        with self.condition:
+            length = min(len(out), self.fill)
+            length -= length % self.frame_size
+            first = min(length, self.size - self.start)
+            out[:first] = self.view[self.start:self.start + first]
+            out[first:length] = self.view[:length - first]
+
+            self.start = (self.start + length) % self.size
+            self.fill -= length
+
+        return length
+
+    def discard(self, length):
+        """ Drop up to length of the oldest bytes """
+        with self.condition:
+            length = min(length - length % self.frame_size, self.fill)
+            self.start = (self.start + length) % self.size
+            self.fill -= length
+
+        return length
+
+    def move_to(self, other):
+        """ Append everything to another ring buffer and empty this one, returns the number of bytes moved """
+        with self.condition:
+            first = min(self.fill, self.size - self.start)
+            other.write(self.view[self.start:self.start + first])
+            other.write(self.view[:self.fill - first])
+            moved = self.fill
+            self.start = 0
+            self.fill = 0
+
+        return moved
+
+    def clear(self):
+        with self.condition:
+            self.start = 0
+            self.fill = 0
+
+    def wait(self, length, timeout):
+        """ Wait up to timeout seconds until at least length bytes are available """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.fill >= length, timeout)
+
+
+class DriftController():
+    """ Estimates the ratio between the capture and the playback clock from the buffer fill
+
+    A PI controller keeps the smoothed fill at the target. Its integral part
+    converges to the drift between the clocks, the returned ratio is the
+    number of captured frames that should be played per output frame.
+    """
+
+    def __init__(self, target, max_drift=MAX_DRIFT, smoothing=0.01, proportional=1e-3, integral=2.5e-7):
+        self.target = target
+        self.max_drift = max_drift
+        self.smoothing = smoothing
+        self.proportional = proportional
+        self.integral = integral
+        self.fill = None
+        self.drift = 0.0
+        self.ratio = 1.0
+
+    def clamp(self, value):
+        return max(-self.max_drift, min(self.max_drift, value))
+
+    def update(self, fill):
+        """ Called once per played period with the current fill in frames, returns the new ratio """
+        if self.fill is None:
+            self.fill = fill
+        else:
+            self.fill += self.smoothing * (fill - self.fill)
+
+        error = (self.fill - self.target) / self.target
+        self.drift = self.clamp(self.drift + self.integral * error)
+        self.ratio = 1 + self.clamp(self.drift + self.proportional * error)
+        return self.ratio
+
+    def reset(self):
+        """ Start over after a gap in playback. The drift estimate is kept, the clocks don't change. """
+        self.fill = None
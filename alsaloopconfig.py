@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+CONFIG_FILE = "/etc/alsaloop.json"
+# Seconds to wait for more changes after the configuration file has been written, editors often write several times
+SETTLE_TIME = 0.1
+# Seconds between two checks of the modification time if inotify isn't available
+POLL_INTERVAL = 2
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def parse_numbers(value):
+    """ "2,3" or "2-3" to a list of numbers, used for CPUs and channels """
+    numbers = []
+    for part in value.split(","):
+        if "-" in part:
+            (first, last) = part.split("-", 1)
+            numbers.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            numbers.append(int(part))
+    return numbers
+
+
+def read_config(path=CONFIG_FILE):
+    """ The settings of the configuration file, raises OSError or ValueError if it can't be read """
+    with open(path) as json_file:
+        config = json.load(json_file)
+    if not isinstance(config, dict):
+        raise ValueError("{} doesn't contain an object".format(path))
+    return config
+
+
+def inotify_watch(directory, mask):
+    """ A file descriptor that reports changes in directory, None if inotify isn't available """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        logging.warning("can't watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+class ConfigWatcher():
+    """ Calls a function on its own thread whenever the configuration file has changed
+
+    The directory is watched with inotify, so files that are replaced by
+    renaming a new one are noticed as well. Without inotify, the
+    modification time is checked every POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, callback, path=CONFIG_FILE):
+        self.callback = callback
+        self.path = path
+        self.running = False
+        self.thread = None
+        self.fd = None
+
+    def start(self):
+        self.fd = inotify_watch(os.path.dirname(os.path.abspath(self.path)),
+                                IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+        if self.fd is None:
+            logging.info("inotify isn't available, checking %s every %d s", self.path, POLL_INTERVAL)
+        self.running = True
+        self.thread = threading.Thread(target=self.watch_loop, name="config", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(POLL_INTERVAL + 1)
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def changed(self, data):
+        """ Whether the inotify events in data concern the configuration file """
+        name = os.path.basename(self.path)
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            (_wd, _mask, _cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            if os.fsdecode(data[offset:offset + length].rstrip(b"\0")) == name:
+                return True
+            offset += length
+        return False
+
+    def wait_inotify(self):
+        readable, _, _ = select.select([self.fd], [], [], POLL_INTERVAL)
+        if not readable or not self.changed(os.read(self.fd, 4096)):
+            return False
+        # Collect the events of the same change
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            os.read(self.fd, 4096)
+        return True
+
+    def modification_time(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch_loop(self):
+        mtime = self.modification_time()
+        while self.running:
+            if self.fd is not None:
+                changed = self.wait_inotify()
+            else:
+                time.sleep(POLL_INTERVAL)
+                changed = mtime != self.modification_time()
+                mtime = self.modification_time()
+
+            if changed and self.running:
+                logging.info("%s has changed", self.path)
+                try:
+                    self.callback()
+                except Exception as e:
+                    logging.error("applying %s failed: %s", self.path, e)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import json
+import os
+from math import sqrt, log
+
+# Length of the sliding window over which the input level is measured in milliseconds
+DETECTION_WINDOW = 200
+# The input level has to exceed the start threshold for this many milliseconds before output starts
+ATTACK_TIME = 0
+# The time during which the input threshold hasn't been reached, before output is stopped.
+# This is useful for preventing the output device from turning off and on when there is a short silence in the input.
+RELEASE_TIME = 15000
+# The stop threshold is this many dB below the start threshold. This prevents output from turning on and off when
+# the volume fluctuates just around the threshold.
+HYSTERESIS = 3
+# What is compared against the threshold: the peak, the RMS, or the peak if the crest factor (peak to RMS in dB) is
+# in the range of music. Steady hum has a crest factor of 3 dB, single clicks have one far above 30 dB.
+DETECTION_MODES = ["peak", "rms", "crest"]
+CREST_MIN = 6
+CREST_MAX = 30
+# Signals with an RMS above this level in dBFS count in the crest mode whatever their crest factor, a steady tone has
+# one of 3 dB. Hum and clicks below it are still rejected.
+CREST_RMS = -30
+# Which of the channels in the mask have to carry a signal: any of them or all of them
+CHANNEL_POLICIES = ["any", "all"]
+# Automatic thresholds: the noise floor is this percentile of the levels of the captured periods, older levels count
+# half after NOISE_HALF_LIFE seconds. Output starts START_MARGIN dB above the noise floor and stops STOP_MARGIN dB
+# above it.
+NOISE_PERCENTILE = 10
+NOISE_HALF_LIFE = 1800
+START_MARGIN = 12
+STOP_MARGIN = 6
+# The noise floor is kept in a histogram with a bin every NOISE_STEP dB from NOISE_LOWEST to 0 dBFS, digital
+# silence counts as NOISE_LOWEST
+NOISE_LOWEST = -120
+NOISE_STEP = 0.5
+# Seconds of levels needed before the thresholds follow the noise floor, the configured threshold is used until then
+NOISE_CALIBRATION = 30
+# Start threshold until then if none has been configured
+AUTO_THRESHOLD = -50
+# Automatic start thresholds are kept in this range, a floor of digital silence doesn't make every dither noise count
+AUTO_THRESHOLD_MIN = -90
+AUTO_THRESHOLD_MAX = -30
+# Where the noise floor is kept between restarts, so the thresholds are calibrated right away
+NOISE_FILE = "/var/lib/alsaloop/noisefloor.json"
+
+
+def decibel(value, full_scale):
+    if value <= 0:
+        return float("-inf")
+    return 20 * log(value / full_scale, 10)
+
+
+def parse_threshold(value):
+    """ The start threshold in dB from the command line or the configuration, None disables level detection """
+    if value is None:
+        return None
+    threshold = float(value)
+    if threshold == 0:
+        return None
+    return -abs(threshold)
+
+
+class NoiseFloor():
+    """ Running percentile of the input level in dB, in constant memory
+
+    Every level adds its duration to a histogram bin. Instead of decaying
+    all bins, the weight of new levels grows, the bins are scaled down once
+    the weight gets large.
+    """
+
+    def __init__(self, percentile=NOISE_PERCENTILE, half_life=NOISE_HALF_LIFE, lowest=NOISE_LOWEST, step=NOISE_STEP):
+        self.percentile = percentile
+        self.half_life = half_life
+        self.lowest = lowest
+        self.step = step
+        self.bins = [0.0] * (int(round(-lowest / step)) + 1)
+        self.total = 0.0
+        self.weight = 1.0
+
+    @property
+    def seconds(self):
+        """ Seconds of levels in the histogram after the decay """
+        return self.total / self.weight
+
+    @property
+    def calibrated(self):
+        return self.seconds >= NOISE_CALIBRATION
+
+    def add(self, level, seconds):
+        """ Add a level in dBFS that lasted for the given seconds """
+        index = int(round((level - self.lowest) / self.step)) if level > self.lowest else 0
+        index = min(index, len(self.bins) - 1)
+        self.weight *= 2 ** (seconds / self.half_life)
+        self.bins[index] += seconds * self.weight
+        self.total += seconds * self.weight
+        if self.weight > 1e12:
+            self.bins = [value / self.weight for value in self.bins]
+            self.total /= self.weight
+            self.weight = 1.0
+
+    @property
+    def level(self):
+        """ The noise floor in dBFS, None without levels """
+        if not self.total:
+            return None
+        remaining = self.total * self.percentile / 100
+        for (index, value) in enumerate(self.bins):
+            remaining -= value
+            if remaining <= 0:
+                break
+        return self.lowest + index * self.step
+
+    def save(self, path):
+        """ Write the histogram to a file, replacing it at once """
+        state = {
+            "percentile": self.percentile,
+            "half_life": self.half_life,
+            "lowest": self.lowest,
+            "step": self.step,
+            "bins": [value / self.weight for value in self.bins],
+        }
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        """ Read a histogram written by save(), raises ValueError if it doesn't match """
+        with open(path) as f:
+            state = json.load(f)
+        if (state.get("lowest"), state.get("step")) != (self.lowest, self.step) \
+                or len(state.get("bins", ())) != len(self.bins):
+            raise ValueError("the histogram in {} has different bins".format(path))
+        self.bins = [float(value) for value in state["bins"]]
+        self.total = sum(self.bins)
+        self.weight = 1.0
+
+
+class Detector():
+    """ Decides whether an input signal is present, updated once per captured period
+
+    The level of every channel is the peak over a sliding window of the
+    most recent periods. The detector becomes active once the level has been
+    above the start threshold for the attack time, and inactive once it has
+    been below the stop threshold for the release time. Without a start
+    threshold, it is always active. The mode selects the level, see
+    DETECTION_MODES. Only the channels in mask count, the policy decides
+    whether any or all of them need a signal.
+
+    With a noise floor, the thresholds follow it once it is calibrated, see
+    NoiseFloor. While a signal is detected, only periods below the stop
+    threshold are added to it.
+    """
+
+    def __init__(self, start_threshold, full_scale, sample_rate, period_size, hysteresis=HYSTERESIS,
+                 window=DETECTION_WINDOW, attack=ATTACK_TIME, release=RELEASE_TIME, mode="peak",
+                 crest_min=CREST_MIN, crest_max=CREST_MAX, crest_rms=CREST_RMS, channels=2, policy="any", mask=None,
+                 noise_floor=None, start_margin=START_MARGIN, stop_margin=STOP_MARGIN):
+        if mode not in DETECTION_MODES:
+            raise ValueError("unknown detection mode {}".format(mode))
+        if policy not in CHANNEL_POLICIES:
+            raise ValueError("unknown channel policy {}".format(policy))
+        if mask is None:
+            mask = range(channels)
+        if not mask or not all(0 <= channel < channels for channel in mask):
+            raise ValueError("channel mask {} doesn't fit {} channels".format(list(mask), channels))
+        self.channels = channels
+        self.policy = policy
+        self.mask = list(mask)
+        self.start_threshold = start_threshold
+        self.mode = mode
+        self.crest_min = crest_min
+        self.crest_max = crest_max
+        self.crest_rms = crest_rms
+        self.hysteresis = hysteresis
+        self.full_scale = full_scale
+        self.attack_frames = attack * sample_rate / 1000
+        self.release_frames = release * sample_rate / 1000
+        self.sample_rate = sample_rate
+        self.window = window
+        self.period_size = period_size
+
+        self.noise_floor = noise_floor
+        self.start_margin = start_margin
+        self.stop_margin = stop_margin
+        # Frames since the thresholds were last derived from the noise floor
+        self.noise_frames = 0
+        if noise_floor is not None:
+            if start_margin <= stop_margin:
+                raise ValueError("the start margin has to be larger than the stop margin")
+            if self.start_threshold is None:
+                self.start_threshold = AUTO_THRESHOLD
+            self.follow_noise_floor()
+
+        # Per period values of the window, the oldest one is overwritten next. Counts are per channel, the sums of
+        # squares and the peaks are lists with a value for every channel.
+        length = self.window_periods(period_size)
+        self.counts = [0] * length
+        self.square_sums = [[0] * channels] * length
+        self.peaks = [[0] * channels] * length
+        self.position = 0
+
+        self.active = self.start_threshold is None
+        # Frames since the level crossed the threshold that would change the state
+        self.pending_frames = 0
+
+    def window_periods(self, period_size):
+        return max(1, int(round(self.window * self.sample_rate / 1000 / period_size)))
+
+    def set_period_size(self, period_size):
+        """ Keep the window length when the capture period size changes, the most recent periods are kept """
+        if period_size == self.period_size:
+            return
+        self.period_size = period_size
+        length = self.window_periods(period_size)
+        # Oldest first, padded with empty periods if the window gets longer
+        order = list(range(self.position, len(self.peaks))) + list(range(self.position))
+        order = order[-length:]
+        padding = length - len(order)
+        self.counts = [0] * padding + [self.counts[index] for index in order]
+        self.square_sums = [[0] * self.channels] * padding + [self.square_sums[index] for index in order]
+        self.peaks = [[0] * self.channels] * padding + [self.peaks[index] for index in order]
+        self.position = 0
+
+    @property
+    def stop_threshold(self):
+        return self.start_threshold - self.hysteresis
+
+    @property
+    def threshold(self):
+        """ The threshold that applies in the current state """
+        if self.active:
+            return self.stop_threshold
+        return self.start_threshold
+
+    def channel_peak(self, channel):
+        return decibel(max(peaks[channel] for peaks in self.peaks), self.full_scale)
+
+    def channel_rms(self, channel):
+        count = sum(self.counts)
+        if not count:
+            return float("-inf")
+        return decibel(sqrt(sum(square_sums[channel] for square_sums in self.square_sums) / count), self.full_scale)
+
+    @property
+    def peak(self):
+        """ The peak of all channels in the window """
+        return decibel(max(max(peaks) for peaks in self.peaks), self.full_scale)
+
+    @property
+    def rms(self):
+        """ The RMS of all channels in the window """
+        count = sum(self.counts) * self.channels
+        if not count:
+            return float("-inf")
+        return decibel(sqrt(sum(sum(square_sums) for square_sums in self.square_sums) / count), self.full_scale)
+
+    def channel_present(self, channel, threshold=None):
+        """ Whether the level of a channel is above the threshold that applies in the current state """
+        if threshold is None:
+            threshold = self.threshold
+        if self.mode == "rms":
+            return self.channel_rms(channel) > threshold
+
+        peak = self.channel_peak(channel)
+        if self.mode == "crest":
+            rms = self.channel_rms(channel)
+            if rms > self.crest_rms:
+                return peak > threshold
+            crest = peak - rms
+            return peak > threshold and self.crest_min <= crest <= self.crest_max
+        return peak > threshold
+
+    def period_level(self, count, square_sums, peaks):
+        """ The level of a single period in dBFS as the mode measures it, for the noise floor """
+        if self.mode == "rms":
+            if not count:
+                return float("-inf")
+            levels = [sqrt(square_sums[channel] / count) for channel in self.mask]
+        else:
+            levels = [peaks[channel] for channel in self.mask]
+        if self.policy == "all":
+            return decibel(min(levels), self.full_scale)
+        return decibel(max(levels), self.full_scale)
+
+    def follow_noise_floor(self):
+        """ Derive the thresholds from the noise floor once it is calibrated """
+        if not self.noise_floor.calibrated:
+            return
+        floor = self.noise_floor.level
+        self.start_threshold = max(AUTO_THRESHOLD_MIN, min(AUTO_THRESHOLD_MAX, floor + self.start_margin))
+        self.hysteresis = self.start_margin - self.stop_margin
+
+    def signal_present(self, threshold=None):
+        if self.policy == "all":
+            return all(self.channel_present(channel, threshold) for channel in self.mask)
+        return any(self.channel_present(channel, threshold) for channel in self.mask)
+
+    def candidate(self):
+        """ Whether a signal might be detected soon: active, waiting for the attack time or above the stop threshold """
+        if self.active or self.pending_frames:
+            return True
+        return self.signal_present(self.stop_threshold)
+
+    def update(self, count, square_sums, peaks, frames):
+        """ Add the measurement of a period, returns True if the state has changed
+
+        count is the number of samples per channel, square_sums and peaks
+        have a value for every channel as returned by Meter.measure_channels().
+        """
+        self.counts[self.position] = count
+        self.square_sums[self.position] = square_sums
+        self.peaks[self.position] = peaks
+        self.position = (self.position + 1) % len(self.peaks)
+
+        if self.noise_floor is not None:
+            level = self.period_level(count, square_sums, peaks)
+            # A long signal would raise the noise floor, while it is detected only its quiet periods count
+            if not self.active or level < self.stop_threshold:
+                self.noise_floor.add(level, frames / self.sample_rate)
+            self.noise_frames += frames
+            if self.noise_frames >= self.sample_rate:
+                # Once a second is often enough, the noise floor moves slowly
+                self.noise_frames = 0
+                self.follow_noise_floor()
+
+        if self.start_threshold is None:
+            return False
+
+        above = self.signal_present()
+        if above == self.active:
+            self.pending_frames = 0
+            return False
+
+        self.pending_frames += frames
+        if self.active:
+            delay = self.release_frames
+        else:
+            delay = self.attack_frames
+        if self.pending_frames < delay:
+            return False
+
+        self.active = above
+        self.pending_frames = 0
+        return True
+
+    def reset(self, active=False):
+        self.counts = [0] * len(self.counts)
+        self.square_sums = [[0] * self.channels] * len(self.square_sums)
+        self.peaks = [[0] * self.channels] * len(self.peaks)
+        self.active = active or self.start_threshold is None
+        self.pending_frames = 0
@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+# Sample processing for alsaloop. Everything in here works on whole capture
+# periods at once instead of looping over single frames in Python.
+
+import sys
+import threading
+from array import array
+from operator import mul
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array typecode with a 4 byte item size, used when numpy isn't available
+if array("i").itemsize == 4:
+    INT32_TYPECODE = "i"
+else:
+    INT32_TYPECODE = "l"
+
+
+class SampleFormat():
+    """ A PCM sample format as named by alsa
+
+    samples() decodes a buffer into a numpy array of sample values,
+    array_samples() into an array multiplied by array_scale, which is used
+    if numpy isn't available. full_scale is the magnitude of a full scale
+    sample.
+    """
+
+    def __init__(self, name, width, full_scale, dtype, typecode, array_scale=1):
+        self.name = name
+        self.width = width
+        self.full_scale = full_scale
+        self.dtype = dtype
+        self.typecode = typecode
+        self.array_scale = array_scale
+
+    def __repr__(self):
+        return self.name
+
+    def samples(self, data, out=None):
+        """ Decode data, S24_LE samples are sign extended into out if it is given """
+        if self.name == "S24_3LE":
+            raw = numpy.frombuffer(data, dtype=numpy.uint8, count=len(data) - len(data) % 3)
+            raw = raw.reshape(-1, 3).astype(numpy.int32)
+            values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+            # Sign extend from 24 bits
+            return (values << 8) >> 8
+
+        values = numpy.frombuffer(data, dtype=self.dtype, count=len(data) // self.width)
+        if self.name == "S24_LE":
+            # The upper byte isn't necessarily the sign extension
+            if out is None:
+                return (values << 8) >> 8
+            out = out[:len(values)]
+            numpy.left_shift(values, 8, out=out)
+            return numpy.right_shift(out, 8, out=out)
+        return values
+
+    def array_samples(self, data):
+        length = len(data) - len(data) % self.width
+        if self.array_scale == 1 and sys.byteorder == "little":
+            # A view on the data, nothing is copied
+            return memoryview(data)[:length].cast(self.typecode)
+        if self.array_scale != 1:
+            # Move the 24 bit samples into the upper bytes of 32 bit ints
+            data = bytes(data)
+            count = length // self.width
+            buffer = bytearray(count * 4)
+            for byte in range(3):
+                buffer[byte + 1::4] = data[byte:length:self.width]
+        else:
+            buffer = data[:length]
+
+        samples = array(self.typecode)
+        samples.frombytes(buffer)
+        if sys.byteorder == "big":
+            samples.byteswap()
+        return samples
+
+    def encode(self, values):
+        """ Encode a numpy array of values in units of this format's full scale """
+        if self.name == "FLOAT_LE":
+            return values.astype("<f4").tobytes()
+
+        values = numpy.clip(numpy.rint(values), -self.full_scale, self.full_scale - 1)
+        if self.name == "S16_LE":
+            return values.astype("<i2").tobytes()
+        values = values.astype("<i4")
+        if self.name == "S24_3LE":
+            return values.view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+        return values.tobytes()
+
+
+FORMATS = {
+    "S16_LE": SampleFormat("S16_LE", 2, 2 ** 15, "<i2", "h"),
+    "S24_LE": SampleFormat("S24_LE", 4, 2 ** 23, "<i4", INT32_TYPECODE, array_scale=256),
+    "S24_3LE": SampleFormat("S24_3LE", 3, 2 ** 23, None, INT32_TYPECODE, array_scale=256),
+    "S32_LE": SampleFormat("S32_LE", 4, 2 ** 31, "<i4", INT32_TYPECODE),
+    "FLOAT_LE": SampleFormat("FLOAT_LE", 4, 1.0, "<f4", "f"),
+}
+
+DEFAULT_FORMAT = FORMATS["S32_LE"]
+
+
+def convert(data, input_format, output_format):
+    """ Convert samples between formats, data is returned as it is if the formats match """
+    if input_format is output_format:
+        return data
+    if numpy is None:
+        raise ValueError("converting from {} to {} requires numpy".format(input_format, output_format))
+
+    values = input_format.samples(data).astype(numpy.float64)
+    return output_format.encode(values * (output_format.full_scale / input_format.full_scale))
+
+
+class Meter():
+    """ Computes the number of samples, the sum of all samples squared and
+    the peak value of a buffer of interleaved samples
+
+    measure_channels() returns the number of frames and lists of the sums
+    of squares and the peaks of every channel instead.
+    """
+
+    name = None
+
+    def __init__(self, sample_format=DEFAULT_FORMAT, channels=2):
+        self.sample_format = sample_format
+        self.channels = channels
+
+    def measure(self, data):
+        raise NotImplementedError()
+
+    def measure_channels(self, data):
+        raise NotImplementedError()
+
+
+class LoopMeter(Meter):
+    """ Loops over every sample in Python like the original implementation, kept as a reference """
+
+    name = "loop"
+
+    def measure(self, data):
+        samples = 0
+        sample_sum = 0
+        max_sample = 0
+        for value in self.sample_format.array_samples(data):
+            samples += 1
+            sample_sum += value * value
+            max_sample = max(max_sample, abs(value))
+
+        scale = self.sample_format.array_scale
+        return samples, sample_sum / (scale * scale), max_sample / scale
+
+    def measure_channels(self, data):
+        channels = self.channels
+        samples = 0
+        sample_sums = [0] * channels
+        max_samples = [0] * channels
+        for (index, value) in enumerate(self.sample_format.array_samples(data)):
+            channel = index % channels
+            samples += 1
+            sample_sums[channel] += value * value
+            max_samples[channel] = max(max_samples[channel], abs(value))
+
+        scale = self.sample_format.array_scale
+        return (samples // channels, [sample_sum / (scale * scale) for sample_sum in sample_sums],
+                [max_sample / scale for max_sample in max_samples])
+
+
+class ArrayMeter(Meter):
+    """ Pure Python meter that lets the interpreter iterate in C """
+
+    name = "array"
+
+    def measure(self, data):
+        samples = self.sample_format.array_samples(data)
+        if not len(samples):
+            return 0, 0, 0
+
+        sample_sum = sum(map(mul, samples, samples))
+        max_sample = max(max(samples), -min(samples))
+        scale = self.sample_format.array_scale
+        return len(samples), sample_sum / (scale * scale), max_sample / scale
+
+    def measure_channels(self, data):
+        channels = self.channels
+        samples = self.sample_format.array_samples(data)
+        frames = len(samples) // channels
+        if not frames:
+            return 0, [0] * channels, [0] * channels
+
+        scale = self.sample_format.array_scale
+        sample_sums = []
+        max_samples = []
+        for channel in range(channels):
+            # Every channels-th sample, a strided view of the interleaved samples
+            values = samples[channel:frames * channels:channels]
+            sample_sums.append(sum(map(mul, values, values)) / (scale * scale))
+            max_samples.append(max(max(values), -min(values)) / scale)
+        return frames, sample_sums, max_samples
+
+
+class NumpyMeter(Meter):
+    """ Vectorized meter, only available if numpy is installed
+
+    Samples are converted in buffers that are reused for every period, so
+    measuring doesn't allocate memory for the samples.
+    """
+
+    name = "numpy"
+
+    def __init__(self, sample_format=DEFAULT_FORMAT, channels=2):
+        super().__init__(sample_format, channels)
+        self.values = None
+        self.scratch = None
+
+    def buffers(self, count):
+        if self.values is None or len(self.values) < count:
+            self.values = numpy.empty(count, dtype=numpy.float64)
+            self.scratch = numpy.empty(count, dtype=numpy.int32)
+        return self.values[:count]
+
+    def measure(self, data):
+        count = len(data) // self.sample_format.width
+        if not count:
+            return 0, 0, 0
+
+        # Squares of 32 bit samples don't fit into an int64 sum, use floats
+        values = self.buffers(count)
+        numpy.copyto(values, self.sample_format.samples(data, self.scratch))
+        sample_sum = float(numpy.dot(values, values))
+        max_sample = max(float(values.max()), -float(values.min()))
+        return count, sample_sum, max_sample
+
+    def measure_channels(self, data):
+        channels = self.channels
+        frames = len(data) // self.sample_format.width // channels
+        if not frames:
+            return 0, [0] * channels, [0] * channels
+
+        values = self.buffers(frames * channels)
+        numpy.copyto(values, self.sample_format.samples(data, self.scratch)[:frames * channels])
+        # One row per frame, the columns are the channels
+        values = values.reshape(frames, channels)
+        sample_sums = numpy.einsum("ij,ij->j", values, values)
+        max_samples = numpy.maximum(values.max(axis=0), -values.min(axis=0))
+        return frames, sample_sums.tolist(), max_samples.tolist()
+
+
+# Frequency weightings of the WeightedMeter
+WEIGHTINGS = ["a", "band"]
+# Default corner frequencies of the band-pass weighting in Hz, this rejects mains hum and most hiss
+BAND_LOW = 150
+BAND_HIGH = 8000
+
+
+def a_weighting(frequencies):
+    """ Gain of the A-weighting curve (IEC 61672) """
+    f2 = frequencies * frequencies
+    gain = (12194.0 ** 2 * f2 * f2) / ((f2 + 20.6 ** 2) * numpy.sqrt((f2 + 107.7 ** 2) * (f2 + 737.9 ** 2))
+                                       * (f2 + 12194.0 ** 2))
+    # +2.0 dB normalizes the gain at 1 kHz to 1
+    return gain * 10 ** (2.0 / 20)
+
+
+def band_weighting(frequencies, low=BAND_LOW, high=BAND_HIGH):
+    """ Gain of a second order Butterworth high-pass at low and low-pass at high """
+    high_pass = (frequencies / low) ** 2 / numpy.sqrt(1 + (frequencies / low) ** 4)
+    low_pass = 1 / numpy.sqrt(1 + (frequencies / high) ** 4)
+    return high_pass * low_pass
+
+
+class WeightedMeter(Meter):
+    """ Measures the input after a frequency weighting, requires numpy
+
+    The weighting is a linear phase FIR filter of one period length,
+    applied with FFT overlap-save, so periods are filtered seamlessly. The
+    output is delayed by half a period.
+    """
+
+    name = "weighted"
+
+    def __init__(self, sample_format=DEFAULT_FORMAT, channels=2, rate=48000, weighting="a",
+                 low=BAND_LOW, high=BAND_HIGH):
+        if numpy is None:
+            raise ValueError("frequency weighting requires numpy")
+        if weighting not in WEIGHTINGS:
+            raise ValueError("unknown weighting {}".format(weighting))
+        super().__init__(sample_format, channels)
+        self.rate = rate
+        self.weighting = weighting
+        self.low = low
+        self.high = high
+        # Frequency response of the filter and the previous period, for the period length they were set up for
+        self.response = None
+        self.previous = None
+
+    def setup(self, frames):
+        size = 2 * frames
+        frequencies = numpy.fft.rfftfreq(size, 1 / self.rate)
+        if self.weighting == "a":
+            gains = a_weighting(frequencies)
+        else:
+            gains = band_weighting(frequencies, self.low, self.high)
+        # Zero phase impulse response, shifted to the middle of a period and windowed to its length
+        impulse = numpy.roll(numpy.fft.irfft(gains, size), frames // 2)[:frames] * numpy.hanning(frames)
+        self.response = numpy.fft.rfft(impulse, size)[:, None]
+        self.previous = numpy.zeros((frames, self.channels))
+
+    def frames(self, data):
+        samples = self.sample_format.samples(data)
+        return samples[:len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+
+    def prime(self, data):
+        """ Use data as the audio right before the next period, e.g. if the audio in between isn't measured """
+        frames = self.frames(data)
+        if self.previous is None or len(self.previous) != len(frames):
+            self.setup(len(frames))
+        self.previous = frames.astype(numpy.float64)
+
+    def filter(self, data):
+        """ The weighted samples of data with one row per frame, None if there isn't a whole frame """
+        frames = self.frames(data)
+        if not frames.size:
+            return None
+
+        count = len(frames)
+        if self.previous is None or len(self.previous) != count:
+            self.setup(count)
+        block = numpy.concatenate((self.previous, frames))
+        self.previous = frames.astype(numpy.float64)
+        return numpy.fft.irfft(numpy.fft.rfft(block, axis=0) * self.response, 2 * count, axis=0)[count:]
+
+    def measure(self, data):
+        filtered = self.filter(data)
+        if filtered is None:
+            return 0, 0, 0
+
+        filtered = filtered.ravel()
+        sample_sum = float(numpy.dot(filtered, filtered))
+        max_sample = float(numpy.abs(filtered).max())
+        return filtered.size, sample_sum, max_sample
+
+    def measure_channels(self, data):
+        filtered = self.filter(data)
+        if filtered is None:
+            return 0, [0] * self.channels, [0] * self.channels
+
+        sample_sums = numpy.einsum("ij,ij->j", filtered, filtered)
+        max_samples = numpy.abs(filtered).max(axis=0)
+        return len(filtered), sample_sums.tolist(), max_samples.tolist()
+
+
+class SubsamplingMeter(Meter):
+    """ Measures only the first part of every period with another meter
+
+    Used while waiting for an input signal, which lasts much longer than
+    a period. The frame count is the number of frames that were measured.
+    A WeightedMeter measures the part after the first one, at most half of
+    the period, as its filter needs the audio right before what it measures.
+    """
+
+    def __init__(self, meter, fraction):
+        super().__init__(meter.sample_format, meter.channels)
+        self.meter = meter
+        self.fraction = fraction
+
+    def part(self, data):
+        frame_size = self.sample_format.width * self.channels
+        frames = len(data) // frame_size
+        data = memoryview(data).cast("B")
+        size = max(1, int(frames * self.fraction)) * frame_size
+        if isinstance(self.meter, WeightedMeter) and frames >= 2:
+            # The filter continues from the audio right before the part instead of the previous period
+            size = min(size, frames // 2 * frame_size)
+            self.meter.prime(data[:size])
+            return data[size:2 * size]
+        return data[:size]
+
+    def measure(self, data):
+        return self.meter.measure(self.part(data))
+
+    def measure_channels(self, data):
+        return self.meter.measure_channels(self.part(data))
+
+
+METERS = {
+    LoopMeter.name: LoopMeter,
+    ArrayMeter.name: ArrayMeter,
+    NumpyMeter.name: NumpyMeter,
+}
+
+
+def create_meter(name="auto", sample_format=DEFAULT_FORMAT, channels=2):
+    """ Create a meter by name, "auto" picks the fastest one available """
+    if name == "auto":
+        if numpy is not None:
+            name = NumpyMeter.name
+        else:
+            name = ArrayMeter.name
+
+    if name == NumpyMeter.name and numpy is None:
+        raise ValueError("numpy meter requested, but numpy is not installed")
+
+    return METERS[name](sample_format, channels)
+
+
+# Length of the fades when output starts and stops, and of the ramp of a software volume change, in milliseconds
+FADE_TIME = 20
+VOLUME_RAMP_TIME = 50
+
+
+class Ramp():
+    """ A gain that moves linearly to its target within a fixed number of frames """
+
+    def __init__(self, frames, value=1.0):
+        self.frames = frames
+        self.value = value
+        self.target = value
+        self.step = 0.0
+
+    @property
+    def moving(self):
+        return self.value != self.target
+
+    def set(self, target, value=None):
+        """ Start a ramp to target, from value if it is given """
+        if value is not None:
+            self.value = value
+        self.target = target
+        if self.frames > 0:
+            self.step = (target - self.value) / self.frames
+        else:
+            self.value = target
+
+    def advance(self, out, index):
+        """ Fill out with the gains of the next len(out) frames, index is 1, 2, 3, ... """
+        numpy.multiply(index[:len(out)], self.step, out=out)
+        out += self.value
+        if self.step > 0:
+            numpy.minimum(out, self.target, out=out)
+        else:
+            numpy.maximum(out, self.target, out=out)
+        self.value = float(out[-1])
+        return out
+
+
+class GainStage():
+    """ Applies fades and the software volume to interleaved audio, one gain per frame
+
+    The gain is the product of the fade and the volume, both change in
+    linear ramps so that neither starting or stopping nor a volume change
+    causes a step. At unity gain the audio is passed through unchanged,
+    otherwise it is scaled in buffers that are reused for every period.
+    The result has the same format as the input.
+    """
+
+    def __init__(self, sample_format=DEFAULT_FORMAT, channels=2, rate=48000, fade_time=FADE_TIME,
+                 volume_ramp=VOLUME_RAMP_TIME):
+        self.sample_format = sample_format
+        self.channels = channels
+        self.rate = rate
+        self.fade = Ramp(int(fade_time * rate / 1000))
+        self.volume = Ramp(int(volume_ramp * rate / 1000))
+        # fade_in() and set_volume() are called from other threads than process()
+        self.lock = threading.Lock()
+        self.index = None
+        self.fades = None
+        self.volumes = None
+        self.values = None
+        self.encoded = None
+
+    def set_times(self, fade_time, volume_ramp):
+        """ Change the length of the fades and volume ramps in milliseconds, a ramp in progress keeps its speed """
+        with self.lock:
+            self.fade.frames = int(fade_time * self.rate / 1000)
+            self.volume.frames = int(volume_ramp * self.rate / 1000)
+
+    def fade_in(self):
+        with self.lock:
+            self.fade.set(1.0, 0.0)
+
+    def fade_out(self):
+        with self.lock:
+            self.fade.set(0.0)
+
+    def set_volume(self, volume):
+        with self.lock:
+            if volume != self.volume.target:
+                self.volume.set(volume)
+
+    def buffers(self, frames):
+        if self.index is None or len(self.index) < frames:
+            self.index = numpy.arange(1, frames + 1, dtype=numpy.float64)
+            self.fades = numpy.empty(frames, dtype=numpy.float64)
+            self.volumes = numpy.empty(frames, dtype=numpy.float64)
+            self.values = numpy.empty(frames * self.channels, dtype=numpy.float64)
+            if self.sample_format.dtype is not None:
+                self.encoded = numpy.empty(frames * self.channels, dtype=self.sample_format.dtype)
+
+    def gains(self, frames):
+        """ The gain of every frame as an array, or a single gain if it doesn't change """
+        with self.lock:
+            if self.fade.moving:
+                fades = self.fade.advance(self.fades[:frames], self.index)
+            else:
+                fades = self.fade.value
+            if self.volume.moving:
+                volumes = self.volume.advance(self.volumes[:frames], self.index)
+            else:
+                volumes = self.volume.value
+        if isinstance(fades, float) and isinstance(volumes, float):
+            return fades * volumes
+        if isinstance(fades, float):
+            return numpy.multiply(volumes, fades, out=volumes)
+        return numpy.multiply(fades, volumes, out=fades)
+
+    def process(self, data):
+        """ Returns data with the gain applied """
+        frame_size = self.sample_format.width * self.channels
+        frames = len(data) // frame_size
+        with self.lock:
+            unity = not self.fade.moving and not self.volume.moving and self.fade.value * self.volume.value == 1
+        if unity or not frames:
+            return data
+
+        self.buffers(frames)
+        count = frames * self.channels
+        gains = self.gains(frames)
+        values = self.values[:count]
+        samples = self.sample_format.samples(data)[:count]
+        if isinstance(gains, float):
+            numpy.multiply(samples, gains, out=values)
+        else:
+            numpy.multiply(samples.reshape(frames, self.channels), gains[:, None],
+                           out=values.reshape(frames, self.channels))
+
+        if self.sample_format.dtype is None or self.sample_format.name == "FLOAT_LE":
+            return self.sample_format.encode(values)
+        # Integer formats are rounded and clipped in place, 32 bit samples keep their full resolution
+        full_scale = self.sample_format.full_scale
+        numpy.rint(values, out=values)
+        numpy.clip(values, -full_scale, full_scale - 1, out=values)
+        encoded = self.encoded[:count]
+        numpy.copyto(encoded, values, casting="unsafe")
+        return memoryview(encoded).cast("B")
+
+
+class Resampler():
+    """ Linear interpolation resampler for small rate corrections of interleaved audio
+
+    The position of the next output frame is kept between calls, it is
+    relative to the last frame of the previous block. The output is
+    converted to output_format.
+    """
+
+    def __init__(self, channels, input_format=DEFAULT_FORMAT, output_format=DEFAULT_FORMAT):
+        self.channels = channels
+        self.input_format = input_format
+        self.output_format = output_format
+        self.scale = output_format.full_scale / input_format.full_scale
+        self.last = numpy.zeros((1, channels))
+        self.phase = 1.0
+
+    def process(self, data, ratio):
+        """ Resample data, ratio is the number of input frames per output frame """
+        samples = self.input_format.samples(data)
+        frames = samples[:len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+        count = len(frames)
+        if not count:
+            return b""
+
+        extended = numpy.concatenate((self.last, frames))
+        output_count = max(0, int(numpy.ceil((count - self.phase) / ratio)))
+        positions = self.phase + ratio * numpy.arange(output_count)
+        index = numpy.minimum(positions.astype(numpy.intp), count - 1)
+        fraction = (positions - index)[:, None]
+        output = extended[index] * (1 - fraction) + extended[index + 1] * fraction
+
+        self.phase += ratio * output_count - count
+        self.last = extended[-1:].astype(numpy.float64)
+        return self.output_format.encode(output.reshape(-1) * self.scale)
+
+
+class FrameSlipResampler():
+    """ Corrects the rate by dropping or repeating single frames, used if numpy isn't available """
+
+    def __init__(self, channels, input_format=DEFAULT_FORMAT, output_format=DEFAULT_FORMAT):
+        if input_format is not output_format:
+            raise ValueError("converting from {} to {} requires numpy".format(input_format, output_format))
+        self.frame_size = channels * input_format.width
+        # Input frames that should have been dropped (positive) or repeated (negative)
+        self.error = 0.0
+
+    def process(self, data, ratio):
+        frames = len(data) // self.frame_size
+        self.error += frames * (ratio - 1) / ratio
+        if self.error >= 1 and frames > 1:
+            self.error -= 1
+            return bytes(data[:(frames - 1) * self.frame_size])
+        elif self.error <= -1 and frames > 0:
+            self.error += 1
+            last_frame = data[(frames - 1) * self.frame_size:frames * self.frame_size]
+            return bytes(data[:frames * self.frame_size]) + bytes(last_frame)
+        return data
+
+
+def create_gain_stage(sample_format=DEFAULT_FORMAT, channels=2, rate=48000, fade_time=FADE_TIME,
+                      volume_ramp=VOLUME_RAMP_TIME):
+    """ A GainStage, None if numpy isn't available and output has to start and stop without fades """
+    if numpy is None:
+        return None
+    return GainStage(sample_format, channels, rate, fade_time, volume_ramp)
+
+
+def create_resampler(channels, input_format=DEFAULT_FORMAT, output_format=DEFAULT_FORMAT):
+    if numpy is not None:
+        return Resampler(channels, input_format, output_format)
+    return FrameSlipResampler(channels, input_format, output_format)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# An in-memory stand-in for the parts of pyalsaaudio that alsaloop uses and
+# a generator for test signals. It lets the benchmarks run alsaloop without
+# audio hardware and faster than real time:
+#
+#   import alsaloopfake
+#   alsaloopfake.install(alsaloopfake.music(60), speed=20)
+#   import alsaloop
+#
+# Capture devices play the installed source, playback devices and mixers
+# accept everything. Signals are S32_LE with CHANNELS channels. Devices have
+# a buffer of BUFFER_PERIODS periods, a capture device overruns if it isn't
+# read before its buffer is full and a playback device underruns if it
+# isn't written before its buffer is empty. Failures can be simulated with
+# the failing, busy_opens and stalled attributes of the backend.
+
+import collections
+import math
+import os
+import random
+import select
+import sys
+import threading
+import time
+from array import array
+
+CHANNELS = 2
+SAMPLE_RATE = 48000
+FULL_SCALE = 2 ** 31
+BUFFER_PERIODS = 4
+# Number of playback events the backend keeps
+PLAYBACK_EVENTS = 256
+EPIPE = 32
+
+PCM_PLAYBACK = 0
+PCM_CAPTURE = 1
+PCM_NORMAL = 0
+PCM_NONBLOCK = 1
+PCM_FORMAT_S16_LE = 2
+PCM_FORMAT_S24_LE = 6
+PCM_FORMAT_S32_LE = 10
+PCM_FORMAT_FLOAT_LE = 14
+PCM_FORMAT_S24_3LE = 32
+VOLUME_UNITS_PERCENTAGE = 0
+VOLUME_UNITS_RAW = 1
+VOLUME_UNITS_DB = 2
+
+
+class ALSAAudioError(Exception):
+    pass
+
+
+class Backend():
+    """ State shared by all fake devices """
+
+    def __init__(self):
+        self.source = iter(())
+        # Audio of the source that hasn't been read yet, devices read it in their own period size
+        self.pending = bytearray()
+        self.speed = 1.0
+        self.skew = 0.0
+        self.captured_frames = 0
+        self.played_frames = 0
+        self.capture_overruns = 0
+        self.playback_underruns = 0
+        # Set once the source is exhausted
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        # Types of the devices that raise ALSAAudioError on read() and write(), like an unplugged device
+        self.failing = set()
+        # Number of times opening a playback device fails as busy
+        self.busy_opens = 0
+        # Capture devices block in read() while this is set, like a hung driver
+        self.stalled = False
+        # The last things that happened on playback devices: ("write", data), and ("pause", frames),
+        # ("drop", frames) and ("close", frames) with the frames that were still queued and aren't played
+        self.playback_events = collections.deque(maxlen=PLAYBACK_EVENTS)
+
+    def seconds(self):
+        """ Seconds of audio captured so far """
+        return self.captured_frames / SAMPLE_RATE
+
+    def take(self, size):
+        """ The next size bytes of the source, padded with silence once it is exhausted """
+        while len(self.pending) < size:
+            data = next(self.source, None)
+            if data is None:
+                self.finished.set()
+                self.pending.extend(bytes(size - len(self.pending)))
+                break
+            self.pending.extend(data)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+
+backend = Backend()
+
+
+def install(source, speed=1.0, skew=0.0):
+    """ Make "import alsaaudio" return this module, capture devices read the periods of source
+
+    The capture clock runs speed times faster than real time, skew is the
+    relative deviation of the capture clock from the nominal rate.
+    """
+    global backend
+    backend = Backend()
+    backend.source = iter(source)
+    backend.speed = speed
+    backend.skew = skew
+    sys.modules["alsaaudio"] = sys.modules[__name__]
+    return backend
+
+
+def idle_descriptors():
+    """ Poll descriptors that are always ready, the devices pace themselves in read() """
+    fd = os.open(os.devnull, os.O_RDONLY)
+    return [(fd, select.POLLIN | select.POLLOUT)]
+
+
+class PCM():
+
+    def __init__(self, type=PCM_PLAYBACK, mode=PCM_NORMAL, device="default", **_kwargs):
+        if type == PCM_PLAYBACK:
+            with backend.lock:
+                busy = backend.busy_opens > 0
+                if busy:
+                    backend.busy_opens -= 1
+            if busy:
+                raise ALSAAudioError("Device or resource busy [{}]".format(device))
+        self.type = type
+        self.device = device
+        self.channels = CHANNELS
+        self.rate = SAMPLE_RATE
+        self.format = PCM_FORMAT_S32_LE
+        self.period_size = 32
+        self.started = None
+        self.frames = 0
+        self.descriptors = None
+
+    def setchannels(self, channels):
+        self.channels = channels
+        return channels
+
+    def setrate(self, rate):
+        self.rate = rate
+        return rate
+
+    def setformat(self, sample_format):
+        if sample_format != PCM_FORMAT_S32_LE:
+            raise ALSAAudioError("only S32_LE is supported")
+        return sample_format
+
+    def setperiodsize(self, period_size):
+        self.period_size = period_size
+        return period_size
+
+    def getformats(self):
+        return {"S32_LE": PCM_FORMAT_S32_LE}
+
+    def getrates(self):
+        return SAMPLE_RATE
+
+    def polldescriptors(self):
+        if self.descriptors is None:
+            self.descriptors = idle_descriptors()
+        return self.descriptors
+
+    def polldescriptors_revents(self, _descriptors):
+        return select.POLLIN | select.POLLOUT
+
+    def info(self):
+        return {"rate": self.rate, "channels": self.channels, "period_size": self.period_size,
+                "buffer_size": BUFFER_PERIODS * self.period_size}
+
+    def queued(self):
+        """ Frames written to a playback device that haven't been played yet """
+        if self.started is None:
+            return 0
+        return max(0, int(self.frames - (time.monotonic() - self.started) * self.clock_rate()))
+
+    def avail(self):
+        return BUFFER_PERIODS * self.period_size - self.queued()
+
+    def stop(self, event):
+        """ Playback starts over with the next write, queued audio is lost """
+        if self.type == PCM_PLAYBACK:
+            with backend.lock:
+                backend.playback_events.append((event, self.queued()))
+        self.started = None
+        self.frames = 0
+
+    def clock_rate(self):
+        if self.type == PCM_CAPTURE:
+            return self.rate * (1 + backend.skew) * backend.speed
+        return self.rate * backend.speed
+
+    def read(self):
+        """ Blocks until the next period is due on the capture clock """
+        while backend.stalled:
+            time.sleep(0.01)
+        if self.type in backend.failing:
+            raise ALSAAudioError("No such device")
+        if self.started is None:
+            self.started = time.monotonic()
+        due = self.started + self.frames / self.clock_rate()
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif -delay > BUFFER_PERIODS * self.period_size / self.clock_rate():
+            # The buffer has been full for a while, the device starts over and the audio in between is lost
+            self.started = None
+            self.frames = 0
+            with backend.lock:
+                backend.capture_overruns += 1
+            return -EPIPE, b""
+
+        data = backend.take(self.period_size * self.channels * 4)
+        frames = len(data) // (self.channels * 4)
+        self.frames += frames
+        with backend.lock:
+            backend.captured_frames += frames
+        return frames, data
+
+    def write(self, data):
+        """ Blocks until data fits into the buffer """
+        if self.type in backend.failing:
+            raise ALSAAudioError("No such device")
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        played = (now - self.started) * self.clock_rate()
+        if self.frames < played:
+            # The buffer has run empty, the device starts over
+            self.started = None
+            self.frames = 0
+            with backend.lock:
+                backend.playback_underruns += 1
+            return -EPIPE
+
+        frames = len(data) // (self.channels * 4)
+        delay = (self.frames + frames - BUFFER_PERIODS * self.period_size) / self.clock_rate() - (now - self.started)
+        if delay > 0:
+            time.sleep(delay)
+        self.frames += frames
+        with backend.lock:
+            backend.played_frames += frames
+            backend.playback_events.append(("write", bytes(data)))
+        return frames
+
+    def pause(self, enable=True):
+        # Playback starts over when it is resumed
+        if enable:
+            self.stop("pause")
+        return 0
+
+    def drop(self):
+        self.stop("drop")
+        return 0
+
+    def close(self):
+        self.stop("close")
+        if self.descriptors is not None:
+            for (fd, _events) in self.descriptors:
+                os.close(fd)
+            self.descriptors = None
+
+
+class Mixer():
+
+    def __init__(self, control="Master", device="default", **_kwargs):
+        self.control = control
+        self.device = device
+        self.volume = 100
+
+    def getvolume(self, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE):
+        if units == VOLUME_UNITS_DB:
+            return [int(2000 * math.log10(max(self.volume, 1) / 100))]
+        return [self.volume]
+
+    def setvolume(self, volume, channel=None, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE):
+        if units == VOLUME_UNITS_DB:
+            volume = int(100 * 10 ** (volume / 2000))
+        self.volume = volume
+
+    def getrange(self, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_RAW):
+        if units == VOLUME_UNITS_DB:
+            return [-4000, 0]
+        return [0, 100]
+
+    def polldescriptors(self):
+        return []
+
+    def handleevents(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+# Signal generator. Every generator yields periods of interleaved S32_LE
+# samples, levels are in dBFS.
+
+def amplitude(level):
+    return FULL_SCALE * 10 ** (level / 20)
+
+
+def encode(values):
+    samples = array("i" if array("i").itemsize == 4 else "l", values)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def periods(seconds, period_size, sample):
+    """ Yield periods of the values of sample(frame), a function of the frame index """
+    frames = int(seconds * SAMPLE_RATE)
+    for start in range(0, frames, period_size):
+        values = []
+        for frame in range(start, min(start + period_size, frames)):
+            value = max(-FULL_SCALE, min(FULL_SCALE - 1, int(sample(frame))))
+            values.extend([value] * CHANNELS)
+        yield encode(values)
+
+
+def silence(seconds, period_size=2048):
+    frames = int(seconds * SAMPLE_RATE)
+    for start in range(0, frames, period_size):
+        yield bytes(min(period_size, frames - start) * CHANNELS * 4)
+
+
+def noise(seconds, level=-60, period_size=2048, seed=0):
+    rnd = random.Random(seed)
+    peak = amplitude(level)
+    return periods(seconds, period_size, lambda _frame: rnd.uniform(-peak, peak))
+
+
+def tone(seconds, frequency=1000, level=-20, period_size=2048, skew=0.0):
+    """ A sine tone, skew shifts it like a capture clock that runs too fast or too slow """
+    peak = amplitude(level)
+    step = 2 * math.pi * frequency * (1 + skew) / SAMPLE_RATE
+    return periods(seconds, period_size, lambda frame: peak * math.sin(step * frame))
+
+
+def clicks(seconds, rate=1.0, level=-6, period_size=2048, seed=0):
+    """ Single sample clicks at random times on silence, rate per second on average """
+    rnd = random.Random(seed)
+    peak = amplitude(level)
+    probability = rate / SAMPLE_RATE
+    return periods(seconds, period_size, lambda _frame: peak if rnd.random() < probability else 0)
+
+
+def music(seconds, level=-20, period_size=2048, gap=0.3, gap_level=-90, seed=0, skew=0.0):
+    """ Bursts of tones and noise with short quiet gaps between them, like notes """
+    rnd = random.Random(seed)
+    noise_peak = amplitude(gap_level)
+    state = {"end": 0, "peak": 0.0, "step": 0.0}
+
+    def sample(frame):
+        if frame >= state["end"]:
+            if state["peak"] and rnd.random() < 0.3:
+                # A gap between notes
+                state["peak"] = 0.0
+                state["end"] = frame + int(rnd.uniform(0.05, gap) * SAMPLE_RATE)
+            else:
+                state["peak"] = amplitude(level - rnd.uniform(0, 12))
+                frequency = rnd.choice([110, 220, 330, 440, 660, 880])
+                state["step"] = 2 * math.pi * frequency * (1 + skew) / SAMPLE_RATE
+                state["end"] = frame + int(rnd.uniform(0.1, 0.6) * SAMPLE_RATE)
+        return state["peak"] * math.sin(state["step"] * frame) + rnd.uniform(-noise_peak, noise_peak)
+
+    return periods(seconds, period_size, sample)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import logging
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from collections import Counter
+
+# Pauses other players when alsaloop starts playing
+PAUSE_ALL_COMMAND = "/opt/hifiberry/bin/pause-all alsaloop"
+# Seconds after which a hook is killed
+HOOK_TIMEOUT = 10
+
+
+class HookRunner():
+    """ Runs the shell commands of start and stop hooks on a worker thread
+
+    Hooks run one after the other in the order they were requested, the
+    caller never waits for them. The command gets the event in the
+    ALSALOOP_EVENT environment variable. Commands that don't finish within
+    the timeout are killed together with their children.
+    """
+
+    def __init__(self, timeout=HOOK_TIMEOUT, listener=None, counters=None):
+        self.timeout = timeout
+        # Called on the hook thread with the command, its duration in seconds and its exit code
+        self.listener = listener
+        self.hooks = queue.Queue()
+        if counters is None:
+            counters = Counter()
+        self.counters = counters
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.hook_loop, name="hooks", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Waits for the running hook, hooks that haven't been started are dropped """
+        if self.thread is None:
+            return
+        while True:
+            try:
+                self.hooks.get_nowait()
+            except queue.Empty:
+                break
+        self.hooks.put(None)
+        self.thread.join(self.timeout + 1)
+        self.thread = None
+
+    def run(self, event, commands):
+        for command in commands:
+            self.hooks.put((event, command))
+
+    def hook_loop(self):
+        while True:
+            hook = self.hooks.get()
+            if hook is None:
+                return
+            (event, command) = hook
+            (duration, returncode) = self.execute(event, command)
+
+            if returncode is None:
+                self.counters["hook_timeouts"] += 1
+                logging.warning("%s hook %s killed after %.1f s", event, command, duration)
+            elif returncode != 0:
+                self.counters["hook_failures"] += 1
+                logging.warning("%s hook %s failed with %d after %.0f ms", event, command, returncode,
+                                duration * 1000)
+            else:
+                logging.info("%s hook %s finished in %.0f ms", event, command, duration * 1000)
+
+            if self.listener is not None:
+                self.listener(command, duration, returncode)
+
+    def execute(self, event, command):
+        """ Returns the duration and the exit code, which is None if the command was killed """
+        start = time.monotonic()
+        env = dict(os.environ, ALSALOOP_EVENT=event)
+        try:
+            process = subprocess.Popen(command, shell=True, env=env, start_new_session=True)
+        except OSError as e:
+            logging.warning("can't run %s hook %s: %s", event, command, e)
+            return time.monotonic() - start, -1
+
+        try:
+            returncode = process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            returncode = None
+        return time.monotonic() - start, returncode
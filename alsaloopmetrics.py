@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import os
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram():
+    """ Counts observed durations in fixed buckets """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last bucket counts everything above the largest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+class Metrics():
+    """ Timing histograms, counters and gauges of the stages of alsaloop
+
+    Each histogram is only written by the thread of its stage, so nothing
+    is locked. Readers might see a histogram in the middle of an update,
+    which is good enough for monitoring.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+        # Time of the last iteration of the loops whose jitter is measured
+        self.last_iteration = {}
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def iteration(self, name, now, interval):
+        """ Record how much the time since the last iteration of a loop deviates from its interval as name_jitter """
+        last = self.last_iteration.get(name)
+        self.last_iteration[name] = now
+        if last is not None:
+            self.observe(name + "_jitter", abs(now - last - interval))
+
+    def restart(self, name):
+        """ The next iteration of the loop doesn't follow the last one, e.g. after an overrun """
+        self.last_iteration.pop(name, None)
+
+    def snapshot(self, counters=None):
+        """ Flat name -> value mapping, counters are added to the counters of the metrics """
+        values = {}
+        for (name, value) in (Counter(self.counters) + Counter(counters or {})).items():
+            values[name + "_total"] = float(value)
+        for (name, histogram) in list(self.histograms.items()):
+            values[name + "_count"] = float(histogram.count)
+            values[name + "_seconds_sum"] = histogram.sum
+            values[name + "_seconds_max"] = histogram.max
+        values.update(self.gauges)
+        return values
+
+    def prometheus(self, counters=None):
+        """ The metrics in the Prometheus text format """
+        lines = []
+        for (name, value) in sorted((Counter(self.counters) + Counter(counters or {})).items()):
+            lines.append("# TYPE alsaloop_{}_total counter".format(name))
+            lines.append("alsaloop_{}_total {}".format(name, value))
+
+        for (name, histogram) in sorted(list(self.histograms.items())):
+            metric = "alsaloop_{}_seconds".format(name)
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append("{}_sum {}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+
+        for (name, value) in sorted(list(self.gauges.items())):
+            lines.append("# TYPE alsaloop_{} gauge".format(name))
+            lines.append("alsaloop_{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path, counters=None):
+        """ Write the metrics for the textfile collector of the node exporter, readers never see a partial file """
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "w") as textfile:
+            textfile.write(self.prometheus(counters))
+        os.replace(temporary, path)
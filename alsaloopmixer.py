@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import logging
+import select
+import threading
+import time
+
+import alsaaudio
+
+INPUT_MIXER_DEVICE = "hw:CARD=UAC2Gadget"
+INPUT_MIXER_CONTROL = "PCM"
+OUTPUT_MIXER_DEVICE = "hw:CARD=sndrpihifiberry"
+OUTPUT_MIXER_CONTROL = "DSPVolume"
+
+# How the capture volume set by the USB host is mapped to the output volume. "linear" copies the percentage of the
+# control ranges, "db" copies the attenuation in dB.
+VOLUME_CURVES = ["linear", "db"]
+# Exponent of the software volume for a percentage, like the mapped volume of alsamixer the amplitude is the cube
+# of the fraction, 50 % is -18 dB
+SOFTWARE_VOLUME_EXPONENT = 3
+
+
+class VolumeFollower():
+    """ Follows the capture volume of the UAC2 gadget with the volume of the output
+
+    Both mixers are opened once. A thread waits on the poll descriptors of
+    the input mixer and only sets the output volume if the capture volume
+    has changed. While the follower is disabled, changes are remembered and
+    applied when it is enabled again. With a gain stage, the volume is
+    applied in software with smooth ramps and the output mixer isn't used.
+    """
+
+    def __init__(self, curve="linear", poll_timeout=1000, metrics=None, gain_stage=None):
+        if curve not in VOLUME_CURVES:
+            raise ValueError("unknown volume curve {}".format(curve))
+        self.curve = curve
+        self.poll_timeout = poll_timeout
+        self.metrics = metrics
+        self.gain_stage = gain_stage
+        self.input_mixer = None
+        self.output_mixer = None
+        self.output_range = None
+        self.poller = None
+        # The input volume that has been applied to the output last
+        self.volume = None
+        self.enabled = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        try:
+            self.input_mixer = alsaaudio.Mixer(control=INPUT_MIXER_CONTROL, device=INPUT_MIXER_DEVICE)
+            if self.gain_stage is None:
+                self.output_mixer = alsaaudio.Mixer(control=OUTPUT_MIXER_CONTROL, device=OUTPUT_MIXER_DEVICE)
+            if self.curve == "db" and self.gain_stage is None:
+                self.output_range = self.output_mixer.getrange(alsaaudio.PCM_PLAYBACK,
+                                                               units=alsaaudio.VOLUME_UNITS_DB)
+        except alsaaudio.ALSAAudioError as e:
+            logging.warning("can't open the mixers, volume isn't synchronized: %s", e)
+            self.close()
+            return False
+
+        self.poller = select.poll()
+        for (fd, events) in self.input_mixer.polldescriptors():
+            self.poller.register(fd, events)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.follow_loop, name="mixer", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        self.enabled.set()
+        if self.thread is not None:
+            self.thread.join(self.poll_timeout / 1000 + 1)
+            self.thread = None
+        if self.gain_stage is not None:
+            self.gain_stage.set_volume(1.0)
+        self.close()
+
+    def close(self):
+        for mixer in (self.input_mixer, self.output_mixer):
+            if mixer is not None:
+                mixer.close()
+        self.input_mixer = None
+        self.output_mixer = None
+
+    def enable(self):
+        """ Follow the input volume, called when output starts """
+        self.enabled.set()
+
+    def disable(self):
+        self.enabled.clear()
+
+    def read_volume(self):
+        if self.curve == "db":
+            return self.input_mixer.getvolume(alsaaudio.PCM_CAPTURE, units=alsaaudio.VOLUME_UNITS_DB)[0]
+        return self.input_mixer.getvolume(alsaaudio.PCM_CAPTURE)[0]
+
+    def apply(self, volume):
+        if self.gain_stage is not None:
+            if self.curve == "db":
+                gain = 10 ** (volume / 2000)
+            else:
+                # A linear gain would leave most of the range too loud, volume controls are spaced in dB
+                gain = (volume / 100) ** SOFTWARE_VOLUME_EXPONENT
+            self.gain_stage.set_volume(gain)
+            logging.debug("software volume set to %.3f", gain)
+        elif self.curve == "db":
+            # Volumes in dB are in hundredths of a dB
+            self.output_mixer.setvolume(max(self.output_range[0], min(self.output_range[1], volume)),
+                                        units=alsaaudio.VOLUME_UNITS_DB)
+            logging.debug("output volume set to %.2f dB", volume / 100)
+        else:
+            self.output_mixer.setvolume(volume)
+            logging.debug("output volume set to %d%%", volume)
+
+    def follow_loop(self):
+        while self.running:
+            if not self.enabled.is_set():
+                self.enabled.wait(self.poll_timeout / 1000)
+                continue
+
+            try:
+                volume = self.read_volume()
+                if volume != self.volume:
+                    if self.metrics is not None:
+                        start = time.perf_counter()
+                        self.apply(volume)
+                        self.metrics.observe("mixer", time.perf_counter() - start)
+                    else:
+                        self.apply(volume)
+                    self.volume = volume
+
+                # Without poll descriptors, the volume is read once per poll timeout
+                if self.poller.poll(self.poll_timeout):
+                    self.input_mixer.handleevents()
+            except alsaaudio.ALSAAudioError as e:
+                logging.warning("mixer error, volume isn't synchronized anymore: %s", e)
+                self.running = False
@@ -28,13 +28,15 @@ import logging
 import time
 import threading
 import os
+import select
 import subprocess
 import signal
-import json
 
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
 import alsaloop
+import alsaloopconfig
+import alsaloopsupervisor
 
 alsaloopWrapper = None
 
@@ -44,6 +46,7 @@ try:
     using_gi_glib = True
 except ImportError:
     import glib as GLib
+    using_gi_glib = False
 
 identity = "alsaloop client"
 
@@ -52,6 +55,17 @@ PLAYBACK_PAUSED = "pause"
 PLAYBACK_PLAYING = "playing"
 PLAYBACK_UNKNOWN = "unkown"
 
+# Minimum time between two PropertiesChanged signals for the same property in seconds
+MIN_UPDATE_INTERVAL = 1.0
+# Properties with a different minimum interval, playback state changes are sent right away
+UPDATE_INTERVALS = {
+    "PlaybackStatus": 0,
+}
+# Range of the rates in Hz that clients can subscribe to Levels signals with. The engine measures once per period,
+# about 23 times per second.
+MIN_LEVEL_RATE = 0.1
+MAX_LEVEL_RATE = 25
+
 # python dbus bindings don't include annotations and properties
 MPRIS2_INTROSPECTION = """<node name="/org/mpris/MediaPlayer2">
   <interface name="org.freedesktop.DBus.Introspectable">
@@ -158,6 +172,27 @@ MPRIS2_INTROSPECTION = """<node name="/org/mpris/MediaPlayer2">
       <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
     </property>
   </interface>
+  <interface name="org.hifiberry.alsaloop">
+    <method name="Configure">
+      <arg direction="in" name="Settings" type="a{sv}"/>
+    </method>
+    <method name="Reload"/>
+    <method name="SubscribeLevels">
+      <arg direction="in" name="Rate" type="d"/>
+      <arg direction="out" name="Rate" type="d"/>
+    </method>
+    <method name="UnsubscribeLevels"/>
+    <signal name="Levels">
+      <arg name="Playing" type="b"/>
+      <arg name="Rms" type="d"/>
+      <arg name="Peak" type="d"/>
+      <arg name="ChannelRms" type="ad"/>
+      <arg name="ChannelPeak" type="ad"/>
+    </signal>
+    <property name="Metrics" type="a{sd}" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+    </property>
+  </interface>
 </node>"""
 
 
@@ -165,7 +200,7 @@ class ALSALoopWrapper(threading.Thread):
     """ Wrapper to handle internal alsaloop
     """
 
-    def __init__(self, auto_start = True):
+    def __init__(self, auto_start = True, external = False):
         super().__init__()
         self.playerid = None
         self.playback_status = "stopped"
@@ -184,12 +219,38 @@ class ALSALoopWrapper(threading.Thread):
         self.alsaloopclient = None
         
         self.alsaloopdb = 0
+        # Engine options from the configuration file, the others keep their defaults
+        self.options = {}
+
+        # alsaloop runs in this process unless external is set
+        self.external = external
+        self.engine = None
+        # Input level of the last report in dBFS
+        self.rms = None
+        self.peak = None
+        # Rate of the Levels signals in Hz, None without subscribers
+        self.level_rate = None
+
+        # Restarts alsaloop with a growing delay when it keeps failing, or right away when a sound device appears
+        self.backoff = alsaloopsupervisor.Backoff()
+        self.uevents = alsaloopsupervisor.UeventMonitor()
+        # Time of the last heartbeat of alsaloop, and since when it is down, None while it is running
+        self.heartbeat = time.monotonic()
+        self.down_since = None
+        # Set by reconfigure() when the external alsaloop is killed to start it with the new sensitivity
+        self.restart_requested = False
+        # Read end of the heartbeat pipe of the external alsaloop
+        self.heartbeat_fd = None
 
     def run(self):
         try:
             self.dbus_service = MPRISInterface()
+            self.uevents.open()
 
-            self.mainloop_external()
+            if self.external:
+                self.mainloop_external()
+            else:
+                self.mainloop_internal()
 
         except Exception as e:
             logging.error("Alsaloopwrapper thread exception: %s", e)
@@ -199,64 +260,267 @@ class ALSALoopWrapper(threading.Thread):
         sys.exit(1)
 
     def mainloop_external(self):
-        current_playback_status = None
         while True:
-            
-            if self.alsaloopclient is None:
-                cmdline = "python /opt/alsaloop/alsaloop.py {}".format(self.alsaloopdb)
-                logging.info("starting %s",cmdline)
-                self.alsaloopclient = \
-                    subprocess.Popen(cmdline,
-                                        bufsize=1,
-                                        stdout=subprocess.PIPE,
-                                        shell=True,
-                                        universal_newlines=True,
-                                        encoding="utf-8",
-                                        text=True)
-                logging.info("alsaloop now running in background")
-
-            # Check if alsaloop is still running
-            if self.alsaloopclient:
-                if self.alsaloopclient.poll() is not None:
-                    logging.warning("alsaloop died")
-                    self.playback_status = PLAYBACK_STOPPED
-                    self.alsaloopclient = None
-                    continue
-                    
-            line = self.alsaloopclient.stdout.readline()
-
-            parts=line.split(" ")
-            pbstatus_old = self.playback_status
-            if len(parts)>2:
-                if parts[0].lower()=="p":
-                    self.playback_status = PLAYBACK_PLAYING
-                elif parts[0]=="-":
-                    self.playback_status = PLAYBACK_STOPPED
-                    
-                # Ignore decibel for the moment
-                #try:
-                #    db = float(parts[1])
-                #except:
-                #    db = 0
-                
-            if self.playback_status != pbstatus_old:
-                logging.info("playback status changed from %s to %s",pbstatus_old, self.playback_status)
-            
-            # Playback status has changed, now inform DBUS
+            self.start_external()
+            self.watch_external()
+            if self.restart_requested:
+                self.restart_requested = False
+            else:
+                self.failed()
+
+    def start_external(self):
+        # The engine writes to this pipe every second, separate from the status lines on stdout
+        (heartbeat_read, heartbeat_write) = os.pipe()
+        cmdline = ["python", "/opt/alsaloop/alsaloop.py", str(self.alsaloopdb),
+                   "--heartbeat-fd", str(heartbeat_write)]
+        logging.info("starting %s", " ".join(cmdline))
+        self.alsaloopclient = subprocess.Popen(cmdline, stdout=subprocess.PIPE, bufsize=0,
+                                               pass_fds=(heartbeat_write,))
+        os.close(heartbeat_write)
+        self.heartbeat_fd = heartbeat_read
+        self.started()
+        logging.info("alsaloop now running in background")
+
+    def watch_external(self):
+        """ Reads status lines and heartbeats until the external alsaloop has died or hangs """
+        client = self.alsaloopclient
+        stdout = client.stdout.fileno()
+        pending = b""
+        try:
+            while True:
+                readable, _, _ = select.select([stdout, self.heartbeat_fd], [], [],
+                                               alsaloop.HEARTBEAT_INTERVAL)
+                if self.heartbeat_fd in readable and os.read(self.heartbeat_fd, 4096):
+                    self.alive()
+                if stdout in readable:
+                    data = os.read(stdout, 4096)
+                    if not data:
+                        break
+                    lines = (pending + data).split(b"\n")
+                    pending = lines.pop()
+                    for line in lines:
+                        self.parse_status(line.decode(errors="replace"))
+
+                if client.poll() is not None:
+                    break
+                if time.monotonic() - self.heartbeat > alsaloopsupervisor.HEARTBEAT_TIMEOUT:
+                    logging.error("no heartbeat or no captured audio from alsaloop for %.0f s, killing it",
+                                  time.monotonic() - self.heartbeat)
+                    break
+        finally:
+            client.kill()
+            returncode = client.wait()
+            client.stdout.close()
+            os.close(self.heartbeat_fd)
+            self.alsaloopclient = None
+            if not self.restart_requested:
+                logging.warning("alsaloop died with exit code %s", returncode)
+
+    def parse_status(self, line):
+        """ A status line of an external alsaloop, see alsaloop.print_level() """
+        parts = line.split(" ")
+        pbstatus_old = self.playback_status
+        if len(parts)>2:
+            if parts[0].lower()=="p":
+                self.playback_status = PLAYBACK_PLAYING
+            elif parts[0]=="-":
+                self.playback_status = PLAYBACK_STOPPED
+
+            # The level of all channels, followed by rms/peak of every channel
+            try:
+                self.rms = float(parts[1])
+                self.peak = float(parts[2])
+                channels = [tuple(float(value) for value in part.split("/")) for part in parts[3:] if part.strip()]
+                if self.level_rate is not None:
+                    self.dbus_service.send_levels(self.playback_status == PLAYBACK_PLAYING, self.rms,
+                                                  self.peak, channels)
+            except ValueError:
+                pass
+
+        if self.playback_status != pbstatus_old:
+            logging.info("playback status changed from %s to %s",pbstatus_old, self.playback_status)
+
+        # Playback status has changed, now inform DBUS
+        self.update_metadata()
+        self.dbus_service.update_property('org.mpris.MediaPlayer2.Player',
+                                          'PlaybackStatus')
+
+    def mainloop_internal(self):
+        # The engine is kept when it fails, it continues with its state, e.g. the output that was playing
+        self.engine = alsaloop.Engine(self.threshold(), **self.engine_options())
+        self.engine.add_listener(self.engine_event)
+        self.set_level_rate(self.level_rate)
+        GLib.timeout_add_seconds(alsaloop.HEARTBEAT_INTERVAL, self.check_heartbeat)
+        while True:
+            logging.info("starting alsaloop in process")
+            self.started()
+            try:
+                self.engine.run()
+            except Exception as e:
+                logging.warning("alsaloop died: %s", e)
+            self.failed()
+
+    def check_heartbeat(self):
+        """ Called on the main loop, a thread can't be killed, so a hung engine ends the process """
+        if self.down_since is None and time.monotonic() - self.heartbeat > alsaloopsupervisor.HEARTBEAT_TIMEOUT:
+            logging.error("no heartbeat or no captured audio from the alsaloop engine for %.0f s, exiting",
+                          time.monotonic() - self.heartbeat)
+            os._exit(1)
+        return True
+
+    def started(self):
+        self.backoff.started()
+        self.heartbeat = time.monotonic()
+        self.uevents.discard()
+
+    def alive(self):
+        self.heartbeat = time.monotonic()
+        if self.down_since is not None:
+            logging.info("alsaloop is running again after %.0f ms", (time.monotonic() - self.down_since) * 1000)
+            self.down_since = None
+
+    def failed(self):
+        """ Waits before alsaloop is started again
+
+        The playback status is only changed if it isn't running again within
+        STATE_GRACE, so a quick restart doesn't show up over MPRIS.
+        """
+        delay = self.backoff.failed()
+        if self.down_since is None:
+            down_since = time.monotonic()
+            self.down_since = down_since
+            GLib.timeout_add(int(alsaloopsupervisor.STATE_GRACE * 1000), self.state_expired, down_since)
+        logging.info("starting alsaloop again in %.2f s", delay)
+        if self.uevents.wait(delay):
+            logging.info("a sound device has been added, starting alsaloop right away")
+
+    def state_expired(self, down_since):
+        if self.down_since == down_since:
+            self.playback_status = PLAYBACK_STOPPED
             self.update_metadata()
             self.dbus_service.update_property('org.mpris.MediaPlayer2.Player',
-                                                  'PlaybackStatus')
+                                              'PlaybackStatus')
+        return False
+
+    def engine_event(self, event, values):
+        """ Called on the alsaloop thread """
+        if event == "heartbeat":
+            # An engine that doesn't capture anything anymore is hung like one without heartbeats
+            if values["capturing"]:
+                self.alive()
+            return
+        if event == "meter":
+            self.dbus_service.send_levels(values["playing"], values["rms"], values["peak"], values["channels"])
+            return
+        if event not in ("playback", "level"):
+            return
+
+        pbstatus_old = self.playback_status
+        if values["playing"]:
+            self.playback_status = PLAYBACK_PLAYING
+        elif self.engine is not None and self.engine.hold == "pause":
+            self.playback_status = PLAYBACK_PAUSED
+        else:
+            self.playback_status = PLAYBACK_STOPPED
 
+        if event == "level":
+            self.rms = values["rms"]
+            self.peak = values["peak"]
+
+        if self.playback_status != pbstatus_old:
+            logging.info("playback status changed from %s to %s",pbstatus_old, self.playback_status)
+
+        # Playback status has changed, now inform DBUS
+        self.update_metadata()
+        self.dbus_service.update_property('org.mpris.MediaPlayer2.Player',
+                                          'PlaybackStatus')
+
+    def control(self, command):
+        """ "play", "pause" or "stop" from DBus """
+        if self.engine is not None:
+            self.engine.control(command)
+        elif self.alsaloopclient is not None and command != "play":
+            # An external alsaloop can only be told to stop
+            self.alsaloopclient.send_signal(signal.SIGUSR1)
+        else:
+            logging.info("can't %s an external alsaloop", command)
+
+    def set_level_rate(self, rate):
+        """ Levels signals are sent rate times per second, None stops them """
+        self.level_rate = rate
+        if self.engine is not None:
+            if rate is None:
+                self.engine.meter_interval = None
+            else:
+                self.engine.meter_interval = 1 / rate
+
+    def threshold(self):
+        if self.auto_threshold():
+            return None
+        try:
+            return alsaloop.parse_threshold(self.alsaloopdb)
+        except ValueError:
+            logging.warning("invalid sensitivity %s, not detecting the input level", self.alsaloopdb)
+            return None
+
+    def engine_options(self):
+        options = dict(alsaloop.DEFAULT_OPTIONS)
+        options.update(self.options)
+        options["metrics"] = True
+        if self.auto_threshold():
+            options["auto_threshold"] = True
+        return options
+
+    def auto_threshold(self):
+        """ A sensitivity of "auto" derives the thresholds from the noise floor """
+        return str(self.alsaloopdb).lower() == "auto"
+
+    def configure(self, settings, update=False):
+        """ Apply settings from the configuration file or DBus, update keeps the settings that aren't given
+
+        Raises ValueError if a setting is invalid, alsaloop continues with the previous settings then.
+        """
+        sensitivity = self.alsaloopdb
+        options = {}
+        for (name, value) in settings.items():
+            if name == "sensitivity":
+                sensitivity = value
+            elif name in alsaloop.DEFAULT_OPTIONS:
+                options[name] = value
+            else:
+                logging.warning("ignoring unknown setting %s", name)
+
+        if str(sensitivity).lower() != "auto":
+            try:
+                alsaloop.parse_threshold(sensitivity)
+            except (TypeError, ValueError):
+                raise ValueError("invalid sensitivity {!r}".format(sensitivity))
+        # Converted like the command line options, also checked for an external alsaloop that doesn't get them
+        options = alsaloop.convert_options(options)
+        if update:
+            options = dict(self.options, **options)
+        alsaloop.check_options(dict(alsaloop.DEFAULT_OPTIONS, **options))
+
+        previous = (self.alsaloopdb, self.options)
+        (self.alsaloopdb, self.options) = (sensitivity, options)
+        try:
+            self.reconfigure()
+        except ValueError:
+            (self.alsaloopdb, self.options) = previous
+            raise
 
-            
     def reconfigure(self):
+        if self.engine is not None:
+            # Applied while audio keeps playing, the devices are only opened again if they have changed
+            self.engine.reconfigure(self.threshold(), **self.engine_options())
+
+        # Only the sensitivity is passed to an external alsaloop, it has to be restarted
         if self.alsaloopclient is not None:
+            self.restart_requested = True
             self.alsaloopclient.kill()
-            self.alsaloopclient = None
-            self.playback_status=PLAYBACK_UNKNOWN
             
     def update_metadata(self):
-        if self.alsaloopclient is not None:
+        if self.alsaloopclient is not None or self.engine is not None:
             self.metadata["xesam:url"] = \
                 "alsaloop://"
 
@@ -264,6 +528,11 @@ class ALSALoopWrapper(threading.Thread):
                                                   'Metadata')
 
 
+class InvalidSettings(dbus.exceptions.DBusException):
+    """ Returned to DBus callers that pass settings alsaloop can't use """
+    _dbus_error_name = "org.hifiberry.alsaloop.InvalidSettings"
+
+
 class MPRISInterface(dbus.service.Object):
     ''' The base object of an MPRIS player '''
 
@@ -271,11 +540,13 @@ class MPRISInterface(dbus.service.Object):
     INTROSPECT_INTERFACE = "org.freedesktop.DBus.Introspectable"
     PROP_INTERFACE = dbus.PROPERTIES_IFACE
 
-    def __init__(self):
-        dbus.service.Object.__init__(self, dbus.SystemBus(),
-                                     MPRISInterface.PATH)
+    def __init__(self, bus=None, min_interval=MIN_UPDATE_INTERVAL,
+                 intervals=UPDATE_INTERVALS):
+        if bus is None:
+            bus = dbus.SystemBus()
+        dbus.service.Object.__init__(self, bus, MPRISInterface.PATH)
         self.name = "org.mpris.MediaPlayer2.alsaloop"
-        self.bus = dbus.SystemBus()
+        self.bus = bus
         self.uname = self.bus.get_unique_name()
         self.dbus_obj = self.bus.get_object("org.freedesktop.DBus",
                                             "/org/freedesktop/DBus")
@@ -286,6 +557,26 @@ class MPRISInterface(dbus.service.Object):
         self.acquire_name()
         logging.info("name on DBus aqcuired")
 
+        # Values and times of the last PropertiesChanged signal of every
+        # (interface, property) and the properties that might have changed
+        # since. Signals are sent from the GLib main loop.
+        self.min_interval = min_interval
+        self.intervals = intervals
+        self.emitted = {}
+        self.emitted_at = {}
+        self.pending = set()
+        self.flush_scheduled = False
+        self.pending_lock = threading.Lock()
+        self.signal_count = 0
+
+        # Rates requested by the subscribers of the Levels signal by their
+        # unique name, and the watches that notice when they disconnect
+        self.level_rates = {}
+        self.level_watches = {}
+        self.pending_levels = None
+        self.levels_scheduled = False
+        self.level_signal_count = 0
+
     def name_owner_changed_callback(self, name, old_owner, new_owner):
         if name == self.name and old_owner == self.uname and new_owner != "":
             try:
@@ -343,12 +634,25 @@ class MPRISInterface(dbus.service.Object):
         "CanPlay": (True, None),
         "CanPause": (True, None),
         "CanSeek": (False, None),
-        "CanControl": (False, None),
+        "CanControl": (True, None),
+    }
+
+    def get_metrics():
+        # Timings and counters of the engine, empty with --external
+        metrics = {}
+        if alsaloop_wrapper.engine is not None:
+            metrics = alsaloop_wrapper.engine.metrics_snapshot()
+        return dbus.Dictionary(metrics, signature='sd')
+
+    ALSALOOP_INTERFACE = "org.hifiberry.alsaloop"
+    ALSALOOP_PROPS = {
+        "Metrics": (get_metrics, None),
     }
 
     PROP_MAPPING = {
         PLAYER_INTERFACE: PLAYER_PROPS,
         ROOT_INTERFACE: ROOT_PROPS,
+        ALSALOOP_INTERFACE: ALSALOOP_PROPS,
     }
 
     @dbus.service.signal(PROP_INTERFACE, signature="sa{sv}as")
@@ -382,75 +686,228 @@ class MPRISInterface(dbus.service.Object):
             read_props[key] = getter
         return read_props
 
-    def update_property(self, interface, prop):
+    def read_property(self, interface, prop):
         getter, _setter = self.PROP_MAPPING[interface][prop]
         if callable(getter):
-            value = getter()
-        else:
-            value = getter
-        logging.debug('Updated property: %s = %s' % (prop, value))
-        self.PropertiesChanged(interface, {prop: value}, [])
+            return getter()
+        return getter
+
+    def update_property(self, interface, prop):
+        """ Announce a property that might have changed, can be called from any thread
+
+        PropertiesChanged is only sent if the value differs from the last
+        one sent. Properties updated together are sent in one signal, and
+        not more often than their minimum interval.
+        """
+        value = self.read_property(interface, prop)
+        with self.pending_lock:
+            self.pending.add((interface, prop))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                GLib.idle_add(self.flush_properties)
         return value
 
-    # Player methods
+    def flush_properties(self):
+        now = time.monotonic()
+        changed = {}
+        next_due = None
+        with self.pending_lock:
+            self.flush_scheduled = False
+            for key in list(self.pending):
+                (interface, prop) = key
+                value = self.read_property(interface, prop)
+                if key in self.emitted and self.emitted[key] == value:
+                    self.pending.discard(key)
+                    continue
+
+                due = self.emitted_at.get(key, float("-inf")) + \
+                    self.intervals.get(prop, self.min_interval)
+                if due > now:
+                    # Sent again once the interval has passed
+                    if next_due is None or due < next_due:
+                        next_due = due
+                    continue
+
+                self.pending.discard(key)
+                self.emitted[key] = value
+                self.emitted_at[key] = now
+                changed.setdefault(interface, {})[prop] = value
+
+            if next_due is not None:
+                self.flush_scheduled = True
+                GLib.timeout_add(max(1, int((next_due - now) * 1000)),
+                                 self.flush_properties)
+
+        for interface, props in changed.items():
+            logging.debug('Updated properties: %s', props)
+            self.signal_count += 1
+            self.PropertiesChanged(interface, props, [])
+
+        # Don't repeat as a GLib source
+        return False
+
+    @dbus.service.method(ALSALOOP_INTERFACE, in_signature='a{sv}', out_signature='')
+    def Configure(self, settings):
+        """ Change settings until the configuration file is read again, fails if a setting is invalid """
+        logging.info("received DBUS configure %s", ", ".join(sorted(settings)))
+        try:
+            alsaloop_wrapper.configure(settings, update=True)
+        except ValueError as e:
+            logging.warning("rejected DBUS configure: %s", e)
+            raise InvalidSettings(str(e))
+
+    @dbus.service.method(ALSALOOP_INTERFACE, in_signature='', out_signature='')
+    def Reload(self):
+        logging.info("received DBUS reload")
+        if not parse_config(alsaloop_wrapper):
+            raise InvalidSettings("invalid settings in {}".format(alsaloopconfig.CONFIG_FILE))
+
+    @dbus.service.method(ALSALOOP_INTERFACE, in_signature='d', out_signature='d', sender_keyword='sender')
+    def SubscribeLevels(self, rate, sender=None):
+        """ Send Levels signals rate times per second until the caller unsubscribes or disconnects
+
+        Signals are broadcast at the highest rate any subscriber asked for.
+        Returns the rate of this subscription after clamping it.
+        """
+        rate = max(MIN_LEVEL_RATE, min(MAX_LEVEL_RATE, float(rate)))
+        logging.debug("%s subscribed to levels at %.1f Hz", sender, rate)
+        self.level_rates[sender] = rate
+        if sender not in self.level_watches:
+            self.level_watches[sender] = self.bus.watch_name_owner(
+                sender, lambda owner, sender=sender: self.level_subscriber_changed(sender, owner))
+        self.update_level_rate()
+        return rate
+
+    @dbus.service.method(ALSALOOP_INTERFACE, in_signature='', out_signature='', sender_keyword='sender')
+    def UnsubscribeLevels(self, sender=None):
+        self.unsubscribe_levels(sender)
+
+    def level_subscriber_changed(self, sender, owner):
+        if not owner:
+            logging.debug("level subscriber %s is gone", sender)
+            self.unsubscribe_levels(sender)
+
+    def unsubscribe_levels(self, sender):
+        self.level_rates.pop(sender, None)
+        watch = self.level_watches.pop(sender, None)
+        if watch is not None:
+            watch.cancel()
+        self.update_level_rate()
+
+    def update_level_rate(self):
+        if self.level_rates:
+            alsaloop_wrapper.set_level_rate(max(self.level_rates.values()))
+        else:
+            alsaloop_wrapper.set_level_rate(None)
+
+    @dbus.service.signal(ALSALOOP_INTERFACE, signature="bddadad")
+    def Levels(self, playing, rms, peak, channel_rms, channel_peak):
+        pass
+
+    def send_levels(self, playing, rms, peak, channels):
+        """ Send a Levels signal from the GLib main loop, can be called from any thread
+
+        Only the latest levels are sent if the main loop falls behind.
+        """
+        with self.pending_lock:
+            self.pending_levels = (playing, rms, peak, channels)
+            if not self.levels_scheduled:
+                self.levels_scheduled = True
+                GLib.idle_add(self.flush_levels)
+
+    def flush_levels(self):
+        with self.pending_lock:
+            levels = self.pending_levels
+            self.pending_levels = None
+            self.levels_scheduled = False
+
+        if levels is not None and self.level_rates:
+            (playing, rms, peak, channels) = levels
+            self.level_signal_count += 1
+            self.Levels(bool(playing), rms, peak,
+                        dbus.Array([channel_rms for (channel_rms, _peak) in channels], signature="d"),
+                        dbus.Array([channel_peak for (_rms, channel_peak) in channels], signature="d"))
+
+        # Don't repeat as a GLib source
+        return False
+
+    # Player methods, they start and stop the output right away
     @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
     def Pause(self):
         logging.debug("received DBUS pause")
-        alsaloop_wrapper.playback_status = PLAYBACK_STOPPED
-        return
+        alsaloop_wrapper.control("pause")
 
     @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
     def PlayPause(self):
         logging.debug("received DBUS play/pause")
-        status = alsaloop_wrapper.playback_status
-
-        if status == PLAYBACK_PLAYING:
-            alsaloop_wrapper.playback_status = PLAYBACK_STOPPED
+        if alsaloop_wrapper.playback_status == PLAYBACK_PLAYING:
+            alsaloop_wrapper.control("pause")
         else:
-            alsaloop_wrapper.playback_status = PLAYBACK_PLAYING
-        return
+            alsaloop_wrapper.control("play")
 
     @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
     def Stop(self):
         logging.debug("received DBUS stop")
-        alsaloop_wrapper.playback_status = PLAYBACK_STOPPED
-        return
+        alsaloop_wrapper.control("stop")
 
     @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
     def Play(self):
-        alsaloop_wrapper.playback_status = PLAYBACK_PLAYING
-        return
+        logging.debug("received DBUS play")
+        alsaloop_wrapper.control("play")
+
+
+def add_signal_handler(signum, handler):
+    """ Call handler() on the main loop when signum is received
+
+    A handler of the signal module would run in between the code of the
+    main thread, which might hold the locks of the engine at that moment.
+    """
+    def handle_unix_signal():
+        handler()
+        return True
 
+    def handle_idle():
+        handler()
+        return False
 
-def stop_alsaloop(_signalNumber, _frame):
+    if using_gi_glib:
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, handle_unix_signal)
+    else:
+        signal.signal(signum, lambda _signalNumber, _frame: GLib.idle_add(handle_idle))
+
+
+def stop_alsaloop():
     logging.info("received USR1, stopping alsaloop")
-    alsaloop_wrapper.playback_status = PLAYBACK_STOPPED
+    alsaloop_wrapper.control("pause")
 
 
-def reconfigure_alsaloop(_signalNumber, _frame):
+def reconfigure_alsaloop():
     logging.info("received HUP, reconfiguring alsaloop")
     parse_config(alsaloop_wrapper)
 
 
 def parse_config(alsaloop_wrapper, debugmode=False):
     try:
-        with open('/etc/alsaloop.json') as json_file:
-            data = json.load(json_file)
-            alsaloop_wrapper.alsaloopdb = data["sensitivity"]
-    except:
-        logging.info("couldn't read /etc/alsaloop.json, using default configuration")
-        
-    alsaloop_wrapper.reconfigure()
-    
+        settings = alsaloopconfig.read_config()
+    except (OSError, ValueError) as e:
+        logging.info("couldn't read %s (%s), using default configuration", alsaloopconfig.CONFIG_FILE, e)
+        settings = {}
+
+    try:
+        alsaloop_wrapper.configure(settings)
+    except ValueError as e:
+        logging.error("invalid settings in %s, keeping the previous ones: %s", alsaloopconfig.CONFIG_FILE, e)
+        return False
+    return True
+
 
 if __name__ == '__main__':
     DBusGMainLoop(set_as_default=True)
 
-    if len(sys.argv) > 1:
-        if "-v" in sys.argv:
-            logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
-                                level=logging.DEBUG)
-            logging.debug("enabled verbose logging")
+    if "-v" in sys.argv:
+        logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
+                            level=logging.DEBUG)
+        logging.debug("enabled verbose logging")
     else:
         logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
                             level=logging.INFO)
@@ -458,16 +915,20 @@ if __name__ == '__main__':
     # Set up the main loop
     loop = GLib.MainLoop()
 
-    signal.signal(signal.SIGUSR1, stop_alsaloop)
-    signal.signal(signal.SIGHUP, reconfigure_alsaloop)
+    add_signal_handler(signal.SIGUSR1, stop_alsaloop)
+    add_signal_handler(signal.SIGHUP, reconfigure_alsaloop)
 
     server = "192.168.30.110"
 
     # Create wrapper to manages the alsaloop child process
     try:
-        alsaloop_wrapper = ALSALoopWrapper()
+        # --external runs alsaloop.py as a child process like older versions
+        alsaloop_wrapper = ALSALoopWrapper(external="--external" in sys.argv)
         parse_config(alsaloop_wrapper)
         alsaloop_wrapper.start()
+        # Changes of the configuration file are applied right away
+        config_watcher = alsaloopconfig.ConfigWatcher(lambda: parse_config(alsaloop_wrapper))
+        config_watcher.start()
         logging.info("alsaloop wrapper thread started")
     except dbus.exceptions.DBusException as e:
         logging.error("DBUS error: %s", e)
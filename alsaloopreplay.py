@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# Feeds a capture tap (see alsalooptap.py) or a WAV file through the meter
+# and the detector of alsaloop, as fast as possible, and prints when output
+# would have started and stopped. This is used to tune the detection
+# options offline:
+#
+#   python alsaloopreplay.py /var/lib/alsaloop/tap 45 --release 5000
+#
+# For a tap file, the decisions alsaloop made while recording are printed
+# as well. Without a threshold, the start threshold that was recorded is used.
+
+import argparse
+import json
+import math
+import sys
+import time
+import wave
+
+import alsaloopconfig
+import alsaloopdetect
+import alsaloopdsp
+import alsalooptap
+
+PERIOD_SIZE = 2048
+# Sample formats of WAV files by sample width in bytes, 8 bit samples are unsigned and not supported
+WAV_FORMATS = {
+    2: "S16_LE",
+    3: "S24_3LE",
+    4: "S32_LE",
+}
+
+
+class Recording():
+    """ Captured audio read from a tap or a WAV file """
+
+    def __init__(self, sample_format, channels, rate, period_size, periods, recorded=None, start_time=None,
+                 threshold=None):
+        self.sample_format = sample_format
+        self.channels = channels
+        self.rate = rate
+        self.period_size = period_size
+        self.periods = periods
+        # Decisions of alsaloop while the tap was written as (seconds, active)
+        self.recorded = recorded
+        self.start_time = start_time
+        # The start threshold while the tap was written
+        self.threshold = threshold
+
+
+def read_recording(path):
+    try:
+        return read_tap(path)
+    except ValueError:
+        pass
+    return read_wav(path)
+
+
+def read_tap(path):
+    (info, periods) = alsalooptap.read_tap(path)
+    rate = info["rate"]
+    recorded = []
+    threshold = None
+    frames = 0
+    active = None
+    for period in periods:
+        frames += period.frames
+        if active is not None and period.active != active:
+            recorded.append((frames / rate, period.active))
+        active = period.active
+        if not period.active and not math.isnan(period.threshold):
+            threshold = period.threshold
+
+    start_time = None
+    if info["written_at"]:
+        start_time = info["written_at"] - frames / rate
+    return Recording(alsaloopdsp.FORMATS[info["format"]], info["channels"], rate, info["period_size"],
+                     [period.data for period in periods], recorded, start_time, threshold)
+
+
+def read_wav(path, period_size=PERIOD_SIZE):
+    try:
+        with wave.open(path, "rb") as wav:
+            width = wav.getsampwidth()
+            if width not in WAV_FORMATS:
+                raise ValueError("{} has {} bit samples, only 16, 24 and 32 bit are supported".format(path, 8 * width))
+            periods = []
+            while True:
+                data = wav.readframes(period_size)
+                if not data:
+                    break
+                periods.append(data)
+            return Recording(alsaloopdsp.FORMATS[WAV_FORMATS[width]], wav.getnchannels(), wav.getframerate(),
+                             period_size, periods)
+    except wave.Error as e:
+        raise ValueError("{} is neither a tap nor a WAV file: {}".format(path, e))
+
+
+def replay(recording, meter, detector):
+    """ Returns the decisions of the detector as (seconds, active) and the seconds of audio """
+    decisions = []
+    frames = 0
+    for data in recording.periods:
+        (count, square_sums, peaks) = meter.measure_channels(data)
+        frames += count
+        # The detector decides at the end of a period
+        if detector.update(count, square_sums, peaks, count):
+            decisions.append((frames / recording.rate, detector.active))
+    return decisions, frames / recording.rate
+
+
+def create_meter(recording, args):
+    if args.weighting != "none":
+        return alsaloopdsp.WeightedMeter(recording.sample_format, recording.channels, recording.rate, args.weighting,
+                                         args.band_low, args.band_high)
+    return alsaloopdsp.create_meter(args.meter, recording.sample_format, recording.channels)
+
+
+def describe(decisions):
+    return [(round(seconds, 3), "start" if active else "stop") for (seconds, active) in decisions]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run a capture tap or a WAV file through the alsaloop detection")
+    parser.add_argument("file", help="tap file written by alsaloop --tap-file, or a WAV file")
+    parser.add_argument("threshold", nargs="?",
+                        help="input level in dB that starts playback, default: the threshold recorded in the tap")
+    parser.add_argument("--meter", default="auto", choices=["auto"] + sorted(alsaloopdsp.METERS),
+                        help="implementation used to measure the input level")
+    parser.add_argument("--window", type=float, default=alsaloopdetect.DETECTION_WINDOW,
+                        help="length of the sliding window over which the input level is measured in milliseconds")
+    parser.add_argument("--attack", type=float, default=alsaloopdetect.ATTACK_TIME,
+                        help="milliseconds the input has to exceed the threshold before output starts")
+    parser.add_argument("--release", type=float, default=alsaloopdetect.RELEASE_TIME,
+                        help="milliseconds the input has to stay below the threshold before output stops")
+    parser.add_argument("--hysteresis", type=float, default=alsaloopdetect.HYSTERESIS,
+                        help="dB between the start and the stop threshold")
+    parser.add_argument("--weighting", default="none", choices=["none"] + alsaloopdsp.WEIGHTINGS,
+                        help="frequency weighting applied before the level is measured, requires numpy")
+    parser.add_argument("--band-low", type=float, default=alsaloopdsp.BAND_LOW,
+                        help="lower corner frequency of the band weighting in Hz")
+    parser.add_argument("--band-high", type=float, default=alsaloopdsp.BAND_HIGH,
+                        help="upper corner frequency of the band weighting in Hz")
+    parser.add_argument("--detect-on", default="peak", choices=alsaloopdetect.DETECTION_MODES,
+                        help="level compared against the threshold")
+    parser.add_argument("--crest-min", type=float, default=alsaloopdetect.CREST_MIN,
+                        help="lowest crest factor in dB that counts as music")
+    parser.add_argument("--crest-max", type=float, default=alsaloopdetect.CREST_MAX,
+                        help="highest crest factor in dB that counts as music")
+    parser.add_argument("--crest-rms", type=float, default=alsaloopdetect.CREST_RMS,
+                        help="RMS in dBFS above which a signal counts in the crest mode whatever its crest factor")
+    parser.add_argument("--auto-threshold", action="store_true",
+                        help="derive the thresholds from the noise floor of the recording")
+    parser.add_argument("--start-margin", type=float, default=alsaloopdetect.START_MARGIN,
+                        help="dB above the noise floor that start playback with --auto-threshold")
+    parser.add_argument("--stop-margin", type=float, default=alsaloopdetect.STOP_MARGIN,
+                        help="dB above the noise floor below which playback stops with --auto-threshold")
+    parser.add_argument("--noise-file",
+                        help="start with the noise floor saved by alsaloop instead of calibrating on the recording")
+    parser.add_argument("--channel-policy", default="any", choices=alsaloopdetect.CHANNEL_POLICIES,
+                        help="whether any or all of the channels in the mask need a signal to start playback")
+    parser.add_argument("--channel-mask", type=alsaloopconfig.parse_numbers,
+                        help="channels that are checked for a signal counting from 0, default: all")
+    parser.add_argument("--json", action="store_true",
+                        help="print the decisions as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    try:
+        recording = read_recording(args.file)
+    except (OSError, ValueError) as e:
+        sys.exit("can't read {}: {}".format(args.file, e))
+
+    noise_floor = None
+    if args.auto_threshold:
+        noise_floor = alsaloopdetect.NoiseFloor()
+        if args.noise_file:
+            try:
+                noise_floor.load(args.noise_file)
+            except (OSError, ValueError) as e:
+                sys.exit("can't read the noise floor from {}: {}".format(args.noise_file, e))
+
+    if args.threshold is not None:
+        threshold = alsaloopdetect.parse_threshold(args.threshold)
+    elif recording.threshold is not None:
+        threshold = recording.threshold
+    elif noise_floor is not None:
+        threshold = None
+    else:
+        sys.exit("no threshold given and none recorded in {}".format(args.file))
+
+    meter = create_meter(recording, args)
+    detector = alsaloopdetect.Detector(threshold, recording.sample_format.full_scale, recording.rate,
+                                       recording.period_size, hysteresis=args.hysteresis, window=args.window,
+                                       attack=args.attack, release=args.release, mode=args.detect_on,
+                                       crest_min=args.crest_min, crest_max=args.crest_max, crest_rms=args.crest_rms,
+                                       channels=recording.channels, policy=args.channel_policy,
+                                       mask=args.channel_mask, noise_floor=noise_floor,
+                                       start_margin=args.start_margin, stop_margin=args.stop_margin)
+    start = time.process_time()
+    (decisions, seconds) = replay(recording, meter, detector)
+    used = time.process_time() - start
+
+    result = {
+        "file": args.file,
+        "format": recording.sample_format.name,
+        "channels": recording.channels,
+        "rate": recording.rate,
+        "threshold": detector.start_threshold,
+        "seconds": seconds,
+        "speed": seconds / used if used else None,
+        "start_time": recording.start_time,
+        "decisions": describe(decisions),
+    }
+    if recording.recorded is not None:
+        result["recorded"] = describe(recording.recorded)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    if detector.start_threshold is None:
+        threshold = "off"
+    else:
+        threshold = "{:.1f} dB".format(detector.start_threshold)
+    print("{}: {:.1f} s of {} {} ch at {} Hz, threshold {}, replayed {:.0f}x faster than real time".format(
+        args.file, seconds, recording.sample_format, recording.channels, recording.rate, threshold,
+        result["speed"] or float("inf")))
+    if noise_floor is not None and noise_floor.level is not None:
+        print("noise floor {:.1f} dBFS, stop threshold {:.1f} dB".format(noise_floor.level, detector.stop_threshold))
+    if recording.start_time is not None:
+        print("recorded from {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(recording.start_time))))
+    for (name, values) in (("replayed", result["decisions"]), ("recorded", result.get("recorded"))):
+        if values is None:
+            continue
+        print("{}:".format(name))
+        for (at, decision) in values:
+            print("  {:10.3f} s  {}".format(at, decision))
+        if not values:
+            print("  no changes")
+
+
+if __name__ == '__main__':
+    main()
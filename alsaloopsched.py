@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# Real-time mode: the capture and playback threads run with the SCHED_FIFO
+# policy, so other processes can't delay them, optionally on dedicated
+# CPUs. Memory is locked so it can't be paged out, the garbage collector
+# ignores the objects that exist after the warm-up and log records are
+# written by a thread of their own. Linux only, the process needs
+# CAP_SYS_NICE and CAP_IPC_LOCK or large enough RLIMIT_RTPRIO and
+# RLIMIT_MEMLOCK limits.
+
+import ctypes
+import ctypes.util
+import gc
+import logging
+import logging.handlers
+import os
+import queue
+
+# SCHED_FIFO priority of the capture and playback threads, above the usual priority of the audio interrupt threads
+RT_PRIORITY = 70
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# Writes the records of the QueueHandler, set up once per process
+log_listener = None
+
+
+def realtime_thread(priority=RT_PRIORITY, cpus=None):
+    """ Make the calling thread a SCHED_FIFO thread, returns False if that isn't allowed """
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, AttributeError) as e:
+        logging.warning("can't set real-time priority %d: %s", priority, e)
+        return False
+    return True
+
+
+def lock_memory():
+    """ Keep the memory of the process in RAM, returns False if that isn't allowed """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            logging.warning("can't lock memory: %s", os.strerror(ctypes.get_errno()))
+            return False
+    except (OSError, AttributeError) as e:
+        logging.warning("can't lock memory: %s", e)
+        return False
+    return True
+
+
+def freeze_gc():
+    """ Called after the warm-up, the garbage collector won't scan the objects that exist now anymore """
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def log_in_background():
+    """ Hand log records to a thread that writes them, so logging can't block the audio threads """
+    global log_listener
+    if log_listener is not None:
+        return
+
+    root = logging.getLogger()
+    handlers = root.handlers or [logging.lastResort]
+    records = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    log_listener.start()
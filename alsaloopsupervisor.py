@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import logging
+import os
+import random
+import select
+import socket
+import time
+
+# Seconds before alsaloop is started again after it has failed, doubled with every failure up to MAX_BACKOFF
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 30
+# Part of the delay that is random, so restarts don't keep hitting the same moment
+BACKOFF_JITTER = 0.5
+# After running for this many seconds, the next failure restarts after MIN_BACKOFF again
+HEALTHY_RUN = 60
+# Seconds without a heartbeat after which alsaloop is considered hung
+HEARTBEAT_TIMEOUT = 10
+# Seconds the last playback status is kept after a failure, a restart within this time doesn't change it
+STATE_GRACE = 3
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group of the uevents sent by the kernel
+UEVENT_KERNEL_GROUP = 1
+
+
+class Backoff():
+    """ Exponential backoff with jitter between the restarts of a process that keeps failing """
+
+    def __init__(self, minimum=MIN_BACKOFF, maximum=MAX_BACKOFF, jitter=BACKOFF_JITTER, healthy=HEALTHY_RUN):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.jitter = jitter
+        self.healthy = healthy
+        self.failures = 0
+        self.started_at = None
+
+    def started(self):
+        self.started_at = time.monotonic()
+
+    def reset(self):
+        """ Start over with the shortest delay, e.g. after an attempt has succeeded """
+        self.failures = 0
+
+    def failed(self):
+        """ Returns the seconds to wait before starting again """
+        if self.started_at is not None and time.monotonic() - self.started_at >= self.healthy:
+            self.failures = 0
+        delay = min(self.maximum, self.minimum * 2 ** self.failures)
+        self.failures += 1
+        return delay * (1 - self.jitter * random.random())
+
+
+def parse_uevent(data):
+    """ The action and the properties of a kernel uevent """
+    lines = data.split(b"\0")
+    (action, _, _) = lines[0].partition(b"@")
+    properties = {}
+    for line in lines[1:]:
+        (name, separator, value) = line.partition(b"=")
+        if separator:
+            properties[name.decode(errors="replace")] = value.decode(errors="replace")
+    return action.decode(errors="replace"), properties
+
+
+class UeventMonitor():
+    """ Notices sound devices that are added, e.g. the UAC2 gadget when the USB host connects again
+
+    Kernel uevents are read from a netlink socket. Without netlink, wait()
+    just sleeps.
+    """
+
+    def __init__(self, subsystem="sound"):
+        self.subsystem = subsystem
+        self.socket = None
+
+    def open(self):
+        try:
+            self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                                        NETLINK_KOBJECT_UEVENT)
+            self.socket.bind((0, UEVENT_KERNEL_GROUP))
+        except (OSError, AttributeError) as e:
+            logging.info("can't receive uevents, not restarting when a sound device is added: %s", e)
+            self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def device_added(self):
+        """ Reads the pending uevents, returns True if a device of the subsystem has been added """
+        added = False
+        while select.select([self.socket], [], [], 0)[0]:
+            try:
+                data = self.socket.recv(16384)
+            except OSError as e:
+                # ENOBUFS if events have been lost while nobody was reading
+                logging.debug("reading uevents failed: %s", e)
+                continue
+            (action, properties) = parse_uevent(data)
+            if action == "add" and properties.get("SUBSYSTEM") == self.subsystem:
+                logging.info("%s device %s added", self.subsystem, properties.get("DEVNAME", properties.get("DEVPATH")))
+                added = True
+        return added
+
+    def discard(self):
+        """ Forget the uevents received while alsaloop was running """
+        if self.socket is not None:
+            self.device_added()
+
+    def wait(self, timeout):
+        """ Waits up to timeout seconds, returns True early if a device of the subsystem has been added """
+        if self.socket is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([self.socket], [], [], remaining)[0] and self.device_added():
+                return True
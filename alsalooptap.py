@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2020 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# The capture tap keeps the last minutes of captured audio and of the levels
+# the detector saw in a ring file, so problems reported later can be
+# replayed with alsaloopreplay.py. The file has a fixed size and is written
+# through mmap, adding a period doesn't need a system call. Layout:
+#
+#   HEADER at offset 0, padded to PAGE_SIZE
+#   capacity RECORDs, the frames and levels of every period
+#   capacity slots of one period of audio, page aligned
+#
+# Period n is stored in record and slot n % capacity. periods_written is
+# updated after the period has been stored. Captured periods that are larger
+# than a slot, e.g. in the idle mode, are split over several slots, every
+# record holds the frames stored in its slot.
+
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"ALSALOOPTAP\0"
+VERSION = 1
+# Seconds of audio kept in the tap file
+TAP_SECONDS = 300
+PAGE_SIZE = mmap.PAGESIZE
+
+# magic, version, sample format, channels, rate, period size, frame size, capacity, periods written, time of the last
+# period
+HEADER = struct.Struct("<12sI16sIIIIIQd")
+PERIODS_WRITTEN_OFFSET = struct.calcsize("<12sI16sIIIII")
+# Frames, RMS and peak of the detection window in dBFS, the threshold that applied (NaN if there is none) and
+# whether the detector was active after the period
+RECORD = struct.Struct("<IfffB3x")
+
+
+def page_align(size):
+    return (size + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+class TapLayout():
+    """ Offsets in a tap file """
+
+    def __init__(self, slot_size, capacity):
+        self.slot_size = slot_size
+        self.capacity = capacity
+        self.records_offset = page_align(HEADER.size)
+        self.slots_offset = page_align(self.records_offset + capacity * RECORD.size)
+        self.size = self.slots_offset + capacity * slot_size
+
+    def record(self, period):
+        return self.records_offset + (period % self.capacity) * RECORD.size
+
+    def slot(self, period):
+        return self.slots_offset + (period % self.capacity) * self.slot_size
+
+
+class Tap():
+    """ Writes captured periods and the levels of the detector to a ring file
+
+    The file is created with its full size when the tap is opened, older
+    periods are overwritten once it is full. An existing file with the same
+    format, e.g. after alsaloop has been restarted, is continued, otherwise
+    it is started over.
+    """
+
+    def __init__(self, path, sample_format, channels, rate, period_size, seconds=TAP_SECONDS):
+        frame_size = channels * sample_format.width
+        capacity = max(1, int(seconds * rate / period_size + 0.5))
+        self.layout = TapLayout(period_size * frame_size, capacity)
+        self.frame_size = frame_size
+        self.path = path
+        self.header = [MAGIC, VERSION, sample_format.name.encode(), channels, rate, period_size, frame_size, capacity]
+        self.periods_written = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size == self.layout.size
+            if not existing:
+                os.ftruncate(fd, self.layout.size)
+            self.map = mmap.mmap(fd, self.layout.size)
+        finally:
+            os.close(fd)
+        header = HEADER.pack(*self.header, 0, 0.0)
+        if existing and self.map[:PERIODS_WRITTEN_OFFSET] == header[:PERIODS_WRITTEN_OFFSET]:
+            (self.periods_written,) = struct.unpack_from("<Q", self.map, PERIODS_WRITTEN_OFFSET)
+        else:
+            self.map[:HEADER.size] = header
+
+    def write(self, data, frames, rms, peak, threshold, active):
+        data = memoryview(data).cast("B")[:frames * self.frame_size]
+        if threshold is None:
+            threshold = float("nan")
+        for start in range(0, len(data), self.layout.slot_size):
+            chunk = data[start:start + self.layout.slot_size]
+            period = self.periods_written
+            slot = self.layout.slot(period)
+            self.map[slot:slot + len(chunk)] = chunk
+            RECORD.pack_into(self.map, self.layout.record(period), len(chunk) // self.frame_size, rms, peak,
+                             threshold, active)
+            self.periods_written = period + 1
+        struct.pack_into("<Qd", self.map, PERIODS_WRITTEN_OFFSET, self.periods_written, time.time())
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class TapPeriod():
+    """ A period read from a tap file """
+
+    def __init__(self, data, frames, rms, peak, threshold, active):
+        self.data = data
+        self.frames = frames
+        self.rms = rms
+        self.peak = peak
+        self.threshold = threshold
+        self.active = active
+
+
+def read_tap(path):
+    """ Returns the header values of a tap file as a dict and its periods, the oldest first
+
+    The file is mapped like the writer does, the data of every period is a
+    view of its slot that is only read from the file when it is used.
+    """
+    with open(path, "rb") as tap_file:
+        if os.fstat(tap_file.fileno()).st_size < HEADER.size:
+            raise ValueError("{} isn't a tap file".format(path))
+        contents = mmap.mmap(tap_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, format_name, channels, rate, period_size, frame_size, capacity, periods_written,
+     written_at) = HEADER.unpack_from(contents, 0)
+    if magic != MAGIC:
+        raise ValueError("{} isn't a tap file".format(path))
+    if version != VERSION:
+        raise ValueError("{} has version {}, expected {}".format(path, version, VERSION))
+    layout = TapLayout(period_size * frame_size, capacity)
+    if len(contents) < layout.size:
+        raise ValueError("{} is truncated".format(path))
+
+    info = {
+        "format": format_name.rstrip(b"\0").decode(),
+        "channels": channels,
+        "rate": rate,
+        "period_size": period_size,
+        "periods_written": periods_written,
+        "written_at": written_at,
+    }
+    view = memoryview(contents)
+    periods = []
+    for period in range(max(0, periods_written - capacity), periods_written):
+        (frames, rms, peak, threshold, active) = RECORD.unpack_from(contents, layout.record(period))
+        slot = layout.slot(period)
+        data = view[slot:slot + min(layout.slot_size, frames * frame_size)]
+        periods.append(TapPeriod(data, frames, rms, peak, threshold, bool(active)))
+    return info, periods
@@ -0,0 +1,367 @@
+import itertools
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from array import array
+
+import pytest
+
+import alsaloopfake
+
+alsaloopfake.install([])
+import alsaloop  # noqa: E402
+import alsaloopdetect  # noqa: E402
+import alsaloopreplay  # noqa: E402
+import alsalooptap  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs alsaloop.py on the fake backend, capturing a continuous tone ten times faster than real time
+CLI = """
+import runpy, sys
+import alsaloopfake
+alsaloopfake.install(alsaloopfake.tone(600), speed=10)
+sys.argv = ["alsaloop.py"] + sys.argv[1:]
+runpy.run_path("alsaloop.py", run_name="__main__")
+"""
+
+
+def read_status(process, timeout):
+    """ The next status line of alsaloop.py, None if there is none within timeout seconds """
+    readable, _, _ = select.select([process.stdout], [], [], timeout)
+    if not readable:
+        return None
+    return process.stdout.readline().decode()
+
+
+def wait_for_status(process, status, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = read_status(process, deadline - time.monotonic())
+        if line and line.split(" ")[0] == status:
+            return True
+    return False
+
+
+def test_usr1_pauses_output():
+    process = subprocess.Popen([sys.executable, "-c", CLI, "-40", "--start-hook", "true"], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        assert wait_for_status(process, "P")
+        process.send_signal(signal.SIGUSR1)
+        assert wait_for_status(process, "-")
+        # The tone continues, output stays paused and alsaloop keeps running
+        for _i in range(3):
+            line = read_status(process, 5)
+            assert line is not None and line.startswith("- ")
+        assert process.poll() is None
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_idle_tap_keeps_every_frame(tmp_path):
+    tap_file = str(tmp_path / "tap")
+    backend = alsaloopfake.install(alsaloopfake.silence(20), speed=10)
+    engine = alsaloop.Engine(-40, start_hooks=[], idle_period=8192, idle_delay=0.2, tap_file=tap_file,
+                             tap_seconds=30)
+    engine.start()
+    assert backend.finished.wait(10)
+    engine.stop()
+
+    (info, periods) = alsalooptap.read_tap(tap_file)
+    frame_size = info["channels"] * 4
+    assert max(period.frames for period in periods) == alsaloop.PERIOD_SIZE
+    assert all(len(period.data) == period.frames * frame_size for period in periods)
+    # Only the last periods captured before the engine stopped may not have been analysed
+    frames = sum(period.frames for period in periods)
+    assert backend.seconds() - 1 < frames / info["rate"] <= backend.seconds()
+
+    recording = alsaloopreplay.read_tap(tap_file)
+    assert sum(len(data) for data in recording.periods) == frames * frame_size
+
+
+def test_detector_window_follows_period_size():
+    detector = alsaloopdetect.Detector(-40, alsaloopfake.FULL_SCALE, alsaloopfake.SAMPLE_RATE, 2048, window=200)
+    for peak in range(5):
+        detector.update(2048, [0, 0], [peak, peak], 2048)
+    assert len(detector.peaks) == 5
+    detector.set_period_size(8192)
+    assert detector.peaks == [[4, 4]]
+    detector.set_period_size(2048)
+    assert detector.peaks == [[0, 0]] * 4 + [[4, 4]]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_buffering_and_fades_change_without_restart():
+    alsaloopfake.install(alsaloopfake.tone(60), speed=10)
+    engine = alsaloop.Engine(-40, start_hooks=[])
+    events = []
+    engine.add_listener(lambda event, values: event == "playback" and events.append(values["playing"]))
+    engine.start()
+    try:
+        assert wait_until(lambda: engine.playing)
+        pipeline = engine.pipeline
+        engine.reconfigure(-40, start_hooks=[], latency=150, high_watermark=500, fade_time=5, volume_ramp=10,
+                           idle_period=8192)
+        assert wait_until(lambda: pipeline.fade_time == 5)
+        assert engine.pipeline is pipeline and engine.playing
+        assert pipeline.target_fill == pipeline.milliseconds_to_bytes(150)
+        assert pipeline.idle_period == 8192
+        if pipeline.gain is not None:
+            assert pipeline.gain.fade.frames == 240
+        assert events == [True]
+    finally:
+        engine.stop()
+
+
+def test_reconfigure_converts_strings():
+    alsaloopfake.install(alsaloopfake.tone(60), speed=10)
+    engine = alsaloop.Engine(-40, start_hooks=[])
+    engine.start()
+    try:
+        assert wait_until(lambda: engine.playing)
+        engine.reconfigure("40", start_hooks=[], channel_mask="0,1", release="5000", detect_on="rms",
+                           drift_compensation="false")
+        assert engine.options["channel_mask"] == [0, 1]
+        assert engine.options["release"] == 5000.0
+        assert engine.threshold == -40
+        time.sleep(0.5)
+        assert engine.thread.is_alive() and engine.playing
+    finally:
+        engine.stop()
+
+
+def test_reconfigure_rejects_invalid_values():
+    engine = alsaloop.Engine(-40, start_hooks=[])
+    options = dict(engine.options)
+    for invalid in ({"channel_mask": "0,2"}, {"release": "-1"}, {"release": "soon"}, {"detect_on": "loud"},
+                    {"idle_measure": 2}, {"rt_priority": 100}, {"latency": 500}, {"channels": 1.5},
+                    {"persistent": "maybe"}, {"start_hooks": [1]}):
+        with pytest.raises(ValueError):
+            engine.reconfigure(-40, **invalid)
+        assert engine.options == options
+
+
+def run_in_thread(engine):
+    """ Runs the engine like alsaloopmpris does, the exception it ends with is appended to the returned list """
+    errors = []
+
+    def run():
+        try:
+            engine.run()
+        except Exception as e:
+            errors.append(e)
+
+    # engine.stop() waits for it
+    engine.thread = threading.Thread(target=run, daemon=True)
+    engine.thread.start()
+    return errors
+
+
+@pytest.mark.parametrize("device_type", [alsaloopfake.PCM_CAPTURE, alsaloopfake.PCM_PLAYBACK])
+def test_device_failure_ends_the_engine_run(device_type):
+    backend = alsaloopfake.install(alsaloopfake.tone(60), speed=10)
+    engine = alsaloop.Engine(-40, start_hooks=[])
+    events = []
+    engine.add_listener(lambda event, values: event == "playback" and events.append(values["playing"]))
+    errors = run_in_thread(engine)
+    try:
+        assert wait_until(lambda: engine.playing)
+        backend.failing.add(device_type)
+        assert wait_until(lambda: errors)
+        assert isinstance(errors[0], alsaloopfake.ALSAAudioError)
+        assert engine.counters["device_errors"] == 1
+        # Started again, output continues without telling the listeners that it has stopped
+        assert engine.resume
+        backend.failing.clear()
+        played = backend.played_frames
+        errors = run_in_thread(engine)
+        assert wait_until(lambda: backend.played_frames > played)
+        assert events == [True] and not errors
+    finally:
+        engine.stop()
+
+
+def test_busy_output_is_opened_again():
+    backend = alsaloopfake.install(itertools.chain(alsaloopfake.silence(3), alsaloopfake.tone(60)), speed=5)
+    engine = alsaloop.Engine(-40, start_hooks=[])
+    engine.start()
+    try:
+        assert wait_until(lambda: engine.pipeline is not None)
+        # The devices have been probed, playback is opened once the tone starts
+        backend.busy_opens = 3
+        assert wait_until(lambda: backend.played_frames > 0)
+        assert engine.counters["output_open_failures"] == 3
+        assert engine.thread.is_alive()
+    finally:
+        engine.stop()
+
+
+@pytest.mark.parametrize("persistent", [True, False])
+def test_fade_out_is_played_before_the_output_stops(persistent):
+    pytest.importorskip("numpy")
+    backend = alsaloopfake.install(alsaloopfake.tone(60), speed=5)
+    engine = alsaloop.Engine(-40, start_hooks=[], persistent=persistent)
+    engine.start()
+    try:
+        assert wait_until(lambda: backend.played_frames > alsaloop.SAMPLE_RATE)
+        stop_event = "pause" if persistent else "close"
+        engine.control("pause")
+        assert wait_until(lambda: any(event == stop_event for (event, _value) in backend.playback_events))
+        events = list(backend.playback_events)
+        stop = [event for (event, _value) in events].index(stop_event)
+        # The fade is followed by a period of silence, only that is still queued when the device stops
+        (fade, silence) = (array("i", events[stop - 2][1]), array("i", events[stop - 1][1]))
+        assert events[stop - 2][0] == events[stop - 1][0] == "write"
+        assert not any(silence)
+        assert events[stop][1] <= len(silence) // alsaloopfake.CHANNELS
+        frames = len(fade) // alsaloopfake.CHANNELS
+        assert frames == int(alsaloop.SAMPLE_RATE * engine.options["fade_time"] / 1000)
+        # The tone is at -20 dBFS, its last quarter fades below -32 dBFS
+        quarters = [max(abs(sample) for sample in fade[i * len(fade) // 4:(i + 1) * len(fade) // 4])
+                    for i in range(4)]
+        assert quarters[0] > quarters[3] and quarters[3] < alsaloopfake.amplitude(-32)
+
+        engine.control("play")
+        assert wait_until(lambda: engine.playing)
+        assert wait_until(lambda: backend.playback_events[-1][0] == "write")
+        if persistent:
+            # The rest of the silence is dropped before the output plays again
+            events = list(backend.playback_events)
+            assert [event for (event, _value) in events[stop:]][:3] == ["pause", "drop", "write"]
+    finally:
+        engine.stop()
+
+
+def playback_gate():
+    """ A gate on a fake playback device with a period of PERIOD_SIZE frames, and the backend """
+    backend = alsaloopfake.install([])
+    device = alsaloopfake.PCM(alsaloopfake.PCM_PLAYBACK)
+    device.setperiodsize(alsaloop.PERIOD_SIZE)
+    return (alsaloop.OutputGate(device, None), backend)
+
+
+def test_gate_pauses_and_drops_the_old_audio():
+    (gate, backend) = playback_gate()
+    period = bytes(alsaloop.PERIOD_SIZE * alsaloop.FRAME_SIZE)
+    gate.write(period)
+    gate.close()
+    assert gate.paused
+    gate.open()
+    assert not gate.paused
+    gate.write(period)
+    assert [event for (event, _) in backend.playback_events] == ["write", "pause", "drop", "write"]
+    # The period was still queued when the device was paused
+    assert backend.playback_events[1][1] > 0
+
+
+def test_gate_that_has_not_started_stays_untouched():
+    (gate, backend) = playback_gate()
+    gate.close()
+    gate.drain()
+    gate.idle(alsaloop.PERIOD_SIZE)
+    gate.open()
+    assert not gate.paused and not gate.needs_silence
+    assert not backend.playback_events
+
+
+def test_gate_plays_silence_if_the_device_cannot_pause():
+    (gate, backend) = playback_gate()
+
+    def pause(_enable=True):
+        raise alsaloop.alsaaudio.ALSAAudioError("Function not implemented")
+
+    gate.output_device.pause = pause
+    gate.write(alsaloopfake.encode([1000] * alsaloop.PERIOD_SIZE * alsaloopfake.CHANNELS))
+    gate.close()
+    assert not gate.paused and gate.needs_silence
+    gate.close()
+    gate.idle(alsaloop.PERIOD_SIZE // 2)
+    gate.open()
+    events = list(backend.playback_events)
+    assert [event for (event, _) in events] == ["write", "write"]
+    assert events[1][1] == bytes(alsaloop.PERIOD_SIZE // 2 * alsaloop.FRAME_SIZE)
+
+
+def test_gate_drain_waits_for_the_queued_audio():
+    (gate, backend) = playback_gate()
+    for _i in range(3):
+        gate.write(alsaloopfake.encode([1000] * alsaloop.PERIOD_SIZE * alsaloopfake.CHANNELS))
+    start = time.monotonic()
+    gate.drain()
+    # Three periods were played, only the silence after them is still queued
+    assert time.monotonic() - start > 2 * alsaloop.PERIOD_SIZE / alsaloopfake.SAMPLE_RATE
+    assert gate.output_device.queued() <= alsaloop.PERIOD_SIZE
+    (event, data) = backend.playback_events[-1]
+    assert event == "write" and data == gate.silence
+
+
+class NonBlockingOutput():
+    """ A playback device in non-blocking mode that takes what fits into its buffer and can't be paused """
+
+    def __init__(self, buffer_frames=2 * alsaloop.PERIOD_SIZE, frame_size=alsaloop.FRAME_SIZE):
+        self.buffer_frames = buffer_frames
+        self.frame_size = frame_size
+        self.queued = 0
+
+    def write(self, data):
+        frames = min(len(data) // self.frame_size, self.buffer_frames - self.queued)
+        self.queued += frames
+        return frames
+
+    def pause(self, _enable=True):
+        raise alsaloop.alsaaudio.ALSAAudioError("Function not implemented")
+
+
+class OutputPoller():
+    """ Ready once a period can be written, the device plays a period if it is full """
+
+    def __init__(self, device):
+        self.device = device
+
+    def wait(self, _timeout):
+        if self.device.buffer_frames - self.device.queued < alsaloop.PERIOD_SIZE:
+            self.device.queued -= alsaloop.PERIOD_SIZE
+        return True
+
+
+def test_silence_is_written_when_the_device_is_ready():
+    device = NonBlockingOutput()
+    counters = alsaloop.Counter()
+    gate = alsaloop.OutputGate(device, OutputPoller(device), counters=counters)
+    gate.write(bytes(alsaloop.PERIOD_SIZE * alsaloop.FRAME_SIZE))
+    gate.close()
+    assert gate.needs_silence
+    for _i in range(10):
+        gate.idle(alsaloop.PERIOD_SIZE)
+    assert counters["short_writes"] == 0
+
+
+def test_watermarks_have_to_fit_the_buffer():
+    alsaloopfake.install([])
+    pipeline = alsaloop.Pipeline(buffer_time=500)
+    pipeline.setup_buffers()
+    frame_size = pipeline.input_frame_size
+    (target_fill, low_watermark, high_watermark) = pipeline.watermarks(100, 10, 400)
+    assert target_fill == 4800 * frame_size
+    # At least a period has to be buffered before it is played
+    assert low_watermark == alsaloop.PERIOD_SIZE * frame_size
+    assert high_watermark == 19200 * frame_size
+    for (latency, low, high) in ((100, 150, 400), (100, 50, 90), (100, 50, 480)):
+        with pytest.raises(ValueError):
+            pipeline.watermarks(latency, low, high)
+    pipeline.set_buffering(150, 50, 300)
+    assert pipeline.target_fill == 7200 * frame_size and pipeline.latency == 150
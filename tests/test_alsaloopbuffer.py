@@ -0,0 +1,88 @@
+import threading
+
+import alsaloopbench
+import alsaloopbuffer
+
+
+def read_all(ring):
+    out = bytearray(ring.size)
+    return bytes(out[:ring.read(out)])
+
+
+def test_ring_buffer_wraps_around():
+    ring = alsaloopbuffer.RingBuffer(4, 2)
+    assert ring.write(b"aabbcc") == 0
+    out = bytearray(4)
+    assert ring.read(out) == 4 and out == b"aabb"
+    assert ring.write(b"ddee") == 0
+    assert ring.fill_frames == 3
+    assert read_all(ring) == b"ccddee"
+    assert ring.fill == 0
+
+
+def test_ring_buffer_overwrites_the_oldest_frames():
+    ring = alsaloopbuffer.RingBuffer(4, 2)
+    ring.write(b"aabbcc")
+    assert ring.write(b"ddee") == 2
+    assert read_all(ring) == b"bbccddee"
+    ring.write(b"aa")
+    # More than the buffer holds, only the newest frames are kept
+    assert ring.write(b"ffgghhiijj") == 4
+    assert read_all(ring) == b"gghhiijj"
+
+
+def test_ring_buffer_reads_and_discards_whole_frames():
+    ring = alsaloopbuffer.RingBuffer(4, 2)
+    ring.write(b"aabbcc")
+    out = bytearray(3)
+    assert ring.read(out) == 2 and out[:2] == b"aa"
+    assert ring.discard(3) == 2
+    assert read_all(ring) == b"cc"
+
+
+def test_ring_buffer_moves_to_another_one():
+    preroll = alsaloopbuffer.RingBuffer(2, 2)
+    preroll.write(b"aabbcc")
+    ring = alsaloopbuffer.RingBuffer(4, 2)
+    ring.write(b"xx")
+    assert preroll.move_to(ring) == 4
+    assert preroll.fill == 0
+    assert read_all(ring) == b"xxbbcc"
+
+
+def test_ring_buffer_wait():
+    ring = alsaloopbuffer.RingBuffer(4, 2)
+    ring.write(b"aa")
+    assert not ring.wait(4, 0.01)
+    writer = threading.Timer(0.05, ring.write, (b"bb",))
+    writer.start()
+    assert ring.wait(4, 5)
+    writer.join()
+
+
+def test_drift_simulation_shorter_than_an_hour():
+    (lowest, highest, drift, wobble) = alsaloopbench.simulate_drift(100e-6, 0.25)
+    assert lowest <= highest
+    assert abs(drift - 100e-6) < 20e-6
+    assert wobble >= 0
+
+
+def test_drift_controller_follows_the_fill():
+    controller = alsaloopbuffer.DriftController(4800)
+    # Capture is faster, the buffer fills up and more frames have to be played
+    for _i in range(20000):
+        ratio = controller.update(6000)
+    assert ratio > 1 and controller.drift > 0
+    assert ratio <= 1 + alsaloopbuffer.MAX_DRIFT
+    controller.reset()
+    assert controller.drift > 0
+    for _i in range(20000):
+        ratio = controller.update(3600)
+    assert ratio < 1
+
+
+def test_drift_controller_is_clamped():
+    controller = alsaloopbuffer.DriftController(4800, max_drift=0.0005)
+    for _i in range(1000):
+        controller.update(48000)
+    assert controller.ratio == 1.0005 and controller.drift <= 0.0005
@@ -0,0 +1,156 @@
+import pytest
+
+import alsaloopdetect
+import alsaloopdsp
+import alsaloopfake
+
+
+def run(detector, periods):
+    meter = alsaloopdsp.create_meter("auto", alsaloopdsp.DEFAULT_FORMAT, alsaloopfake.CHANNELS)
+    for data in periods:
+        frames = len(data) // (alsaloopfake.CHANNELS * 4)
+        detector.update(*meter.measure_channels(data), frames)
+    return detector.active
+
+
+def crest_detector():
+    return alsaloopdetect.Detector(-45, alsaloopfake.FULL_SCALE, alsaloopfake.SAMPLE_RATE, 2048, mode="crest",
+                                   release=1000)
+
+
+def test_crest_keeps_a_loud_steady_tone():
+    assert run(crest_detector(), alsaloopfake.tone(5, level=-20))
+
+
+def test_crest_rejects_hum():
+    assert not run(crest_detector(), alsaloopfake.tone(5, frequency=50, level=-35))
+
+
+def test_noise_floor_ignores_a_long_signal():
+    noise_floor = alsaloopdetect.NoiseFloor(half_life=10)
+    detector = alsaloopdetect.Detector(None, alsaloopfake.FULL_SCALE, alsaloopfake.SAMPLE_RATE, 2048,
+                                       noise_floor=noise_floor)
+    assert not run(detector, list(alsaloopfake.noise(1, level=-70)) * 40)
+    floor = noise_floor.level
+    # Four half lives of music, the noise before it has less than a tenth of the weight
+    assert run(detector, list(alsaloopfake.tone(1, level=-20)) * 40)
+    assert abs(noise_floor.level - floor) < 3
+
+
+PERIOD_SIZE = 2048
+PERIOD_TIME = PERIOD_SIZE / alsaloopfake.SAMPLE_RATE
+
+
+def level_detector(**kwargs):
+    """ A detector that only looks at the last period """
+    return alsaloopdetect.Detector(-40, alsaloopfake.FULL_SCALE, alsaloopfake.SAMPLE_RATE, PERIOD_SIZE, window=1,
+                                   **kwargs)
+
+
+def feed(detector, level, seconds):
+    """ Periods with a peak at level dBFS, returns the seconds after which the state changed """
+    peak = alsaloopfake.amplitude(level)
+    changes = []
+    for period in range(int(round(seconds / PERIOD_TIME))):
+        if detector.update(PERIOD_SIZE, [peak ** 2 * PERIOD_SIZE] * 2, [peak] * 2, PERIOD_SIZE):
+            changes.append((period + 1) * PERIOD_TIME)
+    return changes
+
+
+def test_attack_time():
+    detector = level_detector(attack=500)
+    # Bursts shorter than the attack time don't start the output
+    for _i in range(5):
+        assert feed(detector, -20, 0.4) == []
+        assert feed(detector, -60, 0.1) == []
+    assert not detector.active
+    (started,) = feed(detector, -20, 1)
+    assert 0.5 <= started < 0.5 + PERIOD_TIME
+    assert detector.active
+
+
+def test_release_time():
+    detector = level_detector(release=2000)
+    assert feed(detector, -20, 0.1) and detector.active
+    # Gaps shorter than the release time keep the output
+    assert feed(detector, -90, 1.5) == []
+    assert feed(detector, -20, 0.1) == []
+    (stopped,) = feed(detector, -90, 3)
+    assert 2 <= stopped < 2 + PERIOD_TIME
+    assert not detector.active
+
+
+def test_hysteresis():
+    detector = level_detector(hysteresis=6, release=0)
+    # Between the stop and the start threshold, nothing changes
+    assert feed(detector, -43, 1) == [] and not detector.active
+    assert feed(detector, -35, 0.1) and detector.active
+    assert feed(detector, -43, 1) == [] and detector.active
+    assert detector.threshold == -46
+    assert feed(detector, -50, 0.1) and not detector.active
+    assert detector.threshold == -40
+
+
+def test_noise_floor_percentile():
+    # No noticeable decay, the levels count by their duration
+    noise_floor = alsaloopdetect.NoiseFloor(half_life=1e9)
+    assert noise_floor.level is None
+    noise_floor.add(-80, 3)
+    noise_floor.add(-30, 17)
+    # The level of the quietest tenth of the time
+    assert noise_floor.level == -80
+    noise_floor.add(-60, 20)
+    assert noise_floor.level == -60
+
+
+def test_noise_floor_calibration():
+    noise_floor = alsaloopdetect.NoiseFloor(half_life=1e9)
+    noise_floor.add(-70, alsaloopdetect.NOISE_CALIBRATION - 1)
+    assert not noise_floor.calibrated
+    noise_floor.add(-70, 2)
+    assert noise_floor.calibrated
+
+
+def test_noise_floor_half_life():
+    noise_floor = alsaloopdetect.NoiseFloor(half_life=10)
+    noise_floor.add(-80, 10)
+    noise_floor.add(-60, 10)
+    # The first levels have half the weight of the last ones
+    assert noise_floor.seconds == pytest.approx(15)
+    # Long enough that the weight is rescaled several times
+    for _ in range(100):
+        noise_floor.add(-60, 10)
+    assert noise_floor.seconds == pytest.approx(20)
+    assert noise_floor.level == -60
+
+
+def test_noise_floor_bins():
+    noise_floor = alsaloopdetect.NoiseFloor(half_life=1e9)
+    # Digital silence and levels below the lowest bin count as the lowest bin, nothing is above 0 dBFS
+    noise_floor.add(float("-inf"), 1)
+    noise_floor.add(-200, 1)
+    noise_floor.add(3, 1)
+    assert noise_floor.bins[0] == pytest.approx(2 * noise_floor.weight)
+    assert noise_floor.bins[-1] == pytest.approx(noise_floor.weight)
+    noise_floor.add(-70.1, 100)
+    assert noise_floor.level == -70
+
+
+def test_noise_floor_save_and_load(tmp_path):
+    noise_floor = alsaloopdetect.NoiseFloor()
+    noise_floor.add(-75, 20)
+    noise_floor.add(-40, 20)
+    path = str(tmp_path / "state" / "noisefloor.json")
+    noise_floor.save(path)
+    loaded = alsaloopdetect.NoiseFloor()
+    loaded.load(path)
+    assert loaded.level == noise_floor.level
+    assert loaded.seconds == pytest.approx(noise_floor.seconds)
+    assert loaded.calibrated
+
+
+def test_noise_floor_load_rejects_other_bins(tmp_path):
+    path = str(tmp_path / "noisefloor.json")
+    alsaloopdetect.NoiseFloor(step=1).save(path)
+    with pytest.raises(ValueError):
+        alsaloopdetect.NoiseFloor().load(path)
@@ -0,0 +1,92 @@
+import statistics
+import time
+
+import pytest
+
+import alsaloopdetect
+import alsaloopdsp
+import alsaloopfake
+from alsaloopbench import noise_period
+
+numpy = pytest.importorskip("numpy")
+
+SAMPLE_RATE = 48000
+PERIOD_SIZE = 2048
+
+
+@pytest.mark.parametrize("channels", [2, 8])
+def test_gain_stage_within_period_budget(channels):
+    """ The benchmark of alsaloopbench.py gain, fading has to take a small part of the time of a period """
+    data = noise_period(PERIOD_SIZE, channels)
+    stage = alsaloopdsp.GainStage(alsaloopdsp.FORMATS["S32_LE"], channels, SAMPLE_RATE)
+    times = []
+    for _i in range(200):
+        stage.fade_in()
+        start = time.perf_counter()
+        stage.process(data)
+        times.append(time.perf_counter() - start)
+    assert statistics.median(times) < 0.05 * PERIOD_SIZE / SAMPLE_RATE
+
+
+def test_gain_stage_is_bit_exact_at_unity():
+    data = noise_period(PERIOD_SIZE, 2)
+    stage = alsaloopdsp.GainStage(alsaloopdsp.FORMATS["S32_LE"], 2, SAMPLE_RATE)
+    stage.set_volume(0.5)
+    stage.set_volume(1.0)
+    while stage.fade.moving or stage.volume.moving:
+        stage.process(data)
+    assert bytes(stage.process(data)) == data
+
+
+@pytest.mark.parametrize("weighting", alsaloopdsp.WEIGHTINGS)
+def test_subsampled_weighted_meter_reads_the_same_level(weighting):
+    """ Hum measured on a quarter of every idle period reads like all the periods of the normal size """
+    levels = []
+    for (period_size, fraction) in ((PERIOD_SIZE, None), (4 * PERIOD_SIZE, 0.25)):
+        meter = alsaloopdsp.WeightedMeter(alsaloopdsp.FORMATS["S32_LE"], 2, SAMPLE_RATE, weighting)
+        if fraction is not None:
+            meter = alsaloopdsp.SubsamplingMeter(meter, fraction)
+        (count, sample_sum) = (0, 0)
+        for data in alsaloopfake.tone(2, frequency=50, level=-30, period_size=period_size):
+            (frames, square_sum, _peak) = meter.measure(data)
+            count += frames
+            sample_sum += square_sum
+        levels.append(alsaloopdetect.decibel((sample_sum / count) ** 0.5, alsaloopfake.FULL_SCALE))
+    assert abs(levels[0] - levels[1]) < 1
+
+
+def ramp(frames, channels=2):
+    """ S32_LE frames whose samples rise by 1000 per frame """
+    return alsaloopfake.encode([frame * 1000 for frame in range(frames) for _channel in range(channels)])
+
+
+def samples(data):
+    return alsaloopdsp.FORMATS["S32_LE"].samples(data).reshape(-1, 2)[:, 0]
+
+
+def test_resampler_passes_through_at_ratio_one():
+    resampler = alsaloopdsp.Resampler(2)
+    data = ramp(3 * PERIOD_SIZE)
+    blocks = [data[start:start + PERIOD_SIZE * 8] for start in range(0, len(data), PERIOD_SIZE * 8)]
+    # The last frame is kept to interpolate towards the next block
+    assert b"".join(bytes(resampler.process(block, 1.0)) for block in blocks) == data[:-8]
+
+
+def test_resampler_interpolates_across_blocks():
+    resampler = alsaloopdsp.Resampler(2)
+    data = ramp(10 * PERIOD_SIZE)
+    output = b"".join(bytes(resampler.process(data[start:start + PERIOD_SIZE * 8], 1.001))
+                      for start in range(0, len(data), PERIOD_SIZE * 8))
+    values = samples(output)
+    assert len(values) == pytest.approx(10 * PERIOD_SIZE / 1.001, abs=1)
+    # A ramp stays a ramp with a step of ratio * 1000, also where the blocks meet
+    assert numpy.allclose(numpy.diff(values), 1001, atol=1)
+
+
+def test_frame_slip_resampler_drops_and_repeats_frames():
+    # At most a frame per period
+    for ratio in (1.0003, 0.9997):
+        resampler = alsaloopdsp.FrameSlipResampler(2)
+        data = ramp(PERIOD_SIZE)
+        frames = sum(len(resampler.process(data, ratio)) // 8 for _i in range(100))
+        assert abs(frames - 100 * PERIOD_SIZE / ratio) <= 1
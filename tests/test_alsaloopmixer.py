@@ -0,0 +1,39 @@
+import math
+
+import pytest
+
+import alsaloopfake
+
+alsaloopfake.install([])
+import alsaloopmixer  # noqa: E402
+
+
+class GainStage():
+    """ Records the volume instead of applying it """
+
+    def __init__(self):
+        self.volume = None
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+
+@pytest.mark.parametrize("curve, volume, decibel", [
+    ("linear", 100, 0.0),
+    ("linear", 50, -18.06),
+    ("linear", 10, -60.0),
+    ("db", 0, 0.0),
+    ("db", -600, -6.0),
+    ("db", -4000, -40.0),
+])
+def test_software_volume_curve(curve, volume, decibel):
+    stage = GainStage()
+    follower = alsaloopmixer.VolumeFollower(curve, gain_stage=stage)
+    follower.apply(volume)
+    assert 20 * math.log10(stage.volume) == pytest.approx(decibel, abs=0.01)
+
+
+def test_software_volume_is_muted_at_zero():
+    stage = GainStage()
+    alsaloopmixer.VolumeFollower("linear", gain_stage=stage).apply(0)
+    assert stage.volume == 0
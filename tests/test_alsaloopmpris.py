@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import alsaloopfake
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+alsaloopfake.install([])
+import alsaloop  # noqa: E402
+import alsaloopmpris  # noqa: E402
+import alsaloopsupervisor  # noqa: E402
+
+
+class Service():
+    """ Records the properties the wrapper reports instead of sending them """
+
+    def __init__(self):
+        self.updated = []
+
+    def update_property(self, interface, prop):
+        self.updated.append(prop)
+
+
+@pytest.fixture
+def wrapper(monkeypatch):
+    monkeypatch.setattr(dbus, "SessionBus", lambda: None)
+    wrapper = alsaloopmpris.ALSALoopWrapper(external=True)
+    wrapper.dbus_service = Service()
+    return wrapper
+
+
+def test_engine_event_without_engine(wrapper):
+    wrapper.engine_event("level", {"playing": True, "rms": -30.0, "peak": -20.0})
+    assert wrapper.playback_status == alsaloopmpris.PLAYBACK_PLAYING
+    wrapper.engine_event("playback", {"playing": False, "hold": None})
+    assert wrapper.playback_status == alsaloopmpris.PLAYBACK_STOPPED
+    assert "PlaybackStatus" in wrapper.dbus_service.updated
+
+
+def test_configure_rejects_invalid_settings(wrapper):
+    wrapper.configure({"sensitivity": 45, "release": "5000", "channel_mask": "0"})
+    assert wrapper.options == {"release": 5000.0, "channel_mask": [0]}
+    for invalid in ({"channel_mask": "0,7"}, {"release": "-5"}, {"sensitivity": "loud"}):
+        with pytest.raises(ValueError):
+            wrapper.configure(invalid, update=True)
+        assert wrapper.alsaloopdb == 45
+        assert wrapper.options == {"release": 5000.0, "channel_mask": [0]}
+
+
+def test_watchdog_fires_when_capture_stalls(wrapper, monkeypatch):
+    backend = alsaloopfake.install(alsaloopfake.silence(60), speed=5)
+    monkeypatch.setattr(alsaloopsupervisor, "HEARTBEAT_TIMEOUT", 2)
+    exits = []
+    monkeypatch.setattr(alsaloopmpris.os, "_exit", exits.append)
+    wrapper.engine = alsaloop.Engine(-40, start_hooks=[])
+    wrapper.engine.add_listener(wrapper.engine_event)
+    wrapper.started()
+    wrapper.engine.start()
+    try:
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            wrapper.check_heartbeat()
+            time.sleep(0.1)
+        assert not exits
+        # The engine thread keeps sending heartbeats, but nothing is captured anymore
+        backend.stalled = True
+        deadline = time.monotonic() + 5
+        while not exits and time.monotonic() < deadline:
+            wrapper.check_heartbeat()
+            time.sleep(0.1)
+        assert exits == [1]
+    finally:
+        backend.stalled = False
+        wrapper.engine.stop()
@@ -0,0 +1,40 @@
+import pytest
+
+import alsaloopsupervisor
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    backoff = alsaloopsupervisor.Backoff(minimum=1, maximum=10, jitter=0)
+    assert [backoff.failed() for _i in range(6)] == [1, 2, 4, 8, 10, 10]
+    backoff.reset()
+    assert backoff.failed() == 1
+
+
+def test_backoff_jitter_only_shortens_the_delay():
+    backoff = alsaloopsupervisor.Backoff(minimum=4, maximum=4, jitter=0.25)
+    delays = [backoff.failed() for _i in range(100)]
+    assert all(3 <= delay <= 4 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_backoff_starts_over_after_a_healthy_run(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(alsaloopsupervisor.time, "monotonic", lambda: now[0])
+    backoff = alsaloopsupervisor.Backoff(minimum=1, maximum=60, jitter=0, healthy=30)
+    for delay in (1, 2, 4):
+        backoff.started()
+        now[0] += 10
+        assert backoff.failed() == delay
+    backoff.started()
+    now[0] += 30
+    assert backoff.failed() == 1
+
+
+@pytest.mark.parametrize("data, action, properties", [
+    (b"add@/devices/platform/sound/card1\0ACTION=add\0SUBSYSTEM=sound\0DEVNAME=snd/pcmC1D0c",
+     "add", {"ACTION": "add", "SUBSYSTEM": "sound", "DEVNAME": "snd/pcmC1D0c"}),
+    (b"remove@/devices/virtual/net/lo\0ACTION=remove\0SEQNUM=\xff\0",
+     "remove", {"ACTION": "remove", "SEQNUM": "\ufffd"}),
+])
+def test_parse_uevent(data, action, properties):
+    assert alsaloopsupervisor.parse_uevent(data) == (action, properties)
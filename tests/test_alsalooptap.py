@@ -0,0 +1,62 @@
+import sys
+
+import pytest
+
+import alsaloopdsp
+import alsaloopfake
+import alsaloopreplay
+import alsalooptap
+
+
+def test_read_tap_maps_the_slots(tmp_path):
+    path = str(tmp_path / "tap")
+    tap = alsalooptap.Tap(path, alsaloopdsp.FORMATS["S32_LE"], 2, 48000, 2048, seconds=1)
+    periods = list(alsaloopfake.tone(2))
+    for data in periods:
+        tap.write(data, len(data) // 8, -23.0, -20.0, -45.0, True)
+    tap.close()
+
+    (info, read) = alsalooptap.read_tap(path)
+    assert info["periods_written"] == len(periods)
+    capacity = len(read)
+    assert [bytes(period.data) for period in read] == periods[-capacity:]
+    assert all(isinstance(period.data, memoryview) for period in read)
+
+
+def test_read_tap_rejects_other_files(tmp_path):
+    path = tmp_path / "empty"
+    path.write_bytes(b"")
+    with pytest.raises(ValueError):
+        alsalooptap.read_tap(str(path))
+    path.write_bytes(b"RIFF" + bytes(200))
+    with pytest.raises(ValueError):
+        alsalooptap.read_tap(str(path))
+
+
+def test_tap_continues_a_file_with_the_same_format(tmp_path):
+    path = str(tmp_path / "tap")
+    periods = list(alsaloopfake.tone(1))
+    for data in periods:
+        tap = alsalooptap.Tap(path, alsaloopdsp.FORMATS["S32_LE"], 2, 48000, 2048, seconds=10)
+        tap.write(data, len(data) // 8, -23.0, -20.0, -45.0, True)
+        tap.close()
+    (info, read) = alsalooptap.read_tap(path)
+    assert info["periods_written"] == len(periods)
+    assert [bytes(period.data) for period in read] == periods
+
+    # Another period size starts over
+    tap = alsalooptap.Tap(path, alsaloopdsp.FORMATS["S32_LE"], 2, 48000, 1024, seconds=10)
+    tap.close()
+    (info, read) = alsalooptap.read_tap(path)
+    assert info["periods_written"] == 0 and read == []
+
+
+def test_replay_without_threshold(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "tap")
+    tap = alsalooptap.Tap(path, alsaloopdsp.FORMATS["S32_LE"], 2, 48000, 2048, seconds=10)
+    for data in alsaloopfake.tone(1):
+        tap.write(data, len(data) // 8, -23.0, -20.0, -45.0, True)
+    tap.close()
+    monkeypatch.setattr(sys, "argv", ["alsaloopreplay.py", path, "0"])
+    alsaloopreplay.main()
+    assert "threshold off," in capsys.readouterr().out